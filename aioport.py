@@ -0,0 +1,134 @@
+import asyncio
+from time import time, monotonic
+from collections import namedtuple
+from instrument import SerialPort, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from scheduler import parse_reading
+
+# Subscription settings
+default_max_wait = 3  # longest time (in seconds) a subscription sleeps between passes, as Controller's delay_sensor
+response_timeout = 60  # longest time (in seconds) a response is awaited, as SerialMessage.response() waits
+
+Reading = namedtuple('Reading', 'name response value timestamp')  # one channel read yielded by subscribe()
+
+
+def _resolve(future, response):
+    if not future.done():  # the awaiting task may have been cancelled
+        future.set_result(response)
+
+
+class AsyncSerialPort:
+    """
+    An asyncio front end to a SerialPort, so that one event loop can drive several instruments, sequences and client
+    connections as tasks. Commands still go through the port's CommandQueue and IO thread, which own the (blocking)
+    pyserial connection; each SerialMessage completes an asyncio future through its done callback, so awaiting a
+    response never blocks the loop. transmit() and transmit_many() run the same request/response handling as their
+    SerialPort counterparts (so the same arguments, retries, caching, coalescing and return values) and only do the
+    waiting differently, and the SerialPort stays usable from threads at the same time.
+    """
+    def __init__(self, serial_port=None):
+        self.serial_port = SerialPort() if serial_port is None else serial_port
+
+    @property
+    def is_open(self):
+        return self.serial_port.is_open
+
+    @property
+    def cache(self):
+        return self.serial_port.cache
+
+    async def open(self, portname=None):
+        """
+        Opens the port (in the loop's default executor, as opening real hardware can take a while).
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self.serial_port.open, portname)
+
+    def close(self):
+        return self.serial_port.close()
+
+    @staticmethod
+    def _future(serialmessage):
+        """
+        Returns a future of the running loop that is completed with the response of `serialmessage'.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        serialmessage.add_done_callback(
+            lambda message: loop.call_soon_threadsafe(_resolve, future, message.result(0)))
+        return future
+
+    async def transmit(self, message, error_message=None, print_response=True, attempts=2,
+                       priority=PRIORITY_INTERACTIVE, cache_ttl=None):
+        """
+        Sends `message' and returns its response, retrying up to `attempts' times in total while the response is
+        missing or starts with `?'. A read given a `cache_ttl' (in seconds) is answered from the cache when possible.
+        """
+        return await self._wait_for(self.serial_port._transmit_steps(message, error_message, print_response, attempts,
+                                                                     priority, cache_ttl))
+
+    async def transmit_many(self, messages, error_messages=None, print_response=True, attempts=2,
+                            priority=PRIORITY_INTERACTIVE, cache_ttls=None):
+        """
+        Sends a group of commands as one SerialBatch and returns their responses as a list in the same order, retrying
+        failed items as SerialPort.transmit_many() does.
+        """
+        return await self._wait_for(self.serial_port._transmit_many_steps(messages, error_messages, print_response,
+                                                                          attempts, priority, cache_ttls))
+
+    async def _wait_for(self, steps):
+        """
+        Runs a generator from SerialPort._transmit_steps() or _transmit_many_steps() to its result, awaiting the
+        messages it yields through futures rather than blocking on their Events. As in SerialPort._wait_for(), each
+        wait lasts at most `response_timeout' seconds, after which unanswered messages count as failed (and are
+        retried or reported as `?' by the generator).
+        """
+        try:
+            serialmessages = next(steps)
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.gather(*(self._future(serialmessage)
+                                                            for serialmessage in serialmessages)), response_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                serialmessages = steps.send(None)
+        except StopIteration as stop:
+            return stop.value
+
+    async def subscribe(self, scheduler, max_wait=default_max_wait):
+        """
+        Polls the channels of a PollScheduler as each falls due, exactly as Controller's monitor threads do, and
+        yields a Reading for every channel read until the port closes:
+
+            async for reading in port.subscribe(scheduler):
+                print(reading.name, reading.value)
+
+        The subscription sleeps on the loop between passes and is woken early by scheduler.poll_now()/boost() from
+        any thread. Only one subscription should drive a given scheduler.
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(wakeup.set)
+
+        scheduler.add_wakeup_callback(wake)
+        try:
+            while self.is_open:
+                channels = scheduler.due()
+                if channels:
+                    responses = await self.transmit_many([channel.command for channel in channels],
+                                                         [channel.error_message for channel in channels], False,
+                                                         priority=PRIORITY_BACKGROUND,
+                                                         cache_ttls=[channel.cache_ttl for channel in channels])
+                    timestamp = time()
+                    for channel, response in zip(channels, responses):
+                        scheduler.update(channel, response)
+                        yield Reading(channel.name, response, parse_reading(response), timestamp)
+                next_due = scheduler.next_due()
+                timeout = max_wait if next_due is None else min(max(next_due - monotonic(), 0.0), max_wait)
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
+        finally:
+            scheduler.remove_wakeup_callback(wake)
@@ -0,0 +1,234 @@
+from time import time, monotonic
+from collections import deque
+from threading import Thread, Event, Lock
+from instrument import SerialMessage, Histogram, PRIORITY_CONTROL
+from controller import uid_magnet
+
+# Interlock settings used by default_rules()
+magnet_temperature_limit = 5.0  # K: the magnet is held above this temperature
+magnet_warming_limit = 0.02  # K/s: the magnet is held if it warms faster than this
+pt2_temperature_limit = 70  # K: the magnet is held above this second stage temperature
+vti_pressure_high = 25  # mB: VTI pressures above this are reported
+vti_pressure_low = 1  # mB: VTI pressures below this are reported
+stale_limit = 30  # seconds without a magnet temperature reading before the magnet is held
+stale_polls = 3  # a channel with a stale rule is polled at least this many times every `stale_after' seconds
+stale_check_interval = 1.0  # seconds between checks for channels that have gone quiet
+event_history = 1000  # alarm events kept in AlarmEngine.events
+magnet_actions = {'hold': 'HOLD', 'zero': 'RTOZ'}  # rule action -> iPS magnet action sent when the rule trips
+
+
+class AlarmRule:
+    """
+    A condition on one channel's readings. The rule trips when a reading is above `above' or below `below', when the
+    channel rises faster than `rate' per second between consecutive readings (falls faster, for a negative `rate'), or
+    when no reading has arrived for `stale_after' seconds while its instrument is connected. A tripped rule clears on
+    the first reading that is back inside its limits by `hysteresis', so a reading hovering at a limit does not trip it
+    over and over. `action' is what to do when it trips: `hold' or `zero' (see `magnet_actions'), a function called as
+    action(engine, rule), or None to only report it.
+    """
+    def __init__(self, name, channel, above=None, below=None, rate=None, stale_after=None, hysteresis=0.0,
+                 action=None):
+        self.name = name
+        self.channel = channel
+        self.above = above
+        self.below = below
+        self.rate = rate
+        self.stale_after = stale_after
+        self.hysteresis = hysteresis
+        self.action = action
+        self.active = False
+        self.reason = None  # why the rule last tripped
+        self._last_value, self._last_time = None, None
+        self._last_seen = monotonic()  # monotonic time of the latest reading (or of the start, or of connecting)
+        self._port_open = False  # whether the channel's instrument was connected at the last stale check
+
+    def _evaluate(self, value, timestamp):
+        """
+        Updates the rule with a reading and returns the reason it is tripped, or None if it is (or may be) clear.
+        """
+        rate = None
+        if self._last_time is not None and timestamp > self._last_time:
+            rate = (value - self._last_value) / (timestamp - self._last_time)
+        self._last_value, self._last_time = value, timestamp
+        margin = self.hysteresis if self.active else 0.0
+        if self.above is not None and value > self.above - margin:
+            return f'{value:g} is above {self.above:g}'
+        if self.below is not None and value < self.below + margin:
+            return f'{value:g} is below {self.below:g}'
+        if self.rate is not None and rate is not None and (rate > self.rate > 0 or rate < self.rate < 0):
+            return f'changing by {rate:+.3g}/s'
+        return None
+
+
+def default_rules():
+    """
+    The interlocks watched by the panel: the magnet is held if it or the second stage warms up, if it warms quickly,
+    or if its temperature stops being read. VTI pressures outside the set point range are reported.
+    """
+    return [AlarmRule('magnet warm', 'magnet_temperature', above=magnet_temperature_limit, hysteresis=0.2,
+                      action='hold'),
+            AlarmRule('magnet warming', 'magnet_temperature', rate=magnet_warming_limit, action='hold'),
+            AlarmRule('magnet temperature stale', 'magnet_temperature', stale_after=stale_limit, action='hold'),
+            AlarmRule('PT2 warm', 'pt2_temperature', above=pt2_temperature_limit, hysteresis=2, action='hold'),
+            AlarmRule('VTI pressure', 'vti_pressure', above=vti_pressure_high, below=vti_pressure_low, hysteresis=0.5)]
+
+
+class AlarmEngine:
+    """
+    Watches the readings of a Controller against AlarmRule objects as they arrive from the monitor threads. Each
+    reading is looked up by channel and checked against that channel's rules only, with nothing kept but the previous
+    reading, so the cost per reading is constant and the rules can run at the fastest polling rate. A rule that trips
+    is reported (printed, added to `events' and passed to the listeners, which are called as
+    listener(rule, tripped, timestamp)) and its magnet action is put straight into the iPS queue at control priority,
+    ahead of any queued background reads, without waiting for the response. `latency' records the time from
+    detecting each trip to its command being written and `acknowledged' the time to its response.
+    """
+    def __init__(self, controller, rules=None):
+        self.controller = controller
+        self.rules = {}  # channel name -> list of its AlarmRule objects
+        self.events = deque(maxlen=event_history)  # (timestamp, rule name, `tripped' or `cleared', reason)
+        self.latency = Histogram()
+        self.acknowledged = Histogram()
+        self._listeners = []
+        self._lock = Lock()  # guards rule states, which the monitor threads and the stale check both change
+        self._stop = Event()
+        self._thread = None
+        for rule in default_rules() if rules is None else rules:
+            self.add(rule)
+
+    def add(self, rule):
+        """
+        Watches `rule'. A rule with a `stale_after' caps its channel's polling period at 1/`stale_polls' of it, so a
+        steady reading whose polls have backed off (see scheduler.PollChannel) is not taken for a channel gone quiet.
+        """
+        self.rules.setdefault(rule.channel, []).append(rule)
+        channel = self._channel(rule.channel)
+        if rule.stale_after is not None and channel is not None:
+            channel.max_period = min(channel.max_period, rule.stale_after / stale_polls)
+            channel.min_period = min(channel.min_period, channel.max_period)
+            channel.period = min(channel.period, channel.max_period)
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def start(self):
+        now = monotonic()
+        for rules in self.rules.values():
+            for rule in rules:
+                rule._last_seen = now
+        self._stop.clear()
+        self.controller.add_listener(self._on_reading)
+        self._thread = Thread(target=self._watch_stale, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.controller.remove_listener(self._on_reading)
+        self._stop.set()
+
+    def active(self):
+        """
+        Returns the names of the rules that are tripped.
+        """
+        return [rule.name for rules in self.rules.values() for rule in rules if rule.active]
+
+    def stats(self):
+        return {'latency': self.latency.summary(), 'acknowledged': self.acknowledged.summary(), 'active': self.active()}
+
+    def _on_reading(self, name, text, value, timestamp):
+        rules = self.rules.get(name)
+        if rules is None or value is None:  # not watched, or an error or non-numeric reading
+            return
+        detected = monotonic()
+        with self._lock:
+            for rule in rules:
+                rule._last_seen = detected
+                reason = rule._evaluate(value, timestamp)
+                if reason is not None and not rule.active:
+                    self._trip(rule, reason, detected, timestamp)
+                elif reason is None and rule.active:
+                    self._clear(rule, timestamp)
+
+    def _watch_stale(self):
+        """
+        Thread function tripping the rules with a `stale_after' whose channel has not been read for that long while
+        its instrument is connected. The time is counted from when the instrument was found connected, so connecting
+        (or reconnecting) long after the engine started does not trip the rule before the first reading arrives.
+        """
+        while not self._stop.wait(stale_check_interval):
+            now = monotonic()
+            with self._lock:
+                for rules in self.rules.values():
+                    for rule in rules:
+                        if rule.stale_after is None:
+                            continue
+                        port_open = self._port_of(rule.channel).is_open
+                        if port_open and not rule._port_open:  # just connected: start counting from now
+                            rule._last_seen = max(rule._last_seen, now)
+                        rule._port_open = port_open
+                        if not port_open or rule.active or now - rule._last_seen <= rule.stale_after:
+                            continue
+                        self._trip(rule, f'no reading for {now - rule._last_seen:.0f} s', now, time())
+
+    def _port_of(self, channel):
+        return self.controller.itc if channel in self.controller.itc_scheduler.channels else self.controller.ips
+
+    def _channel(self, name):
+        """
+        Returns the PollChannel polling the channel `name' on either instrument, or None.
+        """
+        for scheduler in (self.controller.itc_scheduler, self.controller.ips_scheduler):
+            if name in scheduler.channels:
+                return scheduler.channels[name]
+        return None
+
+    def _trip(self, rule, reason, detected, timestamp):
+        rule.active, rule.reason = True, reason
+        self.events.append((timestamp, rule.name, 'tripped', reason))
+        print(f'Alarm {rule.name}: {rule.channel} {reason}\a')
+        if rule.action in magnet_actions:
+            self._send_magnet_action(magnet_actions[rule.action], detected)
+        elif callable(rule.action):
+            try:
+                rule.action(self, rule)
+            except Exception as error:
+                print(f'Error in action of alarm {rule.name}: {error!r}\a')
+        self._notify(rule, True, timestamp)
+
+    def _clear(self, rule, timestamp):
+        rule.active = False
+        self.events.append((timestamp, rule.name, 'cleared', None))
+        print(f'Alarm {rule.name} cleared')
+        self._notify(rule, False, timestamp)
+
+    def _notify(self, rule, tripped, timestamp):
+        for listener in list(self._listeners):
+            try:
+                listener(rule, tripped, timestamp)
+            except Exception as error:
+                print(f'Error in alarm listener: {error!r}\a')
+
+    def _send_magnet_action(self, action, detected):
+        """
+        Queues SET:<magnet>:ACTN:`action' on the iPS at control priority (whatever the switch heater state, unlike
+        Controller.ramp_hold()) and records its latency once it completes.
+        """
+        port = self.controller.ips
+        if not port.is_open:
+            print(f'iPS not connected: magnet action {action} not sent\a')
+            return
+        message = SerialMessage(f'SET:{uid_magnet}:ACTN:{action}', False, PRIORITY_CONTROL)
+        message.add_done_callback(lambda message: self._record(message, detected))
+        port.cache.invalidate(message.message)
+        port._queue.put(message)
+        self.controller.ips_scheduler.poll_now('magnet_action')
+
+    def _record(self, message, detected):
+        if message.sent is not None:
+            self.latency.add(message.sent - detected)
+            self.acknowledged.add(message.completed - detected)
+        if not message.result(0).endswith(':VALID'):
+            print(f'Magnet action {message.message} failed: {message.result(0)!r}\a')
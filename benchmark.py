@@ -0,0 +1,274 @@
+import sys
+import json
+import time
+import argparse
+import tempfile
+import itertools
+from statistics import mean
+from threading import Thread
+import instrument
+from instrument import SerialPort, SerialMessage, PRIORITY_CONTROL, PRIORITY_BACKGROUND
+from controller import Controller
+
+# Benchmark settings
+default_port = 'sim'  # `sim' starts a MercurySimulator per instrument; otherwise a port name or pyserial URL
+default_count = 50  # round trips measured per scenario
+default_idle = 0.3  # seconds the port is left idle before each `idle-start' command
+default_cpu_window = 2.0  # seconds over which the CPU use of idle and waiting threads is measured
+benchmark_command = 'READ:DEV:GRPZ:PSU:SIG:FLD'
+sweep_settings = ('delay_before_write', 'delay_queue', 'default_timeout')  # instrument globals
+
+
+def _summary(latencies):
+    """
+    Summarises a list of latencies in seconds as mean/percentiles/max in milliseconds.
+    """
+    ordered = sorted(latencies)
+
+    def percentile(fraction):
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1e3
+
+    return {'count': len(ordered), 'mean_ms': mean(ordered) * 1e3, 'p50_ms': percentile(0.5),
+            'p95_ms': percentile(0.95), 'p99_ms': percentile(0.99), 'max_ms': ordered[-1] * 1e3}
+
+
+def _open(port, model='IPS'):
+    """
+    Opens a SerialPort on `port'. For `sim' a MercurySimulator of the given model is started first. Coalescing is
+    turned off, as the benchmarks repeat the same commands and are meant to time the wire.
+
+    :return: tuple of (SerialPort, simulator or None)
+    """
+    simulator = None
+    if port == 'sim':
+        from simulator import MercurySimulator
+        simulator = MercurySimulator(model)
+        port = simulator.start()
+    serialport = SerialPort()
+    serialport.coalesce_window = None
+    if not serialport.open(port):
+        if simulator is not None:
+            simulator.stop()
+        raise RuntimeError(f'Could not open {port}')
+    return serialport, simulator
+
+
+def _close(serialport, simulator):
+    serialport.close()
+    if simulator is not None:
+        simulator.stop()
+
+
+def transmit_latency(port=default_port, count=default_count, idle=default_idle):
+    """
+    Measures transmit() round-trip latency through a SerialPort opened on `port'. Two scenarios are timed: commands
+    sent after the IO thread has been idle for `idle' seconds, and commands sent back-to-back. The back-to-back run
+    also gives the command throughput.
+
+    :return: dictionary mapping scenario name to a latency summary
+    """
+    serialport, simulator = _open(port)
+    results = {}
+    try:
+        for scenario, wait in (('idle_start', idle), ('back_to_back', 0)):
+            latencies = []
+            for _ in range(count):
+                time.sleep(wait)
+                start_time = time.perf_counter()
+                serialport.transmit(benchmark_command, print_response=False)
+                latencies.append(time.perf_counter() - start_time)
+            results[scenario] = _summary(latencies)
+        results['back_to_back']['commands_per_s'] = count / sum(latencies)
+    finally:
+        _close(serialport, simulator)
+    return results
+
+
+def _monitor_commands(model):
+    """
+    Returns the READ commands the Controller monitors on the `ITC' or `IPS', so the benchmarks follow its channels.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        controller = Controller(log_directory=directory)
+        controller.disconnect_all()
+    return [channel.command for channel in getattr(controller, f'_{model.lower()}_channels')]
+
+
+def batch_latency(port=default_port, count=default_count, commands=None):
+    """
+    Compares the time taken to read a group of commands (by default, the iTC monitor reads) with sequential
+    transmit() calls against a single transmit_many() call through a SerialPort opened on `port'.
+
+    :return: dictionary mapping scenario name to a latency summary
+    """
+    if commands is None:
+        commands = _monitor_commands('ITC')
+    serialport, simulator = _open(port, 'ITC')
+    scenarios = {'sequential': lambda: [serialport.transmit(command, print_response=False) for command in commands],
+                 'pipelined': lambda: serialport.transmit_many(commands, print_response=False)}
+    results = {}
+    try:
+        for scenario, function in scenarios.items():
+            latencies = []
+            for _ in range(count):
+                start_time = time.perf_counter()
+                function()
+                latencies.append(time.perf_counter() - start_time)
+            results[scenario] = _summary(latencies)
+            results[scenario]['commands_per_s'] = count * len(commands) / sum(latencies)
+    finally:
+        _close(serialport, simulator)
+    return results
+
+
+def monitor_cycle(port=default_port, count=default_count):
+    """
+    Times full passes of the iTC and iPS monitor loops: Controller._poll() with every channel due, so each pass
+    includes the background batch, parsing, the history, the data log (into a temporary directory) and the listeners.
+    Set points are answered from the cache after the first pass, as in the monitor threads.
+
+    :return: dictionary mapping scenario name to a latency summary
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        controller = Controller(log_directory=directory)
+        try:
+            for name in ('itc', 'ips'):
+                serialport, simulator = _open(port, name.upper())
+                setattr(controller, name, serialport)
+                scheduler = getattr(controller, f'{name}_scheduler')
+                try:
+                    latencies = []
+                    for _ in range(count):
+                        scheduler.poll_now(*scheduler.channels)
+                        start_time = time.perf_counter()
+                        controller._poll(serialport, scheduler)
+                        latencies.append(time.perf_counter() - start_time)
+                    results[f'{name}_monitor_cycle'] = _summary(latencies)
+                finally:
+                    _close(serialport, simulator)
+        finally:
+            controller.disconnect_all()
+    return results
+
+
+def control_latency(port=default_port, count=10, backlog=12, command_delay=0.05):
+    """
+    Measures how long a HOLD command waits when the queue already holds `backlog' background polls. The port is made
+    slow by stretching delay_before_write so that each command takes about `command_delay' seconds.
+    With priority lanes the HOLD should take no more than two command times (the one in flight plus itself),
+    however long the backlog, so `limit_ms' is twice the slowest HOLD sent on the idle port and `within_limit' says
+    whether every HOLD under the backlog kept to it (tests/test_priority.py asserts the same bound).
+
+    :return: dictionary mapping scenario name to a latency summary
+    """
+    serialport, simulator = _open(port)
+    saved_delay = instrument.delay_before_write
+    instrument.delay_before_write = command_delay
+    latencies, idle = [], []
+    try:
+        for _ in range(count):
+            start_time = time.perf_counter()
+            serialport.transmit('SET:DEV:GRPZ:PSU:ACTN:HOLD', print_response=False, priority=PRIORITY_CONTROL)
+            idle.append(time.perf_counter() - start_time)
+        for _ in range(count):
+            polls = [SerialMessage(benchmark_command, False, PRIORITY_BACKGROUND) for _ in range(backlog)]
+            for poll in polls:
+                serialport._queue.put(poll)
+            time.sleep(command_delay / 2)  # let the first poll get in flight
+            start_time = time.perf_counter()
+            serialport.transmit('SET:DEV:GRPZ:PSU:ACTN:HOLD', print_response=False, priority=PRIORITY_CONTROL)
+            latencies.append(time.perf_counter() - start_time)
+            for poll in polls:
+                poll.result()
+    finally:
+        instrument.delay_before_write = saved_delay
+        _close(serialport, simulator)
+    result = _summary(latencies)
+    result['limit_ms'] = 2 * max(idle) * 1e3
+    result['within_limit'] = result['max_ms'] <= result['limit_ms']
+    return {'hold_under_backlog': result}
+
+
+def idle_cpu(port=default_port, window=default_cpu_window, waiters=4):
+    """
+    Measures the CPU time used by the process, as a fraction of one core, while (a) the IO thread sits on an idle
+    port and (b) `waiters' caller threads wait for about `window' seconds on responses held up behind a slow command.
+    Both should be close to zero.
+
+    :return: dictionary mapping scenario name to {'cpu_fraction': ...}
+    """
+    serialport, simulator = _open(port)
+    results = {}
+    saved_delay = instrument.delay_before_write
+    try:
+        start_cpu, start_time = time.process_time(), time.perf_counter()
+        time.sleep(window)
+        results['idle_io_thread'] = {'cpu_fraction': (time.process_time() - start_cpu) /
+                                                     (time.perf_counter() - start_time)}
+        instrument.delay_before_write = window  # hold up the IO thread so everybody queued behind it waits
+        blocker = SerialMessage(benchmark_command, False)
+        serialport._queue.put(blocker)
+        threads = [Thread(target=serialport.transmit, args=(benchmark_command, None, False), daemon=True)
+                   for _ in range(waiters)]
+        start_cpu, start_time = time.process_time(), time.perf_counter()
+        for thread in threads:
+            thread.start()
+        blocker.result()
+        results['waiting_callers'] = {'cpu_fraction': (time.process_time() - start_cpu) /
+                                                      (time.perf_counter() - start_time), 'waiters': waiters}
+        instrument.delay_before_write = saved_delay
+        for thread in threads:
+            thread.join()
+    finally:
+        instrument.delay_before_write = saved_delay
+        _close(serialport, simulator)
+    return results
+
+
+def run(port=default_port, count=default_count, **settings):
+    """
+    Runs every benchmark with the instrument module globals named in `settings' (see sweep_settings) temporarily
+    replaced, restoring them afterwards.
+
+    :return: dictionary of the settings used and the results of each benchmark
+    """
+    saved = {name: getattr(instrument, name) for name in sweep_settings}
+    for name, value in settings.items():
+        setattr(instrument, name, value)
+    try:
+        results = {}
+        for function in (transmit_latency, batch_latency, monitor_cycle):
+            results.update(function(port, count))
+        results.update(control_latency(port))
+        results.update(idle_cpu(port))
+        return {'settings': {name: getattr(instrument, name) for name in sweep_settings}, 'results': results}
+    finally:
+        for name, value in saved.items():
+            setattr(instrument, name, value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Throughput and latency benchmarks for the serial stack. Each '
+                                                 'setting option takes a list of values; every combination is run.')
+    parser.add_argument('--port', default=default_port,
+                        help='port name or pyserial URL (e.g. loop://), or `sim\' for a simulator (default)')
+    parser.add_argument('--count', type=int, default=default_count, help='round trips per scenario')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    for name in sweep_settings:
+        parser.add_argument(f'--{name.replace("_", "-")}', type=float, nargs='+', default=[getattr(instrument, name)])
+    arguments = parser.parse_args(argv)
+    combinations = itertools.product(*(getattr(arguments, name) for name in sweep_settings))
+    report = {'port': arguments.port, 'count': arguments.count, 'time': time.time(),
+              'runs': [run(arguments.port, arguments.count, **dict(zip(sweep_settings, values)))
+                       for values in combinations]}
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import json
+
+# Catalogue settings
+default_catalogue_path = 'catalogue.json'  # where catalogues are kept, by instrument, relative to the working directory
+signal_kinds = {'TEMP': 'temperature', 'PRES': 'pressure'}  # device kinds with a reading that monitoring can log
+
+
+def parse_catalogue(response):
+    """
+    Splits the response to READ:SYS:CAT, e.g. `STAT:SYS:CAT:DEV:MB1.T1:TEMP:DEV:GRPZ:PSU', into device UIDs.
+
+    :return: list of UIDs such as `DEV:MB1.T1:TEMP' (empty if the response is not a catalogue)
+    """
+    fields = response.split(':')
+    if fields[:3] != ['STAT', 'SYS', 'CAT']:
+        return []
+    return [':'.join(fields[index:index + 3]) for index in range(3, len(fields) - 2) if fields[index] == 'DEV']
+
+
+def parse_signals(response):
+    """
+    Returns the signal names in the response to READ:<uid>:SIG, e.g. ['VOLT', 'TEMP'] from
+    `STAT:DEV:MB1.T1:TEMP:SIG:VOLT:0.1V:TEMP:4.2000K'.
+    """
+    fields = response.split(':')
+    if 'SIG' not in fields or response.startswith('?'):
+        return []
+    return fields[fields.index('SIG') + 1::2]
+
+
+class Catalogue:
+    """
+    The devices of one Mercury instrument and the signals of each, read once from READ:SYS:CAT and READ:<uid>:SIG
+    and kept in `path' under the model and serial number, so that later connections to the same instrument load it
+    without asking. has() checks a configured command against it, so channels for boards that are not fitted (or have
+    moved) can be left out instead of failing on every pass. `cached' tells whether it was loaded from `path', and so
+    may be out of date if a board has been moved since (see load()'s `refresh').
+    """
+    def __init__(self, model, serial, devices, cached=False):
+        self.model = model
+        self.serial = serial
+        self.devices = devices  # UID -> list of signal names
+        self.cached = cached
+
+    @classmethod
+    def load(cls, port, model, serial, path=default_catalogue_path, refresh=False):
+        """
+        Returns the catalogue of the instrument on the open SerialPort `port', from `path' if it is known there (and
+        `refresh' is false) or else read from the instrument and saved. Returns None if the instrument did not answer.
+        """
+        key = f'{model}:{serial}'
+        catalogues = cls._read(path)
+        if key in catalogues and not refresh:
+            return cls(model, serial, catalogues[key], True)
+        uids = parse_catalogue(port.transmit('READ:SYS:CAT', f'Error reading {model} catalogue', False))
+        if not uids:
+            return None
+        signals = port.transmit_many([f'READ:{uid}:SIG' for uid in uids], print_response=False)
+        catalogue = cls(model, serial, {uid: parse_signals(response) for uid, response in zip(uids, signals)})
+        if serial:  # without a serial number the catalogue cannot be told apart from another instrument's
+            catalogues[key] = catalogue.devices
+            try:
+                with open(path, 'w') as file:
+                    json.dump(catalogues, file, indent=1)
+            except OSError as error:
+                print(f'Error saving {path}: {error!r}\a')
+        return catalogue
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def has(self, command):
+        """
+        Returns whether the device of a READ or SET `command' is in the catalogue and, for a SIG path, whether the
+        device has that signal (devices whose signals are unknown accept any).
+        """
+        fields = command.split(':')
+        uid = ':'.join(fields[1:4])
+        if uid not in self.devices:
+            return False
+        signals = self.devices[uid]
+        return len(fields) < 6 or fields[4] != 'SIG' or not signals or fields[5] in signals
+
+    def sensors(self):
+        """
+        Returns (UID, signal) for every temperature and pressure reading in the catalogue.
+        """
+        return [(uid, uid.split(':')[-1]) for uid, signals in self.devices.items()
+                if uid.split(':')[-1] in signal_kinds and (not signals or uid.split(':')[-1] in signals)]
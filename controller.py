@@ -0,0 +1,505 @@
+from time import time, sleep, monotonic
+from threading import Thread, Lock, Condition
+from collections import deque
+from instrument import SerialPort, default_comports, default_cache_ttl, PRIORITY_CONTROL, PRIORITY_BACKGROUND, \
+    write_prometheus
+from scheduler import PollChannel, PollScheduler, parse_reading
+from datalogger import DataLogger
+from discovery import idn_prefixes, identify, remember, discover
+from catalogue import Catalogue, signal_kinds
+
+# Settings flags for magnet controller
+SWITCH_ENABLED = 'enabled'
+SWITCH_WARMING = 'warming'
+SWITCH_COOLING = 'cooling'
+SWITCH_DISABLED = 'disabled'
+SWITCH_UNKNOWN = 'unknown'
+FIELD_HOLD = 'hold'
+FIELD_GOTO = 'goto'
+FIELD_ZERO = 'zero'
+FIELD_INACTIVE = 'inactive'
+SETPOINT_ACTIVE = 'active'
+SETPOINT_INACTIVE = 'inactive'
+
+# Settings for updates
+delay_sensor = 3  # longest time between passes of a monitor loop (also the switch heater countdown refresh)
+metrics_interval = 10  # seconds between rewrites of the metrics file, if one is given
+wait_samples = 256  # recent readings kept per channel, so that a waiter woken late still sees every sample
+
+# Polling periods in seconds for each kind of signal as (fastest, slowest), and the change counted as `changing'
+period_temperature, tolerance_temperature = (1, 30), 0.001
+period_pressure, tolerance_pressure = (1, 30), 0.01
+period_field, tolerance_field = (0.5, 30), 0.0001
+period_setpoint = (10, 60)
+period_action = (1, 10)
+ramp_actions = ('RTOS', 'RTOZ')  # magnet actions during which the field is polled at its fastest period
+poll_catalogue_sensors = False  # also monitor (and log) every other temperature and pressure in the catalogues
+
+# iTC and iPS controller settings
+min_temp, max_temp = 0, 300  # minimum and maximum settings for temperature in Kelvin
+min_press, max_press = 2, 20 # minimum and maximum settings for pressure in mB
+max_abs_field = 7  # maximum field in Tesla
+
+# iTC Device UIDs
+uid_probe_temperature = 'DEV:DB8.T1:TEMP'
+uid_vti_temperature = 'DEV:MB1.T1:TEMP'
+uid_vti_pressure = 'DEV:DB5.P1:PRES'
+uid_vti_pressure_set = 'DEV:DB5.P1:TEMP'
+
+# iPS Device UIDs
+uid_pt2_temperature = 'DEV:DB7.T1:TEMP'
+uid_magnet_temperature = 'DEV:MB1.T1:TEMP'
+uid_magnet = 'DEV:GRPZ:PSU'
+
+
+def format_temperature(temperature):
+    """
+    The temperature controller uses four decimal places so this function takes in a number and converts it into a string
+
+    :param temperature: (float) converts an integer/float to a string with four decimal points
+    :return: string of temperature with correct decimal places
+    """
+    if 0 <= temperature:
+        return '{:.4f}'.format(temperature)
+    else:
+        return str(temperature)
+
+
+def format_field(field, zero=0):
+    if field > 0:
+        return '+{:.4f}'.format(field)
+    elif field < 0:
+        return '{:.4f}'.format(field)
+    elif field == 0:
+        if zero == 1:
+            return '+0.0000'
+        elif zero == -1:
+            return '-0.0000'
+        else:
+            return '0.0000'
+    else:
+        return str(field)
+
+
+class Controller:
+    """
+    The GUI-free control core: owns the iTC and iPS serial connections, runs a monitor thread for each, and provides
+    the set point and ramp commands. Front ends (the Tk panel in main.py, scripts, servers) register listeners with
+    add_listener(); each listener is called as listener(name, text, value, timestamp) from the monitor threads for
+    every channel read, where `text' is the displayable last field of the response and `value' its number (or None).
+    Importing this module loads neither tkinter nor, until a port is opened, pyserial; NumPy is only loaded when the
+    first reading is stored in `history'. Given a `metrics_path', the monitor threads write the metrics of both ports
+    there in Prometheus text format every `metrics_interval' seconds. Given a `trace_directory', both ports record
+    their raw traffic in a wiretrace.WireTrace that is dumped there after an error.
+    """
+    def __init__(self, log_directory=None, metrics_path=None, trace_directory=None):
+        self.itc, self.ips = SerialPort(), SerialPort()  # both serial connections
+        if trace_directory is not None:
+            from wiretrace import WireTrace
+            self.itc.trace = WireTrace(dump_directory=trace_directory)
+            self.ips.trace = WireTrace(dump_directory=trace_directory)
+        self._itc_thread, self._ips_thread = None, None  # update thread for each connection
+        self._itc_delay, self._ips_delay = delay_sensor, delay_sensor  # longest wait between updates for each connection
+        self._itc_channels = [  # everything monitored on the iTC, as far as its catalogue allows
+            PollChannel('probe_temperature', f'READ:{uid_probe_temperature}:SIG:TEMP', *period_temperature,
+                        tolerance_temperature, 'Error reading probe temperature'),
+            PollChannel('vti_temperature', f'READ:{uid_vti_temperature}:SIG:TEMP', *period_temperature,
+                        tolerance_temperature, 'Error reading VTI temperature'),
+            PollChannel('vti_pressure', f'READ:{uid_vti_pressure}:SIG:PRES', *period_pressure,
+                        tolerance_pressure, 'Error reading VTI pressure'),
+            PollChannel('vti_temperature_set', f'READ:{uid_vti_temperature}:SIG:TEMP:LOOP:TSET', *period_setpoint,
+                        error_message='Error reading VTI temperature set point', cache_ttl=default_cache_ttl),
+            PollChannel('vti_pressure_set', f'READ:{uid_vti_pressure_set}:LOOP:TSET', *period_setpoint,
+                        error_message='Error reading VTI pressure set point', cache_ttl=default_cache_ttl)]
+        self._ips_channels = [  # everything monitored on the iPS
+            PollChannel('pt2_temperature', f'READ:{uid_pt2_temperature}:SIG:TEMP', *period_temperature,
+                        tolerance_temperature, 'Error reading PT2 temperature'),
+            PollChannel('magnet_temperature', f'READ:{uid_magnet_temperature}:SIG:TEMP', *period_temperature,
+                        tolerance_temperature, 'Error reading magnet temperature'),
+            PollChannel('magnet_field', f'READ:{uid_magnet}:SIG:FLD', *period_field,
+                        tolerance_field, 'Error reading magnetic field'),
+            PollChannel('magnet_field_set', f'READ:{uid_magnet}:SIG:FSET', *period_setpoint,
+                        error_message='Error reading magnetic field set point', cache_ttl=default_cache_ttl),
+            PollChannel('magnet_action', f'READ:{uid_magnet}:ACTN', *period_action,
+                        error_message='Error reading magnet action')]
+        self.itc_scheduler = PollScheduler(self._itc_channels)
+        self.ips_scheduler = PollScheduler(self._ips_channels)
+        self.itc_catalogue, self.ips_catalogue = None, None  # catalogue.Catalogue of each instrument once connected
+        self.switch_status = SWITCH_UNKNOWN  # flag indicating current switch heater status
+        self._switch_action = None  # controls countdown for switch heater on/off
+        self._history = None  # created on first use, see `history'
+        self._history_lock = Lock()
+        self.logger = DataLogger() if log_directory is None else DataLogger(log_directory)
+        self.logger.start()  # writes every numeric reading to disk from its own thread
+        self._listeners = []
+        self.latest = {}  # channel name -> (text, value, timestamp) of its latest reading
+        self.responses = {}  # channel name -> (response as sent by the instrument, timestamp)
+        self._samples = {}  # channel name -> deque of (sample number, text, value, timestamp) for wait_until()
+        self._sample_number = 0
+        self._readings = Condition()  # notified on every reading
+        self.metrics_path = metrics_path
+        self._metrics_written = 0.0
+        self._metrics_lock = Lock()
+
+    @property
+    def history(self):
+        """
+        The History (time series of every numeric reading, by channel name). Created on first use so that NumPy is
+        not imported until it is needed.
+        """
+        with self._history_lock:
+            if self._history is None:
+                from history import History
+                self._history = History()
+            return self._history
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, name, text, value, timestamp):
+        with self._readings:
+            self._sample_number += 1
+            self.latest[name] = (text, value, timestamp)
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=wait_samples)
+            self._samples[name].append((self._sample_number, text, value, timestamp))
+            self._readings.notify_all()
+        for listener in list(self._listeners):
+            try:
+                listener(name, text, value, timestamp)
+            except Exception as error:
+                print(f'Error in listener for {name}: {error!r}\a')
+
+    def wait_until(self, name, target=None, tolerance=0.0, stability_window=0.0, timeout=None, predicate=None,
+                   since=None, cancel=None):
+        """
+        Blocks until the readings of channel `name' taken after `since' (by default, from now on) are within
+        `tolerance' of `target', or satisfy predicate(reading), and have stayed so for `stability_window' seconds.
+        `reading' is the number, or the text for channels that are not numeric (e.g. predicate=lambda action: action
+        == 'HOLD' for `magnet_action'). The readings are those the monitor threads take anyway, so any number of
+        threads can wait at no extra serial traffic, and each waiter is woken as soon as a reading arrives:
+
+            controller.wait_until('magnet_field', 5, tolerance=0.0005, timeout=3600)
+            controller.wait_until('vti_temperature', 10, tolerance=0.005, stability_window=60)
+
+        :return: (reading, timestamp) of the reading that ended the wait, or None if `timeout' seconds passed or
+                 `cancel' (an Event) was set first (see wake_waiters())
+        """
+        if target is None and predicate is None:  # checked here, as the predicate runs holding the readings lock
+            raise ValueError('wait_until() needs a target or a predicate')
+        if predicate is None:
+            predicate = lambda reading: not isinstance(reading, str) and abs(reading - target) <= tolerance
+        since = time() if since is None else since
+        deadline = None if timeout is None else monotonic() + timeout
+        seen, stable_since = 0, None  # the last sample number checked; start time of the run of matching readings
+        with self._readings:
+            while cancel is None or not cancel.is_set():
+                for number, text, value, timestamp in self._samples.get(name, ()):
+                    if number <= seen:
+                        continue
+                    seen = number
+                    if timestamp <= since:
+                        continue
+                    reading = text if value is None else value
+                    if not predicate(reading):
+                        stable_since = None
+                        continue
+                    if stable_since is None:
+                        stable_since = timestamp
+                    if timestamp - stable_since >= stability_window:
+                        return reading, timestamp
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._readings.wait(remaining)
+        return None
+
+    def wake_waiters(self):
+        """
+        Wakes every wait_until() so that those whose `cancel' event has been set return.
+        """
+        with self._readings:
+            self._readings.notify_all()
+
+    def itc_connect(self, port):
+        """
+        Attempts to connect to the Oxford Mercury iTC through `port' (a COM port, or `host:port' for its Ethernet
+        interface) and starts monitoring it.
+
+        :return: None if connected, otherwise a short failure description (`fail' or `non-iTC fail')
+        """
+        self.itc.port = port
+        if self.itc.is_open:  # if the port is somehow open already, close it
+            self.itc.close()
+        if not self.itc.open():  # if open() is false then something has gone wrong
+            return 'fail'
+        inst_name = self.itc.transmit('*IDN?', 'Error receiving iTC identification')
+        if identify(inst_name)[0] != 'ITC':
+            print('Mercury iTC was not located at user-supplied COM port')
+            self.itc.close()
+            return 'non-iTC fail'
+        remember('ITC', port, identify(inst_name)[1])
+        self.itc_catalogue = self._apply_catalogue(self.itc, self.itc_scheduler, self._itc_channels, 'ITC',
+                                                   identify(inst_name)[1])
+        self.itc_scheduler.poll_now(*self.itc_scheduler.channels)
+        self._itc_thread = Thread(target=self._monitor_itc, daemon=True)
+        self._itc_thread.start()
+        return None
+
+    def _apply_catalogue(self, port, scheduler, channels, model, serial):
+        """
+        Loads the catalogue of the instrument just connected through `port' and has `scheduler' poll those of
+        `channels' whose devices and signals it lists, warning about the others (a board that is not fitted or has
+        moved would otherwise fail on every pass). A catalogue loaded from the cache that lacks one of `channels' is
+        read again from the instrument first, in case a board has been moved since it was saved. With
+        `poll_catalogue_sensors' set, every other temperature and pressure in the catalogue is polled as well. If the
+        instrument cannot list its devices, all `channels' are polled.
+
+        :return: the Catalogue, or None
+        """
+        catalogue = Catalogue.load(port, model, serial)
+        if catalogue is not None and catalogue.cached and not all(catalogue.has(channel.command)
+                                                                   for channel in channels):
+            catalogue = Catalogue.load(port, model, serial, refresh=True) or catalogue
+        polled = list(channels)
+        if catalogue is not None:
+            polled = [channel for channel in channels if catalogue.has(channel.command)]
+            for channel in channels:
+                if channel not in polled:
+                    print(f'{channel.command[len("READ:"):]} is not in the {model} catalogue, so {channel.name} '
+                          f'is not monitored\a')
+            if poll_catalogue_sensors:
+                commands = [channel.command for channel in polled]
+                for uid, kind in catalogue.sensors():
+                    if f'READ:{uid}:SIG:{kind}' not in commands:
+                        period, tolerance = {'TEMP': (period_temperature, tolerance_temperature),
+                                             'PRES': (period_pressure, tolerance_pressure)}[kind]
+                        polled.append(PollChannel(f'{model.lower()}_{uid.split(":")[1]}_{signal_kinds[kind]}',
+                                                  f'READ:{uid}:SIG:{kind}', *period, tolerance, f'Error reading {uid}'))
+        for name in list(scheduler.channels):
+            scheduler.remove(name)
+        for channel in polled:
+            scheduler.add(channel)
+        return catalogue
+
+    def find_ports(self, models=('ITC', 'IPS')):
+        """
+        Looks for the Mercury `models' (`ITC'/`IPS') on the serial ports not already open, trying the ports they were
+        last connected through first (see discovery.discover()).
+
+        :return: dictionary mapping each model found to {'port': ..., 'serial': ...}
+        """
+        return discover(models=models, exclude=[port.port for port in (self.itc, self.ips) if port.is_open])
+
+    def itc_disconnect(self):
+        if self.itc.is_open:
+            self.itc.close()
+
+    def ips_connect(self, port):
+        """
+        Attempts to connect to the Oxford Mercury iPS through `port' (a COM port, or `host:port' for its Ethernet
+        interface), reads the switch heater status into
+        `switch_status' and starts monitoring it.
+
+        :return: None if connected, otherwise a short failure description (`fail' or `non-iPS fail')
+        """
+        self.ips.port = port
+        if self.ips.is_open:  # if the port is somehow open already, close it
+            self.ips.close()
+        if not self.ips.open():  # if open() is false then something has gone wrong
+            return 'fail'
+        inst_name = self.ips.transmit('*IDN?', 'Error receiving iPS identification')
+        if identify(inst_name)[0] != 'IPS':
+            print('Mercury iPS was not located at user-supplied COM port')
+            self.ips.close()
+            return 'non-iPS fail'
+        remember('IPS', port, identify(inst_name)[1])
+        self.ips_catalogue = self._apply_catalogue(self.ips, self.ips_scheduler, self._ips_channels, 'IPS',
+                                                   identify(inst_name)[1])
+        switch_status = self.ips.transmit(f'READ:{uid_magnet}:SIG:SWHT').split(':')
+        self.switch_status = SWITCH_UNKNOWN
+        if len(switch_status) > 0:
+            if switch_status[-1] == 'ON':
+                self.switch_status = SWITCH_ENABLED
+            elif switch_status[-1] == 'OFF':
+                self.switch_status = SWITCH_DISABLED
+        self.ips_scheduler.poll_now(*self.ips_scheduler.channels)
+        self._ips_thread = Thread(target=self._monitor_ips, daemon=True)
+        self._ips_thread.start()
+        return None
+
+    def ips_disconnect(self):
+        if self.ips.is_open:
+            # RETURN TO FINISH HERE. SET TO HOLD THEN INTERRUPT ANY ACTION
+            self.ips.close()
+
+    def disconnect_all(self):
+        self.itc.close()
+        self.ips.close()
+        self.logger.stop()
+
+    def _write_metrics(self):
+        if self.metrics_path is None:
+            return
+        with self._metrics_lock:
+            if time() - self._metrics_written < metrics_interval:
+                return
+            self._metrics_written = time()
+            try:
+                write_prometheus(self.metrics_path, (self.itc, self.ips))
+            except OSError as error:
+                print(f'Error writing metrics to {self.metrics_path}: {error!r}\a')
+
+    def _poll(self, port, scheduler, skip=()):
+        """
+        Reads every channel of `scheduler' that is due (apart from those named in `skip', which are deferred) in one
+        background batch, reschedules them, records numeric readings in `history' and `logger' and notifies the
+        listeners. Set point channels are answered from the port's cache while it is fresh.
+
+        :return: dictionary mapping the name of each channel read to its response
+        """
+        channels = scheduler.due()
+        if skip:
+            scheduler.defer([channel for channel in channels if channel.name in skip])
+            channels = [channel for channel in channels if channel.name not in skip]
+        if not channels:
+            return {}
+        responses = port.transmit_many([channel.command for channel in channels],
+                                       [channel.error_message for channel in channels], False,
+                                       priority=PRIORITY_BACKGROUND,
+                                       cache_ttls=[channel.cache_ttl for channel in channels])
+        timestamp = time()
+        for channel, response in zip(channels, responses):
+            scheduler.update(channel, response)
+            self.responses[channel.name] = (response, timestamp)
+            value = parse_reading(response)
+            if value is not None:
+                self.history.record(channel.name, value, timestamp)
+                self.logger.log(channel.name, value, timestamp)
+            self._notify(channel.name, response.split(':')[-1], value, timestamp)
+        self._write_metrics()
+        return {channel.name: response for channel, response in zip(channels, responses)}
+
+    def _monitor_itc(self):
+        """
+        Daemon thread function to read the iTC channels as each falls due in `itc_scheduler' (waiting at most
+        `_itc_delay' seconds between passes). Does not print each message/response to std_out so as to prevent
+        clutter from background monitoring operations.
+        """
+        while self.itc.is_open:
+            self._poll(self.itc, self.itc_scheduler)
+            self.itc_scheduler.wait(self._itc_delay)
+        # after `while' loop breaks
+        return
+
+    def _monitor_ips(self):
+        """
+        Daemon thread function to read the iPS channels as each falls due in `ips_scheduler' (waiting at most
+        `_ips_delay' seconds between passes). The field is polled at its fastest rate while the magnet is ramping.
+        Does not print each message/response to std_out so as to prevent clutter from background monitoring
+        operations.
+        """
+        while self.ips.is_open:
+            # read whichever values are due, leaving the magnet action to the switch heater countdown if one is running
+            responses = self._poll(self.ips, self.ips_scheduler,
+                                   skip=('magnet_action',) if self._switch_action is not None else ())
+            if 'magnet_action' in responses:
+                action = responses['magnet_action'].split(':')[-1]
+                self.ips_scheduler.boost(('magnet_field', 'magnet_action'), action in ramp_actions)
+
+            # show the switch heater countdown in place of the action while one is running
+            if self._switch_action is not None:
+                if isinstance(self._switch_action, float):
+                    delta_time = time() - self._switch_action
+                    if delta_time <= 600:  # if it hasn't yet been ten minutes, show countdown
+                        if self.switch_status == SWITCH_WARMING:
+                            self._notify('magnet_action', f'Engaging {int(600 - delta_time)}', None, time())
+                        elif self.switch_status == SWITCH_COOLING:
+                            self._notify('magnet_action', f'Disengaging {int(600 - delta_time)}', None, time())
+                    else:
+                        self._switch_action = None
+                else:
+                    self._switch_action = time()
+            self.ips_scheduler.wait(self._ips_delay)
+        # after `while' loop breaks
+        return
+
+    def set_vti_temperature(self, new_value):
+        """
+        Sends a new VTI temperature set point in Kelvin. Returns True if it was in range and the iTC accepted it.
+        """
+        if not self.itc.is_open or not min_temp <= new_value <= max_temp:
+            return False
+        response = self.itc.transmit(f'SET:{uid_vti_temperature}:LOOP:TSET:{new_value}', priority=PRIORITY_CONTROL)
+        self.itc_scheduler.poll_now('vti_temperature_set')
+        return response.endswith(':VALID')
+
+    def set_vti_pressure(self, new_value):
+        """
+        Sends a new VTI pressure set point in mB. Returns True if it was in range and the iTC accepted it.
+        """
+        if not self.itc.is_open or not min_press <= new_value <= max_press:
+            return False
+        response = self.itc.transmit(f'SET:{uid_vti_pressure_set}:LOOP:TSET:{new_value}', priority=PRIORITY_CONTROL)
+        self.itc_scheduler.poll_now('vti_pressure_set')
+        return response.endswith(':VALID')
+
+    def set_magnetic_field(self, new_value):
+        """
+        Sends a new field set point in Tesla. Returns True if it was in range and the iPS accepted it.
+        """
+        if not self.ips.is_open or not -max_abs_field <= new_value <= max_abs_field:
+            return False
+        response = self.ips.transmit(f'SET:{uid_magnet}:SIG:FSET:{new_value}', priority=PRIORITY_CONTROL)
+        self.ips_scheduler.poll_now('magnet_field_set')
+        return response.endswith(':VALID')
+
+    def _magnet_action(self, action):
+        """
+        Sends the magnet `action' (RTOS, RTOZ or HOLD) if the iPS is connected and its switch heater is enabled.
+        Returns True if it was sent and the iPS accepted it.
+        """
+        if not self.ips.is_open or not self.switch_status == SWITCH_ENABLED:
+            return False
+        response = self.ips.transmit(f'SET:{uid_magnet}:ACTN:{action}', priority=PRIORITY_CONTROL)
+        self.ips_scheduler.poll_now('magnet_action')
+        return response.endswith(':VALID')
+
+    def ramp_goto_set(self):
+        return self._magnet_action('RTOS')
+
+    def ramp_goto_zero(self):
+        return self._magnet_action('RTOZ')
+
+    def ramp_hold(self):
+        return self._magnet_action('HOLD')
+
+    def toggle_switch_heater(self):
+        pass
+
+
+if __name__ == '__main__':
+    import sys
+    # Headless monitoring: python controller.py [iTC port] [iPS port]; prints every reading until interrupted.
+    # Without ports the instruments are looked for on every serial port.
+    controller = Controller()
+    if len(sys.argv) > 1:
+        ports = sys.argv[1:3]
+    else:
+        found = controller.find_ports()
+        ports = [found.get(model, {}).get('port', default) for model, default in zip(idn_prefixes, default_comports)]
+    controller.add_listener(lambda name, text, value, timestamp: print(f'{timestamp:.3f} {name} {text}'))
+    for connect, port in zip((controller.itc_connect, controller.ips_connect), ports):
+        failure = connect(port)
+        if failure is not None:
+            print(f'{port}: {failure}')
+    try:
+        while controller.itc.is_open or controller.ips.is_open:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    controller.disconnect_all()
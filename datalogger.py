@@ -0,0 +1,219 @@
+import os
+import csv
+import time
+import queue
+import struct
+from datetime import datetime
+from threading import Thread
+
+# Logger settings
+default_directory = 'logs'  # where log files are written, relative to the working directory
+default_flush_interval = 5.0  # seconds between writes of buffered records to disk
+default_max_file_size = 64 * 1024 * 1024  # bytes after which a new file is started (a new file is also started daily)
+default_queue_size = 100000  # readings waiting for the writer thread before new ones are dropped
+file_prefix, file_suffix = 'oxford', '.oxlog'
+file_magic = b'OXLOG1\n'
+
+# Each record is a kind byte, a channel index, a timestamp and a value. A channel record maps an index to a name:
+# its value is the length of the UTF-8 name, which follows the record. Every file defines the channels it uses.
+record = struct.Struct('<BHdd')
+RECORD_SAMPLE = 0
+RECORD_CHANNEL = 1
+
+
+class DataLogger:
+    """
+    Writes channel readings to disk from a dedicated writer thread. log() only puts the reading into a bounded queue,
+    so callers on the serial/monitor threads never wait for the disk; if the queue is full the reading is dropped and
+    counted in `dropped'. The writer batches records and writes them every `flush_interval' seconds to compact binary
+    files (see `record') in `directory', starting a new file each day and whenever a file exceeds `max_file_size'.
+    A file left with a partly-written record by a crash is repaired by recover() before it is appended to.
+    """
+    def __init__(self, directory=default_directory, flush_interval=default_flush_interval,
+                 max_file_size=default_max_file_size, queue_size=default_queue_size):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_file_size = max_file_size
+        self.dropped = 0
+        self.written = 0
+        self.path = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = Thread()
+        self._running = False
+        self._file = None
+        self._day = None
+        self._channels = {}  # channel name -> index within the current file
+
+    def start(self):
+        if not self._running:
+            os.makedirs(self.directory, exist_ok=True)
+            self._running = True
+            self._thread = Thread(target=self._writer_thread, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the writer thread after it has written everything queued so far.
+        """
+        if self._running:
+            self._running = False
+            self._queue.put(None)
+            self._thread.join()
+
+    def log(self, channel, value, timestamp=None):
+        try:
+            self._queue.put_nowait((time.time() if timestamp is None else timestamp, channel, value))
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer_thread(self):
+        buffer = []
+        last_flush = time.monotonic()
+        while True:
+            try:
+                entry = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                entry = ()
+            if entry is None:
+                break
+            if entry:
+                buffer.append(entry)
+            if buffer and time.monotonic() - last_flush >= self.flush_interval:
+                self._write(buffer)
+                buffer, last_flush = [], time.monotonic()
+        while True:  # write whatever was queued before stop()
+            try:
+                entry = self._queue.get(False)
+            except queue.Empty:
+                break
+            if entry is not None:
+                buffer.append(entry)
+        self._write(buffer)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, entries):
+        data = bytearray()
+        for timestamp, channel, value in entries:
+            day = datetime.fromtimestamp(timestamp).strftime('%Y%m%d')
+            if self._file is None or day != self._day or self._file.tell() + len(data) >= self.max_file_size:
+                if data:
+                    self._file.write(data)
+                    data = bytearray()
+                self._rotate(day)
+            index = self._channels.get(channel)
+            if index is None:
+                index = self._channels[channel] = len(self._channels)
+                name = str(channel).encode('utf-8')
+                data += record.pack(RECORD_CHANNEL, index, timestamp, len(name)) + name
+            data += record.pack(RECORD_SAMPLE, index, timestamp, value)
+        if data:
+            self._file.write(data)
+            self._file.flush()
+        self.written += len(entries)
+
+    def _rotate(self, day):
+        """
+        Closes the current file and opens the next one for `day', resuming (after recovery) the latest file of that
+        day if it still has room.
+        """
+        if self._file is not None:
+            self._file.close()
+        self._day = day
+        sequence = 0
+        while os.path.exists(self._filename(day, sequence + 1)):
+            sequence += 1
+        path = self._filename(day, sequence)
+        if os.path.exists(path) and os.path.getsize(path) >= self.max_file_size:
+            path = self._filename(day, sequence + 1)
+        self._channels = {}
+        if os.path.exists(path):
+            names = recover(path)
+            self._channels = {name: index for index, name in names.items()}
+            self._file = open(path, 'ab')
+        else:
+            self._file = open(path, 'wb')
+            self._file.write(file_magic)
+        self.path = path
+
+    def _filename(self, day, sequence):
+        return os.path.join(self.directory, f'{file_prefix}-{day}-{sequence:03d}{file_suffix}')
+
+
+def _parse(data):
+    """
+    Parses the bytes of a log file after the magic line.
+
+    :return: tuple of (channel index -> name, list of (timestamp, index, value), length of the complete records)
+    """
+    names, samples = {}, []
+    offset = 0
+    while offset + record.size <= len(data):
+        kind, index, timestamp, value = record.unpack_from(data, offset)
+        if kind == RECORD_CHANNEL:
+            end = offset + record.size + int(value)
+            if end > len(data):
+                break
+            names[index] = data[offset + record.size:end].decode('utf-8')
+            offset = end
+        elif kind == RECORD_SAMPLE:
+            samples.append((timestamp, index, value))
+            offset += record.size
+        else:  # corrupt data: keep everything before it
+            break
+    return names, samples, offset
+
+
+def recover(path):
+    """
+    Truncates a log file after its last complete record (removing anything half-written by a crash).
+
+    :return: dictionary mapping channel index to name for the channels defined in the file
+    """
+    with open(path, 'r+b') as file:
+        data = file.read()
+        if not data.startswith(file_magic):
+            file.seek(0)
+            file.truncate()
+            file.write(file_magic)
+            return {}
+        names, _, length = _parse(data[len(file_magic):])
+        if len(file_magic) + length < len(data):
+            print(f'Recovered log file {path}: discarded {len(data) - len(file_magic) - length} trailing bytes')
+            file.truncate(len(file_magic) + length)
+    return names
+
+
+def read_log(path):
+    """
+    Reads a log file (ignoring any partial record at its end).
+
+    :return: list of (timestamp, channel name, value) tuples in the order they were logged
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(file_magic):
+        raise ValueError(f'{path} is not a log file')
+    names, samples, _ = _parse(data[len(file_magic):])
+    return [(timestamp, names.get(index, str(index)), value) for timestamp, index, value in samples]
+
+
+def export_csv(paths, csv_path):
+    """
+    Writes the readings of one or more log files to a CSV file with a row per reading.
+    """
+    with open(csv_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['timestamp', 'time', 'channel', 'value'])
+        for path in paths:
+            for timestamp, channel, value in read_log(path):
+                writer.writerow([f'{timestamp:.3f}', datetime.fromtimestamp(timestamp).isoformat(), channel, value])
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 3:
+        print(f'Usage: python datalogger.py output.csv logfile{file_suffix} [logfile{file_suffix} ...]')
+    else:
+        export_csv(sys.argv[2:], sys.argv[1])
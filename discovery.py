@@ -0,0 +1,133 @@
+import json
+import time
+from instrument import make_transport
+
+# Discovery settings
+default_cache_path = 'comports.json'  # where the ports found are remembered, relative to the working directory
+probe_timeout = 0.3  # seconds a port is given to answer *IDN? while probing
+idn_prefixes = {'ITC': 'IDN:OXFORD INSTRUMENTS:MERCURY ITC',
+                'IPS': 'IDN:OXFORD INSTRUMENTS:MERCURY IPS'}  # how each model's *IDN? response starts
+
+
+def identify(response):
+    """
+    Identifies a Mercury instrument from its *IDN? response, e.g. `IDN:OXFORD INSTRUMENTS:MERCURY IPS:123456:2.6.04'.
+
+    :return: tuple of (model, serial number): `ITC' or `IPS' (None if neither) and the serial number (or '')
+    """
+    for model, prefix in idn_prefixes.items():
+        if response.startswith(prefix):
+            fields = response.split(':')
+            return model, fields[3] if len(fields) > 3 else ''
+    return None, ''
+
+
+def probe(portname, timeout=probe_timeout):
+    """
+    Sends *IDN? to `portname' on a transport of its own and waits up to `timeout' seconds for the answer.
+
+    :return: the response line, or '' if the port could not be opened or did not answer
+    """
+    try:
+        transport = make_transport(portname)
+        transport.timeout = min(transport.timeout, timeout)
+        transport.open()
+    except (ValueError, OSError):
+        return ''
+    received = b''
+    try:
+        transport.write(b'*IDN?\n')
+        deadline = time.monotonic() + timeout
+        while b'\n' not in received and time.monotonic() < deadline:
+            received += transport.read(max(transport.in_waiting, 1))
+    except (ValueError, OSError):
+        pass
+    finally:
+        try:
+            transport.close()
+        except OSError:
+            pass
+    return received.split(b'\n')[0].decode('utf-8', 'replace').strip('\r')
+
+
+def list_comports():
+    """
+    Returns the device names of every serial port on this computer.
+    """
+    from instrument import _import_serial
+    _import_serial()
+    from serial.tools import list_ports
+    return [port.device for port in list_ports.comports()]
+
+
+def load_cache(path=default_cache_path):
+    """
+    :return: dictionary mapping model (`ITC'/`IPS') to {'port': ..., 'serial': ...} as last found; empty if none
+    """
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def remember(model, portname, serial, path=default_cache_path):
+    """
+    Records in the cache that the `model' instrument with serial number `serial' was found on `portname'.
+    """
+    cache = load_cache(path)
+    if cache.get(model) == {'port': portname, 'serial': serial}:
+        return
+    cache[model] = {'port': portname, 'serial': serial}
+    try:
+        with open(path, 'w') as file:
+            json.dump(cache, file, indent=1)
+    except OSError as error:
+        print(f'Error saving {path}: {error!r}\a')
+
+
+def discover(ports=None, models=('ITC', 'IPS'), exclude=(), path=default_cache_path, timeout=probe_timeout):
+    """
+    Finds the ports of the given Mercury models. The ports in the cache are probed first, all at once, so that a
+    setup that has not changed is found within one probe; only if a model is still missing are the remaining
+    `ports' (by default every serial port on the computer) probed, again concurrently. Ports in `exclude' (those
+    already open, say) are never probed. Whatever is found is remembered in the cache.
+
+    :return: dictionary mapping each model found to {'port': ..., 'serial': ...}
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    cache = load_cache(path)
+    found = {}
+
+    def probe_all(portnames):
+        with ThreadPoolExecutor(max_workers=max(len(portnames), 1)) as executor:
+            for portname, response in zip(portnames, executor.map(lambda name: probe(name, timeout), portnames)):
+                model, serial = identify(response)
+                if model in models and model not in found:
+                    found[model] = {'port': portname, 'serial': serial}
+
+    cached = list(dict.fromkeys(cache[model]['port'] for model in models if model in cache))
+    probe_all([portname for portname in cached if portname not in exclude])
+    if len(found) < len(models):
+        if ports is None:
+            try:
+                ports = list_comports()
+            except ImportError:
+                ports = []
+        probe_all([portname for portname in ports if portname not in cached and portname not in exclude])
+    for model, entry in found.items():
+        remember(model, entry['port'], entry['serial'], path)
+    return found
+
+
+def cached_port(model, default=None, path=default_cache_path):
+    """
+    Returns the port on which `model' was last found (without probing), or `default'.
+    """
+    return load_cache(path).get(model, {}).get('port', default)
+
+
+if __name__ == '__main__':
+    import sys
+    for model, entry in sorted(discover(sys.argv[1:] or None).items()):
+        print(f'Mercury {model} (serial {entry["serial"] or "unknown"}) on {entry["port"]}')
@@ -1,22 +1,16 @@
 import tkinter as tk
 from tkinter import simpledialog
+from threading import Lock
+from controller import SWITCH_ENABLED, SWITCH_WARMING, SWITCH_COOLING, SWITCH_DISABLED, SWITCH_UNKNOWN
 
-# Settings flags for magnet controller
-SWITCH_ENABLED = 'enabled'
-SWITCH_WARMING = 'warming'
-SWITCH_COOLING = 'cooling'
-SWITCH_DISABLED = 'disabled'
-SWITCH_UNKNOWN = 'unknown'
-FIELD_HOLD = 'hold'
-FIELD_GOTO = 'goto'
-FIELD_ZERO = 'zero'
-FIELD_INACTIVE = 'inactive'
-SETPOINT_ACTIVE = 'active'
-SETPOINT_INACTIVE = 'inactive'
+# Settings for display updates
+max_frame_rate = 20  # most times per second that values posted from other threads are applied to the widgets
 
 
 class GUI(tk.Frame):
-    def __init__(self, master=tk.Tk()):
+    def __init__(self, master=None):
+        if master is None:  # create the Tk interpreter only when a panel is actually made
+            master = tk.Tk()
         super().__init__(master)
         master.title('Transue Group Oxford Control Panel')
         master.resizable(False, False)
@@ -38,6 +32,13 @@ class GUI(tk.Frame):
         self.func_set_field = None
         self.func_set_pressure = None
 
+        # Latest values posted from other threads, applied by _flush_posted() on the Tk thread
+        self._posted = {}  # entry box -> latest text posted
+        self._posted_lock = Lock()
+        self._shown = {}  # entry box -> text currently displayed
+        self._calls = []  # (function, args, kwargs) posted with post_call(), in order
+        self.after(int(1000 / max_frame_rate), self._flush_posted)
+
         # Make container frames
         self.frm_contents = tk.Frame(self)
         self.frm_contents.pack()
@@ -157,6 +158,10 @@ class GUI(tk.Frame):
         self.lbl_switch_heater = tk.Label(self.frm_ips, text='Current Switch Heater Status: Unknown')
         self.lbl_switch_heater.grid(row=7, column=1, pady=1)
 
+        # Make trend frame (filled by the application, see trends.TrendPanel)
+        self.frm_trends = tk.Frame(self.frm_contents)
+        self.frm_trends.grid(row=2, column=0, columnspan=2, padx=3, pady=1)
+
     def set_functions(self, serial_itc_connect=None, serial_ips_connect=None,
                       serial_itc_disconnect=None, serial_ips_disconnect=None,
                       set_temperature=None, get_temperature=None,
@@ -181,11 +186,48 @@ class GUI(tk.Frame):
         self.master.protocol('WM_DELETE_WINDOW', command)
 
     def update_ent(self, entry_box:tk.Entry, new_text):
+        """
+        Replaces the text of `entry_box'. Must be called from the Tk thread; other threads should use post().
+        """
         state = entry_box['state']
         entry_box['state'] = 'normal'
         entry_box.delete(0, tk.END)
         entry_box.insert(tk.END, str(new_text))
         entry_box['state'] = state
+        self._shown[entry_box] = str(new_text)
+
+    def post(self, entry_box:tk.Entry, new_text):
+        """
+        Thread-safe update of `entry_box'. Only the latest text posted for each box is kept, and it is applied from
+        the Tk thread at most `max_frame_rate' times per second, skipping boxes whose text has not changed. Makes no
+        Tcl calls, so it is safe to call from the monitor threads.
+        """
+        with self._posted_lock:
+            self._posted[entry_box] = str(new_text)
+
+    def post_call(self, function, *args, **kwargs):
+        """
+        Thread-safe request for function(*args, **kwargs) to be called from the Tk thread, e.g. to change the state of
+        the widgets once a background task ends. Calls are made in the order posted, after the posted entry updates.
+        """
+        with self._posted_lock:
+            self._calls.append((function, args, kwargs))
+
+    def _flush_posted(self):
+        with self._posted_lock:
+            posted, self._posted = self._posted, {}
+            calls, self._calls = self._calls, []
+        try:
+            for entry_box, new_text in posted.items():
+                if self._shown.get(entry_box) != new_text:
+                    self.update_ent(entry_box, new_text)
+            for function, args, kwargs in calls:
+                try:
+                    function(*args, **kwargs)
+                except Exception as error:  # one failing call must not drop the others
+                    print(f'Error in {getattr(function, "__name__", function)}: {error!r}\a')
+        finally:  # keep flushing whatever goes wrong, or the display stops updating for good
+            self.after(int(1000 / max_frame_rate), self._flush_posted)
 
     def set_itc_frame(self, connected):
         if connected:
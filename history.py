@@ -0,0 +1,185 @@
+import time
+import numpy as np
+from threading import Lock
+
+# History settings
+default_capacity = 3600  # full-resolution samples kept per channel (an hour at 1 Hz)
+default_tiers = ((10, 8640), (60, 10080))  # downsampled tiers as (bin width in seconds, bins kept): a day and a week
+
+
+class RingBuffer:
+    """
+    A preallocated float64 ring buffer of `capacity' rows of `columns' values. Appending is O(1) and never allocates;
+    once full, each new row overwrites the oldest. Rows are assumed to be appended in time order (column 0).
+    """
+    def __init__(self, capacity, columns):
+        self.capacity = capacity
+        self._data = np.full((capacity, columns), np.nan)
+        self._head = 0  # index the next row is written to
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+    def append(self, row):
+        self._data[self._head] = row
+        self._head = (self._head + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def rows(self):
+        """
+        Returns a copy of the stored rows, oldest first.
+        """
+        if self._count < self.capacity:
+            return self._data[:self._count].copy()
+        return np.concatenate((self._data[self._head:], self._data[:self._head]))
+
+    def since(self, start_time):
+        """
+        Returns a copy of the rows whose first column is at least `start_time', oldest first.
+        """
+        rows = self.rows()
+        return rows[np.searchsorted(rows[:, 0], start_time):]
+
+    def first_time(self):
+        if self._count == 0:
+            return np.nan
+        return self._data[self._head if self._count == self.capacity else 0, 0]
+
+
+class _Tier:
+    """
+    A downsampled copy of a channel: samples are grouped into bins `width' seconds wide and each completed bin is
+    stored as a row of (bin start time, min, max, mean).
+    """
+    def __init__(self, width, capacity):
+        self.width = width
+        self.buffer = RingBuffer(capacity, 4)
+        self._bin = None  # start time of the bin being accumulated
+        self._min = self._max = self._sum = 0.0
+        self._count = 0
+
+    def add(self, timestamp, value):
+        start = timestamp - timestamp % self.width
+        if start != self._bin:
+            if self._count:
+                self.buffer.append((self._bin, self._min, self._max, self._sum / self._count))
+            self._bin, self._min, self._max, self._sum, self._count = start, value, value, 0.0, 0
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+        self._sum += value
+        self._count += 1
+
+
+class ChannelHistory:
+    """
+    The stored readings of one channel: the most recent `capacity' samples at full resolution, plus downsampled
+    tiers (see default_tiers) that cover longer spans in bounded memory. Queries for a span that has already left the
+    full-resolution buffer fall back to the finest tier that still covers it, using the bin means.
+    """
+    def __init__(self, capacity=default_capacity, tiers=default_tiers):
+        self.raw = RingBuffer(capacity, 2)
+        self.tiers = [_Tier(width, bins) for width, bins in tiers]
+        self.last_time, self.last_value = np.nan, np.nan
+        self._lock = Lock()
+
+    @property
+    def nbytes(self):
+        return self.raw.nbytes + sum(tier.buffer.nbytes for tier in self.tiers)
+
+    def append(self, timestamp, value):
+        with self._lock:
+            self.raw.append((timestamp, value))
+            for tier in self.tiers:
+                tier.add(timestamp, value)
+            self.last_time, self.last_value = timestamp, value
+
+    def _source(self, start_time):
+        """
+        Returns the finest tier that reaches back to `start_time' (the coarsest if none does), or None if the
+        full-resolution buffer still does.
+        """
+        if len(self.raw) < self.raw.capacity or self.raw.first_time() <= start_time or not self.tiers:
+            return None
+        for tier in self.tiers:
+            if len(tier.buffer) < tier.buffer.capacity or tier.buffer.first_time() <= start_time:
+                return tier
+        return self.tiers[-1]
+
+    def last(self, seconds, now=None):
+        """
+        Returns (times, values) arrays of the readings from the last `seconds' seconds, oldest first.
+        """
+        start_time = (time.time() if now is None else now) - seconds
+        with self._lock:
+            tier = self._source(start_time)
+            if tier is None:
+                rows = self.raw.since(start_time)
+                return rows[:, 0], rows[:, 1]
+            rows = tier.buffer.since(start_time - tier.width)
+        return rows[:, 0] + tier.width / 2, rows[:, 3]  # bin centres and means
+
+    def envelope(self, seconds, now=None):
+        """
+        Returns (times, minima, maxima) arrays covering the last `seconds' seconds, taken from the same source as
+        last() (for raw readings minima == maxima). Used for plotting long spans without losing spikes.
+        """
+        start_time = (time.time() if now is None else now) - seconds
+        with self._lock:
+            tier = self._source(start_time)
+            if tier is None:
+                rows = self.raw.since(start_time)
+                return rows[:, 0], rows[:, 1], rows[:, 1]
+            rows = tier.buffer.since(start_time - tier.width)
+        return rows[:, 0] + tier.width / 2, rows[:, 1], rows[:, 2]
+
+    def stats(self, seconds, now=None):
+        """
+        Summarises the last `seconds' seconds of readings.
+
+        :return: dictionary of count, min, max, mean and slope (units per second, least squares); NaN if empty
+        """
+        times, values = self.last(seconds, now)
+        if len(values) == 0:
+            return {'count': 0, 'min': np.nan, 'max': np.nan, 'mean': np.nan, 'slope': np.nan}
+        slope = np.nan
+        if len(values) > 1:
+            centred = times - times.mean()
+            denominator = np.dot(centred, centred)
+            if denominator > 0:
+                slope = float(np.dot(centred, values - values.mean()) / denominator)
+        return {'count': len(values), 'min': float(values.min()), 'max': float(values.max()),
+                'mean': float(values.mean()), 'slope': slope}
+
+
+class History:
+    """
+    The in-memory time series of every monitored channel, created on first use of each channel name. Safe to feed
+    from the monitor threads while other threads query it.
+    """
+    def __init__(self, capacity=default_capacity, tiers=default_tiers):
+        self.capacity = capacity
+        self.tiers = tiers
+        self.channels = {}
+        self._lock = Lock()
+
+    def __getitem__(self, name):
+        return self.channel(name)
+
+    def channel(self, name):
+        with self._lock:
+            if name not in self.channels:
+                self.channels[name] = ChannelHistory(self.capacity, self.tiers)
+            return self.channels[name]
+
+    def record(self, name, value, timestamp=None):
+        self.channel(name).append(time.time() if timestamp is None else timestamp, value)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(channel.nbytes for channel in self.channels.values())
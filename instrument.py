@@ -1,137 +1,758 @@
+import os
 import time
-import serial
 import queue
-from threading import Thread
+import socket
+from bisect import bisect_left
+from collections import deque
+from threading import Thread, Event, Lock, Condition
 from sys import exc_info
 
 # Delays used to help communication
 delay_before_write = 0.005  # time to wait before sending a command
-delay_before_read = 0.005  # time to wait before reading response
-delay_queue = 0.1  # how periodically (in seconds) the queue is checked for messages
+delay_queue = 0.1  # how long (in seconds) an idle IO thread blocks before re-checking that its port is still open
 default_comports = ('COM6', 'COM7')  # iTC first, iPS second
 default_baudrate = 115200
 default_timeout = 0.25
-default_stopbits = serial.STOPBITS_TWO
-default_bytesize = serial.EIGHTBITS
-default_parity = serial.PARITY_NONE
+default_stopbits = 2  # serial.STOPBITS_TWO
+default_bytesize = 8  # serial.EIGHTBITS
+default_parity = 'N'  # serial.PARITY_NONE
+default_tcp_port = 7020  # port of the SCPI interface of a Mercury instrument's Ethernet connection
+tcp_connect_timeout = 3  # seconds allowed for (re)connecting to an Ethernet instrument
+tcp_keepalive = (10, 5, 3)  # TCP keepalive (idle seconds, seconds between probes, failed probes) for Ethernet
+serial = None  # pyserial, imported by _import_serial() when a port is first opened so that importing this is fast
+
+# Queue priorities, highest first: each lane is emptied before the next is served
+PRIORITY_CONTROL = 0  # SET/ramp commands that must preempt everything else (e.g. HOLD)
+PRIORITY_INTERACTIVE = 1  # one-off reads requested by the user
+PRIORITY_BACKGROUND = 2  # periodic monitoring polls
+max_background_depth = 16  # background entries allowed in the queue before the oldest is dropped
+max_background_age = 10  # seconds after which a queued background poll is stale and dropped unsent
+
+# Response cache settings
+default_cache_ttl = 120  # seconds a cached set point is trusted before it is re-read (catches front-panel changes)
+
+# Coalescing settings
+default_coalesce_window = 0.05  # seconds after its response that a read may still be shared (None: never coalesce)
+
+# Metrics settings
+latency_buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)  # histogram bounds in seconds
+
+
+def _import_serial():
+    global serial
+    if serial is None:
+        import serial as pyserial
+        serial = pyserial
+    return serial
+
+
+def response_prefix(command):
+    """
+    Returns how the Mercury response to `command' starts, as the instrument echoes the command: `STAT:<path>' for
+    `READ:<path>', `STAT:SET:<path>' for `SET:<path>:<value>' and `IDN' for `*IDN?'. Returns None for other commands.
+    """
+    command = command.strip()
+    if command.startswith('READ:'):
+        return 'STAT:' + command[len('READ:'):]
+    if command.startswith('SET:'):
+        return 'STAT:' + command.rsplit(':', 1)[0]
+    if command == '*IDN?':
+        return 'IDN'
+    return None
+
+
+def single_value(command):
+    """
+    Tells whether `command' reads one value of a device, such as `READ:DEV:MB1.T1:TEMP:SIG:TEMP' or
+    `READ:DEV:GRPZ:PSU:ACTN', so that its response is its response_prefix() followed by a single field. Reads of a
+    whole device, of a device's signals (ending in `SIG') or of the system answer with several fields.
+    """
+    fields = command.strip().split(':')
+    return fields[:2] == ['READ', 'DEV'] and len(fields) > 4 and fields[-1] not in ('SIG', 'LOOP')
+
+
+def answers(line, command):
+    """
+    Tells whether the response `line' answers `command'. The line must start with the command's response_prefix()
+    (any line answers a command without one) and, for a read of one value (see single_value()), hold just one field
+    more, so that the set point `STAT:DEV:MB1.T1:TEMP:SIG:TEMP:LOOP:TSET:9.0000K' does not answer
+    `READ:DEV:MB1.T1:TEMP:SIG:TEMP'. A line repeating the command verbatim, as a loopback such as pyserial's
+    `loop://' sends, answers it too.
+    """
+    command = command.strip()
+    if line == command:
+        return True
+    prefix = response_prefix(command)
+    if prefix is None:
+        return True
+    if single_value(command):
+        return line.rsplit(':', 1)[0] == prefix
+    return line == prefix or line.startswith(prefix + ':')
+
+
+def parse_tcp_address(portname):
+    """
+    Recognises the name of an Ethernet instrument: `tcp://host', `tcp://host:port' or `host:port'.
+
+    :return: (host, port) tuple, or None if `portname' names a serial port (or another pyserial URL)
+    """
+    if portname.startswith('tcp://'):
+        host, _, port = portname[len('tcp://'):].rstrip('/').partition(':')
+        return host, int(port) if port else default_tcp_port
+    if '://' not in portname and ':' in portname:
+        host, _, port = portname.rpartition(':')
+        if host and port.isdigit():
+            return host, int(port)
+    return None
+
+
+def make_transport(portname):
+    """
+    Creates the (unopened) transport for `portname': a SocketTransport for an Ethernet instrument (see
+    parse_tcp_address()), a wiretrace.ReplayTransport for `replay://trace-file' (optionally followed by `?speed=N'),
+    otherwise a pyserial port configured with the default serial settings. A pyserial URL such as `loop://' may be
+    given instead of a COM port name (used for benchmarking). Every transport has the open(),
+    close(), write() and read() methods and the `in_waiting', `is_open', `port' and `timeout' attributes of a
+    pyserial port, which is all that SerialPort uses.
+    """
+    address = parse_tcp_address(portname)
+    if address is not None:
+        return SocketTransport(*address)
+    if portname.startswith('replay://'):
+        from wiretrace import ReplayTransport
+        path, _, speed = portname[len('replay://'):].partition('?speed=')
+        transport = ReplayTransport(path, float(speed) if speed else 1.0)
+        transport.timeout = default_timeout
+        return transport
+    _import_serial()
+    if '://' in portname:
+        transport = serial.serial_for_url(portname, do_not_open=True)
+    else:
+        transport = serial.Serial()
+        transport.port = portname
+    transport.baudrate = default_baudrate
+    transport.timeout = default_timeout
+    transport.stopbits = default_stopbits
+    transport.bytesize = default_bytesize
+    transport.parity = default_parity
+    return transport
+
+
+class SocketTransport:
+    """
+    The Ethernet interface of a Mercury instrument, which accepts the same SCPI commands and newline-terminated
+    responses as its serial port, over one persistent TCP connection to `host':`tcp_port'. It behaves like a pyserial
+    port (see make_transport()): read() returns up to `size' bytes, waiting at most `timeout' for any to arrive.
+    TCP keepalive notices a silently dead connection, and a write or read that finds the connection dropped
+    reconnects, so an instrument restart or network blip costs the command in flight (which transmit() retries)
+    rather than the connection. Errors are raised as OSError, and operations on a closed transport as ValueError.
+    """
+    def __init__(self, host, tcp_port=default_tcp_port):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.port = f'tcp://{host}:{tcp_port}'
+        self.timeout = default_timeout
+        self.is_open = False
+        self.reconnects = 0
+        self._socket = None
+        self._buffer = b''
+
+    def open(self):
+        self._connect()
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+        self._disconnect()
+
+    def _connect(self):
+        self._disconnect()
+        connection = socket.create_connection((self.host, self.tcp_port), tcp_connect_timeout)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # commands are tiny: send them at once
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in zip(('TCP_KEEPIDLE', 'TCP_KEEPINTVL', 'TCP_KEEPCNT'), tcp_keepalive):
+            if hasattr(socket, option):  # not every platform allows the keepalive timing to be set
+                connection.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        self._socket = connection
+
+    def _disconnect(self):
+        self._buffer = b''
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+    def _reconnect(self):
+        self.reconnects += 1
+        self._connect()
+
+    def write(self, data):
+        if not self.is_open:
+            raise ValueError('Attempting to use a port that is not open')
+        if self._socket is None:
+            self._reconnect()
+        try:
+            self._socket.settimeout(tcp_connect_timeout)
+            self._socket.sendall(data)
+        except OSError:  # dropped since the last command: reconnect and send once more
+            self._reconnect()
+            self._socket.sendall(data)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise ValueError('Attempting to use a port that is not open')
+        if self._socket is None:
+            self._reconnect()
+        if not self._buffer:
+            self._socket.settimeout(self.timeout)
+            try:
+                data = self._socket.recv(4096)
+            except socket.timeout:
+                return b''
+            except OSError:
+                data = b''
+            if not data:  # closed by the instrument: reconnect ready for the next command
+                self._reconnect()
+                return b''
+            self._buffer = data
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
 
 
 class SerialMessage:
     """
     A message to be submitted into the queue of an open serial port. Initializing the object creates a message to be
-    sent. The `print_response' flag dictates whether to print the message and response to std_out. The response()
-    method waits for a response from the instrument: a (default) timeout == 0 waits up to 60 s, and a timeout != 0
-    specifies a maximum time in seconds to wait for a response.
+    sent. The `print_response' flag dictates whether to print the message and response to std_out. Completion is
+    signalled through an Event, so waiting threads sleep until the IO thread delivers the response instead of polling:
+    done() reports whether a response has arrived, result(timeout) blocks for up to `timeout' seconds (None waits
+    forever) and add_done_callback(fn) arranges for fn(message) to be called once the response is set. The response()
+    method is kept for existing callers: a (default) timeout == 0 waits up to 60 s, and a timeout != 0 specifies a
+    maximum time in seconds to wait for a response. `priority' selects the CommandQueue lane; a message that the queue
+    discards unsent (stale or over-depth background polls) is completed with an empty response and `dropped' set.
     """
-    def __init__(self, message, print_response=True):
+    def __init__(self, message, print_response=True, priority=PRIORITY_INTERACTIVE):
         self.message = message
         self.print_response = print_response
+        self.priority = priority
+        self.dropped = False
+        self.created = time.monotonic()
+        self.sent = None  # monotonic time the IO thread wrote the command
+        self.completed = None  # monotonic time the response was set
         self._response = None
+        self._event = Event()
+        self._lock = Lock()  # guards the callback list against a response arriving while a callback is added
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        self._event.wait(timeout)
+        return self._response
 
     def response(self, timeout=0):
         if not timeout:
             timeout = 60
-        start_time = time.time()
-        while time.time() - start_time <= timeout:  # allow up to `timeout' seconds for a response
-            if self._response is not None:
-                break
-            time.sleep(0.01)  # don't hog the computer
-        return self._response
+        return self.result(timeout)
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)  # already complete, so call straight away
+
+    def _drop(self):
+        self.dropped = True
+        self._set_response('')
+
+    def _set_response(self, response):
+        """
+        Stores the response, wakes any waiting threads and runs the registered callbacks. Called by the IO thread.
+        """
+        with self._lock:
+            self._response = response
+            self.completed = time.monotonic()
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                print(f'Error in response callback for {self.message}: {exc_info()[0]}\a')
+
+
+class SerialBatch:
+    """
+    A group of SerialMessage objects to be sent as a single entry in the queue of an open serial port. The IO thread
+    writes every command back-to-back and then reads the responses in the same order, so the group costs roughly one
+    round trip plus wire time instead of one full round trip per command. Each message is completed individually.
+    The batch is queued in the lane given by `priority'.
+    """
+    def __init__(self, messages, priority=PRIORITY_INTERACTIVE):
+        self.messages = list(messages)
+        self.priority = priority
+
+    def _drop(self):
+        for serialmessage in self.messages:
+            serialmessage.dropped = True
+            serialmessage._set_response('')
+
+
+class CommandQueue:
+    """
+    A thread-safe queue with one FIFO lane per priority, used in place of queue.Queue by SerialPort. get() always
+    returns the oldest entry of the highest-priority non-empty lane, so a control command waits for at most the one
+    command already in flight, however many polls are queued. The background lane is bounded: putting an entry into a
+    full lane drops its oldest entry, and background entries that have waited longer than `max_background_age' are
+    dropped when reached rather than sent. Dropped entries are completed with an empty response.
+    """
+    def __init__(self, max_depth=max_background_depth, max_age=max_background_age):
+        self.max_depth = max_depth
+        self.max_age = max_age
+        self.dropped = 0  # count of background entries discarded unsent
+        self.high_water = 0  # most entries ever waiting at once
+        self._lanes = tuple(deque() for _ in range(PRIORITY_BACKGROUND + 1))
+        self._condition = Condition()
+
+    def qsize(self):
+        with self._condition:
+            return sum(len(lane) for lane in self._lanes)
+
+    def put(self, entry, priority=None):
+        """
+        Adds `entry' to the lane given by `priority', or by the entry's own priority attribute if `priority' is None.
+        """
+        if priority is None:
+            priority = getattr(entry, 'priority', PRIORITY_INTERACTIVE)
+        dropped = None
+        with self._condition:
+            lane = self._lanes[priority]
+            if priority == PRIORITY_BACKGROUND and len(lane) >= self.max_depth:
+                dropped = lane.popleft()[1]
+                self.dropped += 1
+            lane.append((time.monotonic(), entry))
+            depth = sum(len(lane) for lane in self._lanes)
+            if depth > self.high_water:
+                self.high_water = depth
+            self._condition.notify()
+        if dropped is not None:
+            dropped._drop()
+
+    def get(self, block=True, timeout=None):
+        """
+        Removes and returns the next entry. Raises queue.Empty if nothing arrives within `timeout' seconds (or at once
+        if `block' is False), mirroring queue.Queue.get().
+        """
+        stale = []
+        try:
+            with self._condition:
+                if block and not self._condition.wait_for(self._has_entries, timeout):
+                    raise queue.Empty
+                self._discard_stale(stale)
+                for lane in self._lanes:
+                    if lane:
+                        return lane.popleft()[1]
+                raise queue.Empty
+        finally:
+            for entry in stale:
+                entry._drop()
+
+    def _has_entries(self):
+        return any(self._lanes)
+
+    def _discard_stale(self, stale):
+        lane = self._lanes[PRIORITY_BACKGROUND]
+        oldest = time.monotonic() - self.max_age
+        while lane and lane[0][0] < oldest:
+            stale.append(lane.popleft()[1])
+            self.dropped += 1
+
+
+class ResponseCache:
+    """
+    A per-instrument cache of READ responses for set points and other slowly-changing parameters. Reads opt in by
+    passing a time-to-live to SerialPort.transmit()/transmit_many(); a cached response younger than that is returned
+    without touching the wire. Every SET command we send invalidates the cached reads of the device it addresses
+    before it is written, and a `VALID' reply to the SET writes the new value through to cached reads of the same
+    parameter. The hits, misses and invalidations counters (and stats()) show how much traffic the cache saves.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = {}  # READ command -> (monotonic time stored, response)
+        self._lock = Lock()
+
+    def get(self, command, ttl):
+        """
+        Returns the cached response to `command' if it is younger than `ttl' seconds, otherwise None.
+        """
+        with self._lock:
+            entry = self._entries.get(command)
+            if entry is not None and time.monotonic() - entry[0] <= ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def store(self, command, response):
+        with self._lock:
+            self._entries[command] = (time.monotonic(), response)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def invalidate(self, set_command):
+        """
+        Marks every cached read of the device addressed by `set_command' (e.g. `SET:DEV:MB1.T1:TEMP:LOOP:TSET:5') as
+        stale, so that it is re-read from the instrument unless write_through() refreshes it first.
+        """
+        device = self._device(set_command)
+        with self._lock:
+            for command, (_, cached) in list(self._entries.items()):
+                if self._device(command) == device:
+                    self._entries[command] = (float('-inf'), cached)  # stale, but kept so write_through() can refresh it
+                    self.invalidations += 1
+
+    def write_through(self, set_command, response):
+        """
+        Stores the value from a SET command that the instrument accepted (`response' ends in `VALID') as the cached
+        response of every read of the same device and parameter, keeping the unit suffix of the previous response.
+        Does nothing for rejected commands (their reads stay stale) or parameters not read through the cache before.
+        """
+        if not response.endswith(':VALID'):
+            return
+        path, value = set_command.strip()[len('SET:'):].rsplit(':', 1)
+        device, parameter = self._device(set_command), path.split(':')[-1]
+        with self._lock:
+            for command, (_, cached) in list(self._entries.items()):
+                if self._device(command) == device and command.split(':')[-1] == parameter:
+                    old_value = cached.split(':')[-1]
+                    unit = old_value.lstrip('+-.0123456789eE')
+                    self._entries[command] = (time.monotonic(), f'{cached.rsplit(":", 1)[0]}:{value}{unit}')
+        # entries we have never read are left alone: their command (and so key) is not known
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'entries': len(self._entries)}
+
+    @staticmethod
+    def _device(command):
+        """
+        Returns the device UID of a READ/SET command, e.g. `DEV:MB1.T1:TEMP', or the whole path for other commands.
+        """
+        parts = command.strip().split(':')[1:]
+        if parts and parts[0] == 'DEV':
+            return ':'.join(parts[:3])
+        return ':'.join(parts)
+
+
+class Histogram:
+    """
+    A fixed-bucket histogram of durations in seconds (see `latency_buckets'). Adding a value is a bisect and a few
+    integer updates, cheap enough to record every command permanently; quantiles are estimated as bucket bounds.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1)  # the last bucket holds values above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(latency_buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction of values (the maximum for the last bucket).
+        """
+        rank = fraction * self.count
+        total = 0
+        for bound, count in zip(latency_buckets, self.counts):
+            total += count
+            if total >= rank and total > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.sum / self.count if self.count else 0.0,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99), 'max': self.max}
+
+
+class PortMetrics:
+    """
+    Counters and latency histograms for one SerialPort. Each command sent is recorded under its pattern (the command,
+    without the value of a SET) with two histograms: `queue' is the time from creation until the IO thread wrote it and
+    `wire' the time from writing it until its response was read. Responses that time out (empty), are errors (`?') or
+    could not be sent (`~') are counted, as are retries, commands that still failed after retrying, late responses
+    discarded while resynchronising, and bytes written and read. SerialPort.stats() adds the queue and cache figures.
+    """
+    def __init__(self):
+        self.commands = {}  # pattern -> (queue Histogram, wire Histogram)
+        self.timeouts = 0
+        self.errors = 0  # `?' responses
+        self.send_errors = 0  # `~' responses
+        self.retries = 0
+        self.failures = 0
+        self.discarded = 0  # lines that answered no outstanding command
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self._lock = Lock()
+
+    @staticmethod
+    def pattern(command):
+        command = command.strip()
+        if command.startswith('SET:'):
+            return command.rsplit(':', 1)[0]
+        return command
+
+    def record(self, serialmessage):
+        """
+        Records a message that the IO thread has completed.
+        """
+        response = serialmessage.result(0)
+        with self._lock:
+            histograms = self.commands.get(self.pattern(serialmessage.message))
+            if histograms is None:
+                histograms = self.commands[self.pattern(serialmessage.message)] = (Histogram(), Histogram())
+            if serialmessage.sent is not None:
+                histograms[0].add(serialmessage.sent - serialmessage.created)
+                histograms[1].add(serialmessage.completed - serialmessage.sent)
+            if not response:
+                self.timeouts += 1
+            elif response[0] == '?':
+                self.errors += 1
+            elif response[0] == '~':
+                self.send_errors += 1
+
+    def count(self, retries=0, failures=0):
+        with self._lock:
+            self.retries += retries
+            self.failures += failures
+
+    def stats(self):
+        with self._lock:
+            return {'commands': {pattern: {'queue': queue_histogram.summary(), 'wire': wire_histogram.summary()}
+                                 for pattern, (queue_histogram, wire_histogram) in self.commands.items()},
+                    'timeouts': self.timeouts, 'errors': self.errors, 'send_errors': self.send_errors,
+                    'retries': self.retries, 'failures': self.failures, 'discarded': self.discarded,
+                    'bytes_out': self.bytes_out, 'bytes_in': self.bytes_in}
+
+    def prometheus(self, labels):
+        """
+        Returns the metrics in the Prometheus text exposition format, with `labels' (e.g. `port="COM6"') on each.
+        """
+        lines = []
+        with self._lock:
+            for name, value in (('timeouts', self.timeouts), ('errors', self.errors),
+                                ('send_errors', self.send_errors), ('retries', self.retries),
+                                ('failures', self.failures), ('discarded', self.discarded),
+                                ('bytes_out', self.bytes_out),
+                                ('bytes_in', self.bytes_in)):
+                lines.append(f'mercury_{name}_total{{{labels}}} {value}')
+            for pattern, histograms in self.commands.items():
+                for kind, histogram in zip(('queue', 'wire'), histograms):
+                    name, series = f'mercury_{kind}_seconds', f'{labels},command="{pattern}"'
+                    total = 0
+                    for bound, count in zip(latency_buckets + (float('inf'),), histogram.counts):
+                        total += count
+                        bound = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{{{series},le="{bound}"}} {total}')
+                    lines.append(f'{name}_sum{{{series}}} {histogram.sum}')
+                    lines.append(f'{name}_count{{{series}}} {histogram.count}')
+        return lines
 
 
 class SerialPort:
     """
-    An object that manages communication through a single serial port. A queue is used to prevent timing clashes of
-    messages being sent/received, and a thread is used to monitor this queue for new entries. The queue is populated
-    by SerialMessage objects. When the thread detects a SerialMessage object in the queue, it sends the requested
-    message, updates the object with the response, then moves on to the next object in the queue (if any).
+    An object that manages communication with one instrument through a serial port or, if the port name is a TCP
+    address, its Ethernet interface (see make_transport()). A queue is used to prevent timing clashes of messages being
+    sent/received, and a thread is used to monitor this queue for new entries. The queue is populated by SerialMessage
+    objects. When the thread detects a SerialMessage object in the queue, it sends the requested message, updates the
+    object with the response, then moves on to the next object in the queue (if any). SerialBatch objects are handled
+    the same way, except that all their commands are written before any response is read. Each response is matched to
+    its command by the command it echoes (see _send()). The queue is a CommandQueue, so entries are served by priority
+    lane rather than strictly first-in, first-out. The `cache' attribute is a ResponseCache for reads that pass a
+    time-to-live. Identical reads are coalesced (see _coalesce()) and `coalesced' counts the round trips this saved.
+    `metrics' (a PortMetrics) records every command sent; stats() summarises everything. Setting `trace' to a
+    wiretrace.WireTrace before open() records the raw traffic.
     """
     def __init__(self):
         self.port = ''
         self.is_open = False
-        self._serial = serial.Serial()
+        self.cache = ResponseCache()
+        self.coalesce_window = default_coalesce_window
+        self.coalesced = 0
+        self.metrics = PortMetrics()
+        self.trace = None  # optional wiretrace.WireTrace
+        self._transport = None  # pyserial port or SocketTransport, created by open()
         self._thread = Thread()
-        self._queue = queue.Queue()
+        self._queue = CommandQueue()
+        self._input = bytearray()  # received bytes not yet framed into lines, see _read_line()
+        self._reads = {}  # command -> latest SerialMessage sent for it, for coalescing
+        self._reads_lock = Lock()
 
     def __del__(self):
-        if self._serial.is_open:
+        if self._transport is not None and self._transport.is_open:
             try:
-                self._serial.close()
-            except serial.SerialException:
+                self._transport.close()
+            except OSError:
                 print(f'Destructor error closing COM port: {exc_info()[0]}\a')
 
-    def _serial_io_thread(self):
+    def _write(self, newmessage):
+        """
+        Writes a newline-terminated command to the serial port. Returns False (after printing why) on a sending error.
+        """
+        data = newmessage.encode('utf-8')
+        try:
+            self._transport.write(data)
+        except ValueError:
+            print(f'Error sending, ValueError:{newmessage[:-1]},{exc_info()[0]}\a')
+            return False
+        except OSError:  # serial.SerialException or a socket error
+            print(f'Error sending, OSError:{newmessage[:-1]},{exc_info()[0]}\a')
+            return False
+        self.metrics.bytes_out += len(data)
+        return True
+
+    def _read_line(self, deadline):
         """
-        A daemon thread function that continuously waits for messages to appear in the queue. When it receives a new
-        message, it sends it to the serial port and returns the response to the SerialMessage object.
+        Returns the next line received, without its newline. Whatever the transport has waiting is drained into
+        `_input' at once, so responses that arrive together are framed from one read and nothing waits for a fixed
+        time. Returns None if no complete line arrives by the monotonic time `deadline' (give or take one transport
+        timeout) or the port is closed underneath the read.
         """
         while True:
-            if self.is_open:  # ensure the serial connection is still open
-                try:  # check if there is an entry in the queue
-                    serialmessage = self._queue.get(False)
-                except queue.Empty:  # otherwise wait `delay' seconds then retry
-                    time.sleep(delay_queue)
-                    continue
-                if isinstance(serialmessage, SerialMessage):
-                    newmessage = serialmessage.message.strip() + '\n'
-                    try:
-                        time.sleep(delay_before_write)
-                        self._serial.write(newmessage.encode('utf-8'))
-                    except ValueError:
-                        print(f'Error sending, ValueError:{newmessage[:-2]},{exc_info()[0]}\a')
-                        serialmessage._response = '~'  # flag sending error
-                    except serial.SerialException:
-                        print(f'Error sending, SerialException:{newmessage[:-2]},{exc_info()[0]}\a')
-                        serialmessage._response = '~'  # flag sending error
-                    else:
-                        time.sleep(delay_before_read)
-                        response = self._serial.readline()
-                        if response is not None:
-                            response = response.decode('utf-8').strip('\n')
-                        else:
-                            response = ''
-                        if serialmessage.print_response:
-                            print(newmessage[:-2], response)
-                        serialmessage._response = response
-                elif isinstance(serialmessage, str):
-                    newmessage = serialmessage.message.strip() + '\n'
-                    try:
-                        time.sleep(delay_before_write)
-                        self._serial.write(newmessage.encode('utf-8'))
-                    except ValueError:
-                        print(f'Error sending, ValueError:{newmessage[:-2]},{exc_info()[0]}\a')
-                    except serial.SerialException:
-                        print(f'Error sending, SerialException:{newmessage[:-2]},{exc_info()[0]}\a')
-                    else:
-                        time.sleep(delay_before_read)
-                        response = self._serial.readline().decode('utf-8').strip('\n')
-                        print(newmessage[:-2], response)
-                else:
-                    raise TypeError
+            end = self._input.find(b'\n')
+            if end >= 0:
+                line = self._input[:end].decode('utf-8', 'replace').strip('\r')
+                del self._input[:end + 1]
+                return line
+            if time.monotonic() >= deadline:
+                return None
+            try:
+                data = self._transport.read(max(self._transport.in_waiting, 1))
+            except (ValueError, OSError, TypeError):  # port closed underneath the read (pyserial's fd becomes None)
+                return None
+            self.metrics.bytes_in += len(data)
+            self._input += data
+
+    def _complete(self, serialmessage, response):
+        if serialmessage.print_response:
+            print(serialmessage.message.strip(), response)
+        serialmessage._set_response(response)
+        self.metrics.record(serialmessage)
+
+    def _send(self, messages):
+        """
+        Writes the commands of `messages' back-to-back, then completes each message with its response. Every line
+        read is matched to the earliest outstanding message whose command it answers (see answers()), and a `?' line
+        to the earliest outstanding message. Messages passed over by a match were not answered and get an empty
+        response; a line that matches no outstanding message is a late response to an earlier command and is
+        discarded (counted in metrics.discarded), which keeps the port in step without flushing or extra reads.
+        Messages still outstanding once no line has arrived for `default_timeout' seconds get an empty response.
+        """
+        sent = time.monotonic()
+        for serialmessage in messages:
+            serialmessage.sent = sent
+        time.sleep(delay_before_write)
+        if not self._write(''.join(serialmessage.message.strip() + '\n' for serialmessage in messages)):
+            for serialmessage in messages:
+                serialmessage._set_response('~')  # flag sending error
+                self.metrics.record(serialmessage)
+            return
+        commands = [serialmessage.message.strip() for serialmessage in messages]
+        index = 0
+        deadline = time.monotonic() + default_timeout
+        while index < len(messages):
+            line = self._read_line(deadline)
+            if line is None:
+                break
+            if line.startswith('?'):
+                match = index
             else:
+                match = next((position for position in range(index, len(messages))
+                              if answers(line, commands[position])), None)
+            if match is None:
+                self.metrics.discarded += 1
+                continue
+            for serialmessage in messages[index:match]:
+                self._complete(serialmessage, '')
+            self._complete(messages[match], line)
+            index = match + 1
+            deadline = time.monotonic() + default_timeout
+        for serialmessage in messages[index:]:
+            self._complete(serialmessage, '')
+
+    def _serial_io_thread(self):
+        """
+        A daemon thread function that blocks on the queue until a message appears. When it receives a new message, it
+        sends it to the serial port and returns the response to the SerialMessage object. The blocking get() wakes as
+        soon as a message is queued, so an idle port adds no polling delay to a command. close() queues a None entry
+        to wake the thread; any messages still queued when the port closes are completed with a `~' sending error.
+        """
+        while self.is_open:  # ensure the serial connection is still open
+            try:  # wait for an entry in the queue
+                serialmessage = self._queue.get(timeout=delay_queue)
+            except queue.Empty:  # nothing to send, check the port is still open and wait again
+                continue
+            if serialmessage is None:  # wake-up entry queued by close()
+                continue
+            if isinstance(serialmessage, str):
+                serialmessage = SerialMessage(serialmessage)
+            if isinstance(serialmessage, SerialMessage):
+                self._send([serialmessage])
+            elif isinstance(serialmessage, SerialBatch):
+                self._send(serialmessage.messages)
+            else:
+                raise TypeError
+        # after `while' loop breaks, release anybody still waiting on a queued message
+        while True:
+            try:
+                serialmessage = self._queue.get(False)
+            except queue.Empty:
                 break
+            if isinstance(serialmessage, SerialMessage):
+                serialmessage._set_response('~')
+            elif isinstance(serialmessage, SerialBatch):
+                for batchmessage in serialmessage.messages:
+                    batchmessage._set_response('~')
 
     def open(self, portname=None):
         """
-        Opens a connection to the serial port using the default baud rate and timeout settings from global variables.
-        If `portname' is provided, this is the COM port name used; otherwise, self.Port is used. Upon establishing the
-        connection, it initiates a queueing thread and returns True. If a connection fails or is already open, it
-        returns False.
+        Opens a connection to the instrument using the default settings from global variables. If `portname' is
+        provided, this is the port name used; otherwise, self.port is used. The name is a COM port, a pyserial URL or
+        an Ethernet address (see make_transport()). Upon establishing the connection, it initiates a queueing thread
+        and returns True. If a connection fails or is already open, it returns False.
         """
         if not self.is_open:
-            self._serial.port = portname if portname is not None else self.port
-            self._serial.baudrate = default_baudrate
-            self._serial.timeout = default_timeout
-            self._serial.stopbits = default_stopbits
-            self._serial.bytesize = default_bytesize
-            self._serial.parity = default_parity
+            portname = portname if portname is not None else self.port
+            self.port = portname
             try:
-                self._serial.open()
-            except serial.SerialException:
-                print(f'Error opening COM port: {self._serial.port},{exc_info()[0]}\a')
+                self._transport = make_transport(portname)
+                if self.trace is not None:
+                    self._transport = self.trace.wrap(self._transport)
+                self._transport.open()
+            except (ValueError, OSError):  # serial.SerialException, a socket error or an invalid port name
+                print(f'Error opening COM port: {portname},{exc_info()[0]}\a')
                 return False
             else:
                 self.is_open = True
+                self._input = bytearray()
+                self.cache.clear()  # nothing cached from a previous connection can be trusted
                 self._thread = Thread(target=self._serial_io_thread, daemon=True)
                 self._thread.start()
                 return True
@@ -141,33 +762,208 @@ class SerialPort:
         if self.is_open:
             try:
                 self.is_open = False  # this flag will also cause the IO thread to quit
-                self._serial.close()
+                self._queue.put(None, PRIORITY_CONTROL)  # wake the IO thread so it notices straight away
+                self._transport.close()
                 return True
-            except serial.SerialException:
-                print(f'Error closing COM port: {self._serial.port},{exc_info()[0]}\a')
+            except OSError:
+                print(f'Error closing COM port: {self._transport.port},{exc_info()[0]}\a')
                 return False
         return False
 
-    def transmit(self, message, error_message=None, print_response=True, attempts=2):
+    def _coalesce(self, message, print_response=True, priority=PRIORITY_INTERACTIVE):
+        """
+        Returns (serialmessage, shared). If an identical read is already queued or in flight with at least the same
+        priority, or was answered successfully within the last `coalesce_window' seconds, that SerialMessage is
+        returned with `shared' True, for the caller to wait on instead of sending the command again. Otherwise a new
+        SerialMessage is returned with `shared' False, and the caller must queue it. SET commands are never shared.
+        """
+        if message.startswith('SET:') or self.coalesce_window is None:
+            return SerialMessage(message, print_response, priority), False
+        command = message.strip()
+        with self._reads_lock:
+            existing = self._reads.get(command)
+            if existing is not None and not existing.dropped and existing.priority <= priority:
+                if not existing.done():
+                    self.coalesced += 1
+                    return existing, True
+                response = existing.result(0)
+                if (time.monotonic() - existing.completed <= self.coalesce_window and isinstance(response, str)
+                        and len(response) > 0 and response[0] not in '?~'):
+                    self.coalesced += 1
+                    return existing, True
+            serialmessage = self._reads[command] = SerialMessage(message, print_response, priority)
+        return serialmessage, False
+
+    def transmit(self, message, error_message=None, print_response=True, attempts=2, priority=PRIORITY_INTERACTIVE,
+                 cache_ttl=None):
+        """
+        Sends `message' and returns its response, retrying up to `attempts' times in total while the response is
+        missing or starts with `?'. A read given a `cache_ttl' (in seconds) is answered from the cache when possible.
+        """
+        return self._wait_for(self._transmit_steps(message, error_message, print_response, attempts, priority,
+                                                   cache_ttl))
+
+    def transmit_many(self, messages, error_messages=None, print_response=True, attempts=2,
+                      priority=PRIORITY_INTERACTIVE, cache_ttls=None):
+        """
+        Sends a group of commands as one SerialBatch and returns their responses as a list in the same order. Any item
+        whose response is missing or starts with `?' is retried (as a smaller batch) up to `attempts' times in total;
+        items that succeeded are not re-sent and items coalesced with identical reads are left out of the batch.
+        `error_messages' is an optional list, parallel to `messages', of messages to print for items that still fail.
+        A failed item's last response is returned (`?' if there was none). Items dropped unsent by the queue are not
+        retried. `cache_ttls' is an optional parallel list of cache time-to-live values (None for uncached items);
+        items answered from the cache are left out of the batch.
+        """
+        return self._wait_for(self._transmit_many_steps(messages, error_messages, print_response, attempts, priority,
+                                                        cache_ttls))
+
+    @staticmethod
+    def _wait_for(steps):
+        """
+        Runs a generator from _transmit_steps() or _transmit_many_steps() to its result, blocking on the completion
+        Event of each message it yields (for at most 60 s, as SerialMessage.response()).
+        """
+        try:
+            serialmessages = next(steps)
+            while True:
+                for serialmessage in serialmessages:
+                    serialmessage.response()
+                serialmessages = steps.send(None)
+        except StopIteration as stop:
+            return stop.value
+
+    def _transmit_steps(self, message, error_message, print_response, attempts, priority, cache_ttl):
+        """
+        The request/response handling of transmit() (cache, coalescing, retries, metrics), as a generator that leaves
+        the waiting to its caller: it queues what must be sent, yields the list of SerialMessage objects whose
+        responses it needs, expects to be resumed once they are complete (or have been waited on long enough) and
+        returns the response. transmit() drives it with _wait_for() and aioport.AsyncSerialPort with futures.
+        """
+        if cache_ttl is not None:
+            response = self.cache.get(message, cache_ttl)
+            if response is not None:
+                return response
+        if message.startswith('SET:'):
+            self.cache.invalidate(message)
         while attempts > 0:
-            transmission = SerialMessage(message, print_response)
-            self._queue.put(transmission)
-            response = transmission.response()
+            transmission, shared = self._coalesce(message, print_response, priority)
+            if not shared:
+                self._queue.put(transmission)
+            yield [transmission]
+            response = transmission.result(0)
             if isinstance(response, str):
                 if len(response) > 0:
                     if response[0] != '?':
                         break  # if responded without confusion
-            self._serial.readline()
+            if transmission.dropped:
+                break  # discarded unsent by the queue, so there is nothing to retry
             attempts = attempts - 1
+            self.metrics.count(retries=1 if attempts > 0 else 0, failures=0 if attempts > 0 else 1)
         if isinstance(response, str):
             if len(response) > 0:
                 if response[0] == '?' and error_message is not None:
                     print(error_message)
+            self._cache_response(message, response, cache_ttl)
             return response
         else:
             if error_message is not None:
                 print(error_message)
             return '?'
 
+    def _transmit_many_steps(self, messages, error_messages, print_response, attempts, priority, cache_ttls):
+        """
+        The request/response handling of transmit_many(), as a generator driven like _transmit_steps().
+        """
+        if cache_ttls is None:
+            cache_ttls = [None] * len(messages)
+        responses = [None] * len(messages)
+        pending = []
+        for index, message in enumerate(messages):
+            if cache_ttls[index] is not None:
+                responses[index] = self.cache.get(message, cache_ttls[index])
+            if responses[index] is None:
+                if message.startswith('SET:'):
+                    self.cache.invalidate(message)
+                pending.append(index)
+        sent = list(pending)
+        while attempts > 0 and pending:
+            transmissions, new = [], []
+            for index in pending:
+                transmission, shared = self._coalesce(messages[index], print_response, priority)
+                transmissions.append(transmission)
+                if not shared:
+                    new.append(transmission)
+            if new:
+                self._queue.put(SerialBatch(new, priority))
+            yield transmissions
+            failed = []
+            for index, transmission in zip(pending, transmissions):
+                response = transmission.result(0)
+                responses[index] = response
+                if transmission.dropped:
+                    continue
+                if not isinstance(response, str) or len(response) == 0 or response[0] == '?':
+                    failed.append(index)
+            pending = failed
+            attempts = attempts - 1
+            self.metrics.count(retries=len(failed) if attempts > 0 else 0, failures=0 if attempts > 0 else len(failed))
+        for index in pending:
+            if error_messages is not None and error_messages[index] is not None:
+                print(error_messages[index])
+            if not isinstance(responses[index], str):
+                responses[index] = '?'
+        for index in sent:
+            self._cache_response(messages[index], responses[index], cache_ttls[index])
+        return responses
+
+    def _cache_response(self, message, response, cache_ttl):
+        """
+        Stores a successful read in the cache (if it was sent with a time-to-live) or writes a SET through to it.
+        """
+        if len(response) == 0 or response[0] in '?~':
+            return
+        if message.startswith('SET:'):
+            self.cache.write_through(message, response)
+        elif cache_ttl is not None:
+            self.cache.store(message, response)
+
+    def stats(self):
+        """
+        Returns a dictionary of the port's metrics (see PortMetrics): per-command-pattern latency summaries, error,
+        retry and byte counters, the queue's current depth, high-water mark and drops, coalescing and cache figures.
+        """
+        stats = self.metrics.stats()
+        stats.update(queue_depth=self._queue.qsize(), queue_high_water=self._queue.high_water,
+                     dropped=self._queue.dropped, coalesced=self.coalesced, cache=self.cache.stats())
+        return stats
+
+    def prometheus(self, labels=None):
+        """
+        Returns the port's metrics as lines of the Prometheus text exposition format, labelled with the port name.
+        """
+        labels = f'port="{self.port}"' if labels is None else labels
+        lines = self.metrics.prometheus(labels)
+        cache = self.cache.stats()
+        for name, value in (('queue_depth', self._queue.qsize()), ('queue_high_water', self._queue.high_water)):
+            lines.append(f'mercury_{name}{{{labels}}} {value}')
+        for name, value in (('dropped', self._queue.dropped), ('coalesced', self.coalesced),
+                            ('cache_hits', cache['hits']), ('cache_misses', cache['misses'])):
+            lines.append(f'mercury_{name}_total{{{labels}}} {value}')
+        return lines
+
+
+def write_prometheus(path, ports):
+    """
+    Writes the metrics of the SerialPort objects in `ports' to `path' in the Prometheus text format (for example for
+    the node exporter's textfile collector). The file is replaced atomically, so a scrape never sees half of it.
+    """
+    lines = []
+    for port in ports:
+        lines.extend(port.prometheus())
+    with open(path + '.tmp', 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
 if __name__ == '__main__':
     pass
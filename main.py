@@ -1,255 +1,132 @@
-from time import sleep, time
 from threading import Thread
-from instrument import SerialPort, default_comports
+from controller import *
 from gui import *
+from discovery import cached_port
+from alarms import AlarmEngine
+from trends import TrendPanel
 
-# Settings for appearance, updates, etc
-delay_sensor = 3  # time between updates for sensors
 
-# iTC and iPS controller settings
-min_temp, max_temp = 0, 300  # minimum and maximum settings for temperature in Kelvin
-min_press, max_press = 2, 20 # minimum and maximum settings for pressure in mB
-max_abs_field = 7  # maximum field in Tesla
-
-# iTC Device UIDs
-uid_probe_temperature = 'DEV:DB8.T1:TEMP'
-uid_vti_temperature = 'DEV:MB1.T1:TEMP'
-uid_vti_pressure = 'DEV:DB5.P1:PRES'
-uid_vti_pressure_set = 'DEV:DB5.P1:TEMP'
-
-# iPS Device UIDs
-uid_pt2_temperature = 'DEV:DB7.T1:TEMP'
-uid_magnet_temperature = 'DEV:MB1.T1:TEMP'
-uid_magnet = 'DEV:GRPZ:PSU'
-
-
-def format_temperature(temperature):
+class Application:
     """
-    The temperature controller uses four decimal places so this function takes in a number and converts it into a string
-
-    :param temperature: (float) converts an integer/float to a string with four decimal points
-    :return: string of temperature with correct decimal places
+    The Tk control panel: a GUI front end that forwards button presses to a Controller and shows the readings it
+    reports. Readings arrive on the monitor threads and are handed to the GUI with GUI.post(). With `worker' set,
+    the Controller runs in a worker process (see worker.WorkerController), along with the interlocks.
     """
-    if 0 <= temperature:
-        return '{:.4f}'.format(temperature)
-    else:
-        return str(temperature)
-
-
-def format_field(field, zero=0):
-    if field > 0:
-        return '+{:.4f}'.format(field)
-    elif field < 0:
-        return '{:.4f}'.format(field)
-    elif field == 0:
-        if zero == 1:
-            return '+0.0000'
-        elif zero == -1:
-            return '-0.0000'
+    def __init__(self, worker=False):
+        if worker:
+            from worker import WorkerController
+            self.controller = WorkerController()
         else:
-            return '0.0000'
-    else:
-        return str(field)
-
-
-class Application:
-    def __init__(self):
-        self.itc, self.ips = SerialPort(), SerialPort()  # both serial connections
-        self._itc_connect, self._ips_connect = False, False  # True/False flags for each connection
-        self._itc_thread, self._ips_thread = None, None  # update thread for each connection
-        self._itc_delay, self._ips_delay = delay_sensor, delay_sensor  # delays between updates for each connection
-        self._switch_status = SWITCH_UNKNOWN  # flag indicating current switch heater status
-        self._switch_action = None  # controls countdown for switch heater on/off
+            self.controller = Controller()
         self.gui = GUI()
-        self.gui.ent_itc_com.insert(tk.END, str(default_comports[0]))
-        self.gui.ent_ips_com.insert(tk.END, str(default_comports[1]))
+        self._searching = set()  # models being looked for on the serial ports after a failed connect
+        self.gui.ent_itc_com.insert(tk.END, str(cached_port('ITC', default_comports[0])))  # where last connected
+        self.gui.ent_ips_com.insert(tk.END, str(cached_port('IPS', default_comports[1])))
         self.gui.set_close_method(self.disconnect_all)
         self.gui.set_functions(serial_itc_connect=self.itc_connect, serial_ips_connect=self.ips_connect,
                                serial_itc_disconnect=self.itc_disconnect, serial_ips_disconnect=self.ips_disconnect,
-                               set_field=self.set_magnetic_field, goto_field=self.ramp_goto_set,
-                               zero_field=self.ramp_goto_zero, set_temperature=self.set_vti_temperature,
+                               set_field=self.set_magnetic_field, goto_field=self.controller.ramp_goto_set,
+                               zero_field=self.controller.ramp_goto_zero, set_temperature=self.set_vti_temperature,
                                set_pressure=self.set_vti_pressure)
         self.gui.set_itc_frame(False)
         self.gui.set_ips_frame(False)
+        self._entries = {'probe_temperature': self.gui.ent_probe_temp, 'vti_temperature': self.gui.ent_vti_temp,
+                         'vti_pressure': self.gui.ent_vti_press, 'vti_temperature_set': self.gui.ent_vti_temp_set,
+                         'vti_pressure_set': self.gui.ent_vti_press_set, 'pt2_temperature': self.gui.ent_pt2_temp,
+                         'magnet_temperature': self.gui.ent_mag_temp, 'magnet_field': self.gui.ent_curr_fld,
+                         'magnet_field_set': self.gui.ent_field_set, 'magnet_action': self.gui.ent_mag_action}
+        self.controller.add_listener(self._show_reading)
+        self.trends = TrendPanel(self.gui.frm_trends, lambda: self.controller.history)
+        self.trends.pack()
+        self.alarms = None
+        if not worker:
+            self.alarms = AlarmEngine(self.controller)  # holds the magnet if it warms up (see alarms.default_rules())
+            self.alarms.start()
 
     def run(self):
         self.gui.mainloop()
 
-    def itc_connect(self):
+    def _show_reading(self, name, text, value, timestamp):
+        if name in self._entries:
+            self.gui.post(self._entries[name], text)
+
+    def itc_connect(self, event=None):
         """
-        Attempts to connect to the Oxford Mercury iTC through the user-supplied COM port
+        Attempts to connect to the Oxford Mercury iTC through the user-supplied COM port (or `host:port' address),
+        and if it is not there, looks for it on the other serial ports in a background thread
         """
-        self.itc.port = self.gui.ent_itc_com.get()  # read the user-supplied COM port name
-        if self.itc.is_open:  # if the port is somehow open already, close it
-            self.itc.close()
-        if not self.itc.open():  # if open() is false then something has gone wrong
-            self.gui.update_ent(self.gui.ent_itc_com, 'fail')
-            self.gui.set_itc_frame(False)
+        if 'ITC' in self._searching:
             return
-
-        self.gui.set_itc_frame(True)
-        inst_name = self.itc.transmit('*IDN?', 'Error receiving iTC identification')
-        if inst_name[:34] != 'IDN:OXFORD INSTRUMENTS:MERCURY ITC':
-            print('Mercury iTC was not located at user-supplied COM port')
-            self.gui.update_ent(self.gui.ent_itc_com, 'non-iTC fail')
-            self.gui.set_itc_frame(False)
-            self.itc.close()
+        failure = self.controller.itc_connect(self.gui.ent_itc_com.get())  # read the user-supplied COM port name
+        if failure is not None:
+            self._searching.add('ITC')
+            self.gui.btn_itc_com['state'] = 'disabled'  # until the search is over
+            self.gui.update_ent(self.gui.ent_itc_com, 'Searching...')
+            Thread(target=self._search_itc, args=(failure,), daemon=True).start()
             return
         self.gui.set_itc_frame(True)
-        self._itc_thread = Thread(target=self._monitor_itc, daemon=True)
-        self._itc_thread.start()
 
-    def itc_disconnect(self):
-        if self.itc.is_open:
-            self.itc.close()
-        self.gui.set_itc_frame(False)
+    def _search_itc(self, failure):
+        port = self._find_and_connect('ITC', self.controller.itc_connect)
+        self.gui.post(self.gui.ent_itc_com, failure if port is None else port)
+        self.gui.post_call(self.gui.set_itc_frame, port is not None)
+        self.gui.post_call(self.gui.btn_itc_com.configure, state='normal')
+        self.gui.post_call(self._searching.discard, 'ITC')
 
-    def ips_connect(self):
-        """
-        Attempts to connect to the Oxford Mercury iPS through the user-supplied COM port
+    def _find_and_connect(self, model, connect):
         """
-        self.ips.port = self.gui.ent_ips_com.get()  # read the user-supplied COM port name
-        if self.ips.is_open:  # if the port is somehow open already, close it
-            self.ips.close()
-        if not self.ips.open():  # if open() is false then something has gone wrong
-            self.gui.update_ent(self.gui.ent_ips_com, 'fail')
-            self.gui.set_ips_frame(False)
-            return
-
-        self.gui.set_ips_frame(True)
-        inst_name = self.ips.transmit('*IDN?', 'Error receiving iPS identification')
-        if inst_name[:34] != 'IDN:OXFORD INSTRUMENTS:MERCURY IPS':
-            print('Mercury iPS was not located at user-supplied COM port')
-            self.gui.update_ent(self.gui.ent_ips_com, 'non-iPS fail')
-            self.gui.set_ips_frame(False)
-            self.ips.close()
-            return
-        switch_status = self.ips.transmit(f'READ:{uid_magnet}:SIG:SWHT').split(':')
-        self._switch_status = SWITCH_UNKNOWN
-        if len(switch_status) > 0:
-            if switch_status[-1] == 'ON':
-                self._switch_status = SWITCH_ENABLED
-            elif switch_status[-1] == 'OFF':
-                self._switch_status = SWITCH_DISABLED
-        self.gui.set_ips_frame(True, switch_setting=self._switch_status)
-        self._ips_thread = Thread(target=self._monitor_ips, daemon=True)
-        self._ips_thread.start()
+        Probes the serial ports not in use for `model' and connects to it with connect(port) where it is found. Run
+        from a background thread, as probing takes up to a few tenths of a second per port.
 
-    def ips_disconnect(self):
-        if self.ips.is_open:
-            # RETURN TO FINISH HERE. SET TO HOLD THEN INTERRUPT ANY ACTION
-            self.ips.close()
-        self.gui.set_ips_frame(False)
-
-    def _monitor_itc(self):
-        """
-        Daemon thread function to update the various iTC boxes every `_itc_delay' seconds. Does not print each message/
-        response to std_out so as to prevent clutter from background monitoring operations.
+        :return: the port connected to, or None
         """
-        while self.itc.is_open:
-            # read current values
-            probe_temperature = self.itc.transmit(f'READ:{uid_probe_temperature}:SIG:TEMP',
-                                                  'Error reading probe temperature', False)
-            vti_temperature = self.itc.transmit(f'READ:{uid_vti_temperature}:SIG:TEMP',
-                                                'Error reading VTI temperature', False)
-            vti_pressure = self.itc.transmit(f'READ:{uid_vti_pressure}:SIG:PRES',
-                                             'Error reading VTI pressure', False)
-            probe_temperature = probe_temperature.split(':')
-            if len(probe_temperature) > 0:
-                self.gui.update_ent(self.gui.ent_probe_temp, probe_temperature[-1])
-            vti_temperature = vti_temperature.split(':')
-            if len(vti_temperature) > 0:
-                self.gui.update_ent(self.gui.ent_vti_temp, vti_temperature[-1])
-            vti_pressure = vti_pressure.split(':')
-            if len(vti_pressure) > 0:
-                self.gui.update_ent(self.gui.ent_vti_press, vti_pressure[-1])
+        found = self.controller.find_ports((model,))
+        if model in found and connect(found[model]['port']) is None:
+            return found[model]['port']
+        return None
 
-            # read set points
-            probe_temperature = self.itc.transmit(f'READ:{uid_probe_temperature}:SIG:TEMP:LOOP:TSET',
-                                                  'Error reading probe temperature set point',
-                                                  False)
-            vti_temperature = self.itc.transmit(f'READ:{uid_vti_temperature}:SIG:TEMP:LOOP:TSET',
-                                                'Error reading VTI temperature set point',
-                                                False)
-            vti_pressure = self.itc.transmit(f'READ:{uid_vti_pressure_set}:LOOP:TSET',
-                                             'Error reading VTI pressure set point',
-                                             False)
-            # probe_temperature = probe_temperature.split(':')
-            # if len(probe_temperature) > 0:
-                # self.gui.update_ent(self.gui.ent_probe_temp_set, probe_temperature[-1])
-            vti_temperature = vti_temperature.split(':')
-            if len(vti_temperature) > 0:
-                self.gui.update_ent(self.gui.ent_vti_temp_set, vti_temperature[-1])
-            vti_pressure = vti_pressure.split(':')
-            if len(vti_pressure) > 0:
-                self.gui.update_ent(self.gui.ent_vti_press_set, vti_pressure[-1])
-            sleep(self._itc_delay)
-        # after `while' loop breaks
-        return
+    def itc_disconnect(self):
+        self.controller.itc_disconnect()
+        self.gui.set_itc_frame(False)
 
-    def _monitor_ips(self):
+    def ips_connect(self, event=None):
         """
-        Daemon thread function to update the various iPS boxes every `_ips_delay' seconds. Does not print each message/
-        response to std_out so as to prevent clutter from background monitoring operations.
+        Attempts to connect to the Oxford Mercury iPS through the user-supplied COM port (or `host:port' address),
+        and if it is not there, looks for it on the other serial ports in a background thread
         """
-        while self.ips.is_open:
-            # read current values
-            pt2_temperature = self.ips.transmit(f'READ:{uid_pt2_temperature}:SIG:TEMP',
-                                                'Error reading PT2 temperature', False)
-            mag_temperature = self.ips.transmit(f'READ:{uid_magnet_temperature}:SIG:TEMP',
-                                                'Error reading magnet temperature', False)
-            mag_field = self.ips.transmit(f'READ:{uid_magnet}:SIG:FLD',
-                                          'Error reading magnetic field', False)
-            pt2_temperature = pt2_temperature.split(':')
-            if len(pt2_temperature) > 0:
-                self.gui.update_ent(self.gui.ent_pt2_temp, pt2_temperature[-1])
-            mag_temperature = mag_temperature.split(':')
-            if len(mag_temperature) > 0:
-                self.gui.update_ent(self.gui.ent_mag_temp, mag_temperature[-1])
-            mag_field = mag_field.split(':')
-            if len(mag_field) > 0:
-                self.gui.update_ent(self.gui.ent_curr_fld, mag_field[-1])
+        if 'IPS' in self._searching:
+            return
+        failure = self.controller.ips_connect(self.gui.ent_ips_com.get())  # read the user-supplied COM port name
+        if failure is not None:
+            self._searching.add('IPS')
+            self.gui.btn_ips_com['state'] = 'disabled'  # until the search is over
+            self.gui.update_ent(self.gui.ent_ips_com, 'Searching...')
+            Thread(target=self._search_ips, args=(failure,), daemon=True).start()
+            return
+        self.gui.set_ips_frame(True, switch_setting=self.controller.switch_status)
 
-            # read set points
-            mag_field = self.ips.transmit(f'READ:{uid_magnet}:SIG:FSET',
-                                          'Error reading magnetic field set point',
-                                          False)
-            mag_field = mag_field.split(':')
-            if len(mag_field) > 0:
-                self.gui.update_ent(self.gui.ent_field_set, mag_field[-1])
+    def _search_ips(self, failure):
+        port = self._find_and_connect('IPS', self.controller.ips_connect)
+        self.gui.post(self.gui.ent_ips_com, failure if port is None else port)
+        if port is None:
+            self.gui.post_call(self.gui.set_ips_frame, False)
+        else:
+            self.gui.post_call(self.gui.set_ips_frame, True, switch_setting=self.controller.switch_status)
+        self.gui.post_call(self.gui.btn_ips_com.configure, state='normal')
+        self.gui.post_call(self._searching.discard, 'IPS')
 
-            # get action info
-            if self._switch_action is not None:
-                if isinstance(self._switch_action, float):
-                    delta_time = time() - self._switch_action
-                    if delta_time <= 600:  # if it hasn't yet been ten minutes, show countdown
-                        if self._switch_status == SWITCH_WARMING:
-                            self.gui.update_ent(self.gui.ent_mag_action, f'Engaging {int(600 - delta_time)}')
-                        elif self._switch_status == SWITCH_COOLING:
-                            self.gui.update_ent(self.gui.ent_mag_action, f'Disengaging {int(600 - delta_time)}')
-                    else:
-                        self._switch_action = None
-                else:
-                    self._switch_action = time()
-            else:
-                action = self.ips.transmit(f'READ:{uid_magnet}:ACTN',
-                                           'Error reading magnet action',
-                                           False).split(':')
-                if len(action) > 0:
-                    self.gui.update_ent(self.gui.ent_mag_action, action[-1])
-                else:
-                    self.gui.update_ent(self.gui.ent_mag_action, '~')
-            sleep(self._ips_delay)
-        # after `while' loop breaks
-        return
+    def ips_disconnect(self):
+        self.controller.ips_disconnect()
+        self.gui.set_ips_frame(False)
 
     def disconnect_all(self):
-        self.itc.close()
-        self.ips.close()
+        if self.alarms is not None:
+            self.alarms.stop()
+        self.controller.disconnect_all()
         self.gui.master.destroy()
 
     def set_vti_temperature(self):
-        if not self.itc.is_open:
+        if not self.controller.itc.is_open:
             return
         new_value = input_popup('VTI Temperature Set Point', 'Set VTI temperature: (Kelvin)').strip('K')
         try:
@@ -257,11 +134,10 @@ class Application:
         except ValueError:
             new_value = -1
         self.gui.update_ent(self.gui.ent_vti_temp_set, '')
-        if min_temp <= new_value <= max_temp:
-            self.itc.transmit(f'SET:{uid_vti_temperature}:LOOP:TSET:{new_value}')
+        self.controller.set_vti_temperature(new_value)
 
     def set_vti_pressure(self):
-        if not self.itc.is_open:
+        if not self.controller.itc.is_open:
             return
         new_value = input_popup('VTI Pressure Set Point', 'Set VTI pressure: (mB)').strip('mB')
         try:
@@ -269,11 +145,10 @@ class Application:
         except ValueError:
             new_value = -1
         self.gui.update_ent(self.gui.ent_vti_press_set, '')
-        if min_press <= new_value <= max_press:
-            self.itc.transmit(f'SET:{uid_vti_pressure_set}:LOOP:TSET:{new_value}')
+        self.controller.set_vti_pressure(new_value)
 
     def set_magnetic_field(self):
-        if not self.ips.is_open:
+        if not self.controller.ips.is_open:
             return
         new_value = input_popup('Field Set Point', 'Set field set point: (Tesla)').strip('T')
         try:
@@ -281,28 +156,10 @@ class Application:
         except ValueError:
             new_value = 100  # 100 is a random invalid value designed to cause the next `if' to be false
         self.gui.update_ent(self.gui.ent_field_set, '')
-        if -7.0 <= new_value <= 7.0:  # if the value is valid
-            self.ips.transmit(f'SET:{uid_magnet}:SIG:FSET:{new_value}')
-
-    def ramp_goto_set(self):
-        if not self.ips.is_open or not self._switch_status == SWITCH_ENABLED:
-            return
-        self.ips.transmit(f'SET:{uid_magnet}:ACTN:RTOS')
-
-    def ramp_goto_zero(self):
-        if not self.ips.is_open or not self._switch_status == SWITCH_ENABLED:
-            return
-        self.ips.transmit(f'SET:{uid_magnet}:ACTN:RTOZ')
-
-    def ramp_hold(self):
-        if not self.ips.is_open or not self._switch_status == SWITCH_ENABLED:
-            return
-        self.ips.transmit(f'SET:{uid_magnet}:ACTN:HOLD')
-
-    def toggle_switch_heater(self):
-        pass
+        self.controller.set_magnetic_field(new_value)
 
 
 if __name__ == '__main__':
-    app = Application()
+    import sys
+    app = Application(worker='--worker' in sys.argv[1:])  # --worker: serial IO in a separate process
     app.run()
@@ -0,0 +1,171 @@
+import re
+import time
+from threading import Event, Lock
+
+# Settings for adaptive polling
+backoff_factor = 1.5  # a stable channel's period is multiplied by this after each unchanged reading, up to its maximum
+_number = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+
+def parse_reading(response):
+    """
+    Extracts the numeric value from a Mercury response such as `STAT:DEV:MB1.T1:TEMP:SIG:TEMP:4.2001K'. The last
+    colon-separated field is used and any unit suffix is ignored.
+
+    :param response: (str) response returned by SerialPort.transmit()
+    :return: float value, or None if the response holds no number (e.g. an error or an action such as `HOLD')
+    """
+    match = _number.match(response.split(':')[-1])
+    if match is None:
+        return None
+    return float(match.group(0))
+
+
+class PollChannel:
+    """
+    One periodically-read instrument signal. `command' is the READ command sent to poll it. The channel is polled every
+    `min_period' seconds while it is boosted or while its value is changing by more than `tolerance' per reading;
+    otherwise its period grows by `backoff_factor' after each unchanged reading until it reaches `max_period'.
+    Non-numeric readings (such as the magnet action) count as changed whenever the text differs. A `cache_ttl' (in
+    seconds) lets the read be answered from the instrument's ResponseCache.
+    """
+    def __init__(self, name, command, min_period, max_period, tolerance=0.0, error_message=None, cache_ttl=None):
+        self.name = name
+        self.command = command
+        self.cache_ttl = cache_ttl
+        self.min_period = min_period
+        self.max_period = max_period
+        self.tolerance = tolerance
+        self.error_message = error_message
+        self.period = min_period
+        self.next_due = 0.0  # monotonic time of the next poll; zero means poll straight away
+        self.boosted = False
+        self.last_response = None
+
+    def _changed(self, response):
+        if self.last_response is None:
+            return True
+        new_value, old_value = parse_reading(response), parse_reading(self.last_response)
+        if new_value is None or old_value is None:
+            return response.split(':')[-1] != self.last_response.split(':')[-1]
+        return abs(new_value - old_value) > self.tolerance
+
+
+class PollScheduler:
+    """
+    Decides which PollChannel objects of one instrument are due to be read. A monitor loop asks for the due() channels,
+    reads them (in one batch), reports each response with update() and then calls wait(), which sleeps until the next
+    channel falls due or until another thread calls poll_now() or boost(). All methods are thread-safe. Loops that
+    cannot block in wait() (such as an asyncio subscriber) register add_wakeup_callback() instead.
+    """
+    def __init__(self, channels=()):
+        self.channels = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._wakeup_callbacks = []
+        for channel in channels:
+            self.add(channel)
+
+    def add(self, channel):
+        with self._lock:
+            self.channels[channel.name] = channel
+
+    def remove(self, name):
+        with self._lock:
+            self.channels.pop(name, None)
+
+    def add_wakeup_callback(self, fn):
+        """
+        Arranges for fn() to be called (from the calling thread) whenever poll_now() or boost() wakes the scheduler.
+        """
+        with self._lock:
+            self._wakeup_callbacks.append(fn)
+
+    def remove_wakeup_callback(self, fn):
+        with self._lock:
+            if fn in self._wakeup_callbacks:
+                self._wakeup_callbacks.remove(fn)
+
+    def _wake(self):
+        self._wakeup.set()
+        with self._lock:
+            callbacks = list(self._wakeup_callbacks)
+        for fn in callbacks:
+            fn()
+
+    def next_due(self):
+        """
+        Returns the monotonic time at which the earliest channel falls due (None if there are no channels).
+        """
+        with self._lock:
+            return min((channel.next_due for channel in self.channels.values()), default=None)
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [channel for channel in self.channels.values() if channel.next_due <= now]
+
+    def update(self, channel, response, now=None):
+        """
+        Schedules the next poll of `channel' after a read that returned `response'. Failed or dropped reads (empty or
+        `?' responses) keep the current period and do not count as a change.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if isinstance(response, str) and len(response) > 0 and response[0] not in '?~':
+                if channel.boosted or channel._changed(response):
+                    channel.period = channel.min_period
+                else:
+                    channel.period = min(channel.period * backoff_factor, channel.max_period)
+                channel.last_response = response
+            channel.next_due = now + channel.period
+
+    def defer(self, channels, now=None):
+        """
+        Puts off the next poll of each of `channels' by its period without reading it or changing the period, for a
+        due channel that is not to be read for now. A channel left due instead would make wait() return at once.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for channel in channels:
+                channel.next_due = now + channel.period
+
+    def boost(self, names, enabled=True):
+        """
+        Holds the named channels at their fastest period while `enabled' (e.g. while the magnet is ramping). Enabling a
+        boost polls the channels straight away. Names of channels that are not being polled are ignored.
+        """
+        with self._lock:
+            for name in names:
+                channel = self.channels.get(name)
+                if channel is None:
+                    continue
+                if enabled and not channel.boosted:
+                    channel.period = channel.min_period
+                    channel.next_due = 0.0
+                channel.boosted = enabled
+        self._wake()
+
+    def poll_now(self, *names):
+        """
+        Makes the named channels due immediately, e.g. after a SET command changes them, and wakes the monitor loop.
+        Names of channels that are not being polled are ignored.
+        """
+        with self._lock:
+            for name in names:
+                if name not in self.channels:
+                    continue
+                self.channels[name].period = self.channels[name].min_period
+                self.channels[name].next_due = 0.0
+        self._wake()
+
+    def wait(self, max_wait=None):
+        """
+        Blocks until the earliest channel is due, poll_now()/boost() is called, or `max_wait' seconds pass.
+        """
+        next_due = self.next_due()
+        timeout = max_wait if next_due is None else max(next_due - time.monotonic(), 0.0)
+        if max_wait is not None:
+            timeout = min(timeout, max_wait)
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
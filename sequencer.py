@@ -0,0 +1,335 @@
+import os
+import json
+import math
+import hashlib
+from time import time, monotonic
+from threading import Thread, Event
+
+# Sequencer settings
+default_tolerances = {'magnet_field': 0.0005, 'vti_temperature': 0.05, 'vti_pressure': 0.1}  # `at target' margins
+default_timeout = 4 * 3600  # longest time in seconds a step waits for its target before the sequence is abandoned
+set_points = {'field': 'magnet_field', 'temperature': 'vti_temperature', 'pressure': 'vti_pressure'}  # step -> channel
+actions = tuple(set_points) + ('sweep_field', 'wait', 'dwell', 'acquire')  # the keys that say what a step does
+
+
+def _values(value):
+    """
+    Returns the set points of a field/temperature/pressure step: a number, a list, or {"from", "to", "step"}. A range
+    runs from `from' in steps of `step' without passing `to' and always ends on `to'. Raises ValueError for anything
+    else.
+    """
+    if isinstance(value, dict):
+        if sorted(value) != ['from', 'step', 'to'] or not all(_is_number(number) for number in value.values()):
+            raise ValueError(f'a range needs numeric "from", "to" and "step": {value!r}')
+        start, stop, step = value['from'], value['to'], abs(value['step'])
+        if step == 0:
+            raise ValueError(f'a range needs a non-zero "step": {value!r}')
+        count = math.floor(abs(stop - start) / step + 1e-9)  # steps that stay within `to' (allowing for rounding)
+        values = [round(start + index * (step if stop >= start else -step), 9) for index in range(count + 1)]
+        if abs(values[-1] - stop) > 1e-9:  # a step that does not divide the range ends short: finish on `to'
+            values.append(stop)
+        return values
+    values = list(value) if isinstance(value, list) else [value]
+    if not values or not all(_is_number(number) for number in values):
+        raise ValueError(f'set points must be numbers: {value!r}')
+    return values
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def expand_steps(steps):
+    """
+    Checks a sequence and expands each step that lists several set points into one step per set point, so that a
+    resumed sequence restarts at the point it was on. Raises ValueError, naming the step, for a step that cannot run.
+
+    :return: list of step dictionaries, each with one of `actions' (besides `dwell' and `acquire' as options)
+    """
+    expanded = []
+    for number, step in enumerate(steps, 1):
+        kinds = [key for key in step if key in actions and key not in ('dwell', 'acquire')]
+        if len(kinds) > 1 or not kinds and 'dwell' not in step and 'acquire' not in step:
+            raise ValueError(f'step {number} must have one of {", ".join(actions)}: {step!r}')
+        if kinds and kinds[0] in set_points:
+            try:
+                values = _values(step[kinds[0]])
+            except ValueError as error:
+                raise ValueError(f'step {number}: {error}')
+            expanded.extend(dict(step, **{kinds[0]: value}) for value in values)
+        elif kinds and kinds[0] == 'sweep_field' and not _is_number(step['sweep_field']):
+            raise ValueError(f'step {number}: the field to sweep to must be a number: {step!r}')
+        else:
+            expanded.append(dict(step))
+    return expanded
+
+
+def load_sequence(path):
+    """
+    Reads a sequence from a JSON file holding a list of steps, for example
+        [{"temperature": 10, "stable_for": 300},
+         {"field": {"from": 0, "to": 2, "step": 0.5}, "dwell": 60, "acquire": "measure"},
+         {"sweep_field": 0, "acquire": "measure"},
+         {"wait": "probe_temperature", "target": 10, "tolerance": 0.1}]
+    and checks it with expand_steps(), so that a mistake is reported before anything is connected.
+    """
+    with open(path) as file:
+        steps = json.load(file)
+    expand_steps(steps)
+    return steps
+
+
+class Sequencer:
+    """
+    Runs a declarative sequence of steps on a Controller, so that sweeps run unattended:
+
+        field, temperature, pressure  set the point (ramping the magnet with RTOS) and wait until the reading is
+                                      within `tolerance' for `stable_for' seconds; a list or {"from", "to", "step"}
+                                      runs the step once per set point
+        sweep_field                   ramp continuously to the field given, calling the `acquire' hook on every
+                                      field reading on the way
+        wait                          wait for the named channel to reach `target' (or `below'/`above' a value)
+        dwell                         wait a number of seconds (also allowed as an option of the steps above)
+        acquire                       call the named hook (also allowed as an option, after the step's wait)
+
+    Waiting steps take `tolerance', `stable_for' and `timeout' (seconds) options. Hooks are the acquisition code,
+    called as hook(sequencer, step) with `sequencer.latest' holding the latest reading of every channel. Waits use
+    Controller.wait_until(), which is woken by the readings the monitor threads take anyway, so a sequence adds no
+    serial traffic of its own. Given a `state_path', the index of the next step is saved there after each step so
+    that a sequence interrupted by a crash can be resumed with run(resume=True).
+    """
+    def __init__(self, controller, steps, hooks=None, state_path=None):
+        self.controller = controller
+        self.steps = expand_steps(steps)
+        self.hooks = {} if hooks is None else hooks
+        self.state_path = state_path
+        self.step_index = None  # index in `steps' of the step running, if any
+        self._fingerprint = hashlib.sha1(json.dumps(self.steps, sort_keys=True).encode()).hexdigest()
+        self._stop = Event()
+        self._thread = None
+
+    @property
+    def latest(self):
+        """
+        Dictionary mapping each channel name to (text, value, timestamp) of its latest reading.
+        """
+        return self.controller.latest
+
+    def start(self, resume=False):
+        """
+        Runs the sequence in a daemon thread (see run()).
+        """
+        self._thread = Thread(target=self.run, args=(resume,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Abandons the sequence after the current wait; the magnet and set points are left as they are.
+        """
+        self._stop.set()
+        self.controller.wake_waiters()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self, resume=False):
+        """
+        Runs the steps in order, from the step recorded in `state_path' if `resume'.
+
+        :return: True if every step completed, False if one failed or the sequence was stopped
+        """
+        first = self._load_state() if resume else 0
+        if first is None:
+            return False
+        self._stop.clear()
+        try:
+            for index in range(first, len(self.steps)):
+                self.step_index = index
+                print(f'Step {index + 1}/{len(self.steps)}: {json.dumps(self.steps[index])}')
+                if not self._run_step(self.steps[index]) or self._stop.is_set():
+                    print(f'Sequence stopped at step {index + 1}\a')
+                    return False
+                self._save_state(index + 1)
+        finally:
+            self.step_index = None
+        self._save_state(None)
+        return True
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as file:
+                state = json.load(file)
+        except (OSError, ValueError, TypeError):
+            return 0
+        if state.get('fingerprint') != self._fingerprint:
+            print(f'{self.state_path} was saved by a different sequence, so it cannot be resumed\a')
+            return None
+        return state['next']
+
+    def _save_state(self, next_index):
+        """
+        Records that the next step to run is `next_index' (None once the sequence is complete).
+        """
+        if self.state_path is None:
+            return
+        try:
+            if next_index is None:
+                if os.path.exists(self.state_path):
+                    os.remove(self.state_path)
+                return
+            with open(self.state_path + '.tmp', 'w') as file:
+                json.dump({'fingerprint': self._fingerprint, 'next': next_index, 'saved': time()}, file)
+            os.replace(self.state_path + '.tmp', self.state_path)
+        except OSError as error:
+            print(f'Error saving sequence state to {self.state_path}: {error!r}\a')
+
+    def _run_step(self, step):
+        controller = self.controller
+        since = time()
+        if 'field' in step:
+            if not controller.set_magnetic_field(step['field']):
+                print(f'Field {step["field"]} T could not be set\a')
+                return False
+            if not controller.ramp_goto_set():
+                print(f'The ramp to {step["field"]} T was not started (switch heater not enabled, or refused)\a')
+                return False
+            ok = self._wait_until('magnet_field', step['field'], step, since) and \
+                self._wait_until('magnet_action', None, {}, since, lambda action: action == 'HOLD')
+        elif 'temperature' in step:
+            if not controller.set_vti_temperature(step['temperature']):
+                print(f'Temperature {step["temperature"]} K could not be set\a')
+                return False
+            ok = self._wait_until('vti_temperature', step['temperature'], step, since)
+        elif 'pressure' in step:
+            if not controller.set_vti_pressure(step['pressure']):
+                print(f'Pressure {step["pressure"]} mB could not be set\a')
+                return False
+            ok = self._wait_until('vti_pressure', step['pressure'], step, since)
+        elif 'sweep_field' in step:
+            return self._sweep(step, since)
+        elif 'wait' in step:
+            ok = self._wait_until(step['wait'], step.get('target'), step, since)
+        else:
+            ok = True
+        if ok and 'dwell' in step:
+            ok = not self._stop.wait(step['dwell'])
+        if ok and 'acquire' in step:
+            ok = self._acquire(step)
+        return ok
+
+    def _wait_until(self, name, target, step, since, predicate=None):
+        """
+        Waits until the readings of channel `name' taken after `since' have been within the step's tolerance of
+        `target' (and `below'/`above' its values, if given), or satisfy predicate(reading), for its `stable_for'
+        seconds.
+
+        :return: True if they have, False if the step's timeout passed first or the sequence was stopped
+        """
+        tolerance = step.get('tolerance', default_tolerances.get(name, 0.0))
+        if predicate is None:
+            def predicate(reading):
+                return not isinstance(reading, str) and (target is None or abs(reading - target) <= tolerance) \
+                    and reading < step.get('below', float('inf')) and reading > step.get('above', float('-inf'))
+        timeout = step.get('timeout', default_timeout)
+        if self.controller.wait_until(name, predicate=predicate, stability_window=step.get('stable_for', 0),
+                                      timeout=timeout, since=since, cancel=self._stop) is not None:
+            return True
+        if not self._stop.is_set():
+            print(f'{name} did not reach its target within {timeout} s\a')
+        return False
+
+    def _sweep(self, step, since):
+        """
+        Ramps to the field of a sweep_field step, calling its `acquire' hook on each field reading until the magnet
+        holds at the target.
+        """
+        target = step['sweep_field']
+        if not self.controller.set_magnetic_field(target):
+            print(f'Field {target} T could not be set\a')
+            return False
+        if not self.controller.ramp_goto_set():
+            print(f'The ramp to {target} T was not started (switch heater not enabled, or refused)\a')
+            return False
+        tolerance = step.get('tolerance', default_tolerances['magnet_field'])
+        last = since
+        deadline = monotonic() + step.get('timeout', default_timeout)
+        while True:
+            reading = self.controller.wait_until('magnet_field', predicate=lambda field: not isinstance(field, str),
+                                                 timeout=max(deadline - monotonic(), 0.0), since=last,
+                                                 cancel=self._stop)
+            if reading is None:
+                if not self._stop.is_set():
+                    print(f'The field did not reach {target} T within {step.get("timeout", default_timeout)} s\a')
+                return False
+            field, last = reading
+            action, _, timestamp = self.latest.get('magnet_action', ('', None, 0.0))
+            done = abs(field - target) <= tolerance and action == 'HOLD' and timestamp > since
+            if 'acquire' in step and not self._acquire(step):
+                return False
+            if done:
+                return True
+
+    def _acquire(self, step):
+        hook = self.hooks.get(step['acquire'])
+        if hook is None:
+            print(f'No acquisition hook called {step["acquire"]!r}\a')
+            return False
+        try:
+            hook(self, step)
+        except Exception as error:
+            print(f'Error in acquisition hook {step["acquire"]!r}: {error!r}\a')
+            return False
+        return True
+
+
+def load_hooks(source):
+    """
+    Returns the functions of a module, given by name or by the path of a .py file, as a dictionary of hooks.
+    """
+    import importlib
+    import importlib.util
+    if source.endswith('.py'):
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(source))[0], source)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(source)
+    return {name: value for name, value in vars(module).items() if callable(value) and not name.startswith('_')}
+
+
+if __name__ == '__main__':
+    import argparse
+    from controller import Controller, default_comports
+    from alarms import AlarmEngine
+    parser = argparse.ArgumentParser(description='Run a measurement sequence without the panel.')
+    parser.add_argument('sequence', help='JSON file holding the list of steps')
+    parser.add_argument('--itc', help='iTC COM port (found automatically if not given)')
+    parser.add_argument('--ips', help='iPS COM port (found automatically if not given)')
+    parser.add_argument('--hooks', help='module name or .py file whose functions are the acquisition hooks')
+    parser.add_argument('--resume', action='store_true', help='continue from the step reached by an earlier run')
+    parser.add_argument('--log', help='directory for the data log')
+    arguments = parser.parse_args()
+    steps = load_sequence(arguments.sequence)
+    controller = Controller(log_directory=arguments.log)
+    ports = [arguments.itc, arguments.ips]
+    if None in ports:
+        found = controller.find_ports([model for model, port in zip(('ITC', 'IPS'), ports) if port is None])
+        ports = [port or found.get(model, {}).get('port', default)
+                 for model, port, default in zip(('ITC', 'IPS'), ports, default_comports)]
+    for connect, port in zip((controller.itc_connect, controller.ips_connect), ports):
+        failure = connect(port)
+        if failure is not None:
+            print(f'{port}: {failure}')
+    sequencer = Sequencer(controller, steps,
+                          load_hooks(arguments.hooks) if arguments.hooks else None, arguments.sequence + '.state')
+    alarms = AlarmEngine(controller)  # an interlock that acts on the magnet also stops the sequence
+    alarms.add_listener(lambda rule, tripped, timestamp: sequencer.stop() if tripped and rule.action else None)
+    alarms.start()
+    try:
+        completed = sequencer.run(arguments.resume)
+    except KeyboardInterrupt:
+        completed = False
+    alarms.stop()
+    controller.disconnect_all()
+    raise SystemExit(0 if completed else 1)
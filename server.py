@@ -0,0 +1,315 @@
+import os
+import json
+import queue
+import socket
+import socketserver
+from time import time
+from threading import Thread, Lock
+from concurrent.futures import Future
+
+# Server settings
+default_address = ('127.0.0.1', 7030)  # TCP address the server listens on
+default_freshness = 1.0  # seconds for which a monitored reading answers an identical READ request
+client_queue_size = 1000  # messages waiting to be sent to a client before further readings to it are dropped
+callable_methods = ('set_vti_temperature', 'set_vti_pressure', 'set_magnetic_field',
+                    'ramp_goto_set', 'ramp_goto_zero', 'ramp_hold')  # Controller methods clients may call
+
+
+class _Client:
+    """
+    One connected client: its subscriptions and a writer thread that sends it queued messages, so that a slow client
+    never holds up the monitor threads. Readings that do not fit in its queue are dropped and counted.
+    """
+    def __init__(self, wfile):
+        self.channels = None  # None until subscribed; then a set of channel names, empty meaning all channels
+        self.dropped = 0
+        self._wfile = wfile
+        self._queue = queue.Queue(client_queue_size)
+        self._thread = Thread(target=self._writer_thread, daemon=True)
+        self._thread.start()
+
+    def send(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self._queue.put(None)
+
+    def _writer_thread(self):
+        while True:
+            message = self._queue.get()
+            if message is None:
+                break
+            try:
+                self._wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+                self._wfile.flush()
+            except (OSError, ValueError):  # client went away
+                break
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        client = _Client(self.wfile)
+        self.server.reading_server._add_client(client)
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                request = {}
+                try:
+                    request = json.loads(line)
+                    reply = self.server.reading_server.handle(request, client)
+                except Exception as error:
+                    reply = {'type': 'error', 'error': repr(error)}
+                    if isinstance(request, dict) and 'id' in request:
+                        reply['id'] = request['id']
+                if reply is not None:
+                    client.send(reply)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.server.reading_server._remove_client(client)
+            client.close()
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+
+class ReadingServer:
+    """
+    Shares one Controller (and so one connection to each instrument) among any number of local clients over TCP and,
+    where supported, a Unix socket. The Controller polls as usual and the server fans each reading out to subscribed
+    clients. Requests and replies are single-line JSON objects; a request may carry an `id' that is echoed back.
+
+        {"op": "subscribe", "channels": [...]}  stream {"type": "reading", ...} messages (all channels if omitted)
+        {"op": "unsubscribe"}                    stop streaming
+        {"op": "latest"}                         the latest reading of every channel
+        {"op": "transmit", "instrument": "itc" or "ips", "command": "..."}  send a command and return the response
+        {"op": "call", "method": "...", "args": [...]}  call one of `callable_methods' on the Controller
+
+    A READ sent with `transmit' is answered with the Controller's latest monitored response to the same command (see
+    Controller.responses) if it is younger than `freshness' seconds and not an error; otherwise identical READs from
+    several clients that overlap in time share one round trip. `stats' counts both savings. SET commands are refused
+    by `transmit': set points and ramps go through `call', so that the Controller's range checks apply and the
+    channels they change are re-read.
+    """
+    def __init__(self, controller, address=default_address, unix_path=None, freshness=default_freshness):
+        self.controller = controller
+        self.address = address
+        self.unix_path = unix_path
+        self.freshness = freshness
+        self.latest = {}  # channel name -> latest reading message
+        self.stats = {'requests': 0, 'coalesced': 0, 'from_latest': 0}
+        self._clients = []
+        self._inflight = {}  # (instrument, command) -> Future of the response being read
+        self._lock = Lock()
+        self._servers = []
+
+    def start(self):
+        """
+        Starts listening and returns the TCP address actually bound (useful when the port given is 0).
+        """
+        self.controller.add_listener(self._on_reading)
+        tcp_server = _TCPServer(self.address, _RequestHandler)
+        self.address = tcp_server.server_address
+        self._servers.append(tcp_server)
+        if self.unix_path is not None:
+            self._servers.append(_UnixServer(self.unix_path, _RequestHandler))
+        for server in self._servers:
+            server.reading_server = self
+            Thread(target=server.serve_forever, daemon=True).start()
+        return self.address
+
+    def stop(self):
+        self.controller.remove_listener(self._on_reading)
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        if self.unix_path is not None:
+            try:
+                os.remove(self.unix_path)
+            except OSError:
+                pass
+
+    def _add_client(self, client):
+        with self._lock:
+            self._clients.append(client)
+
+    def _remove_client(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+    def _on_reading(self, name, text, value, timestamp):
+        message = {'type': 'reading', 'name': name, 'text': text, 'value': value, 'timestamp': timestamp}
+        with self._lock:
+            self.latest[name] = message
+            clients = list(self._clients)
+        for client in clients:
+            if client.channels is not None and (not client.channels or name in client.channels):
+                client.send(message)
+
+    def handle(self, request, client=None):
+        """
+        Handles one request and returns the reply (None for requests without one).
+        """
+        self.stats['requests'] += 1
+        op = request.get('op')
+        if op == 'subscribe':
+            client.channels = set(request.get('channels') or ())
+            reply = {'type': 'subscribed', 'channels': sorted(client.channels)}
+        elif op == 'unsubscribe':
+            client.channels = None
+            reply = {'type': 'unsubscribed'}
+        elif op == 'latest':
+            with self._lock:
+                reply = {'type': 'latest', 'readings': dict(self.latest)}
+        elif op == 'transmit':
+            reply = {'type': 'reply', 'response': self.transmit(request['instrument'], request['command'])}
+        elif op == 'call':
+            if request.get('method') not in callable_methods:
+                raise ValueError(f'method {request.get("method")!r} cannot be called')
+            result = getattr(self.controller, request['method'])(*request.get('args', ()))
+            reply = {'type': 'reply', 'result': result}
+        else:
+            raise ValueError(f'unknown op {op!r}')
+        if 'id' in request:
+            reply['id'] = request['id']
+        return reply
+
+    def transmit(self, instrument, command):
+        """
+        Sends `command' to the `itc' or `ips' port, sharing READs as described above, and returns the response. If
+        the read fails with an exception, every client sharing it gets the exception.
+        """
+        port, scheduler = {'itc': (self.controller.itc, self.controller.itc_scheduler),
+                           'ips': (self.controller.ips, self.controller.ips_scheduler)}[instrument]
+        command = command.strip()
+        if command.startswith('SET:'):
+            raise ValueError(f'SET commands are not sent as they are; use the call op ({", ".join(callable_methods)})')
+        for channel in scheduler.channels.values():
+            if channel.command == command:
+                response, timestamp = self.controller.responses.get(channel.name, ('', 0.0))
+                if response and response[0] not in '?~' and time() - timestamp <= self.freshness:
+                    self.stats['from_latest'] += 1
+                    return response
+        key = (instrument, command)
+        with self._lock:
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+        if not owner:
+            self.stats['coalesced'] += 1
+            return future.result()
+        try:
+            response = port.transmit(command, print_response=False)
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        future.set_result(response)
+        return response
+
+
+class ReadingClient:
+    """
+    A blocking client for ReadingServer. `address' is a (host, port) tuple for TCP or a path for a Unix socket.
+    Replies and streamed readings arrive on the same connection: request() waits for the reply with its id and hands
+    any readings received meanwhile to `on_reading' (if given), as does listen().
+    """
+    def __init__(self, address=default_address, on_reading=None):
+        family = socket.AF_INET if isinstance(address, tuple) else socket.AF_UNIX
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        self._socket.connect(address)
+        self._file = self._socket.makefile('rwb')
+        self._next_id = 0
+        self.on_reading = on_reading
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def _receive(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError('server closed the connection')
+        return json.loads(line)
+
+    def request(self, op, **fields):
+        self._next_id += 1
+        fields.update(op=op, id=self._next_id)
+        self._file.write((json.dumps(fields) + '\n').encode('utf-8'))
+        self._file.flush()
+        while True:
+            message = self._receive()
+            if message.get('id') == self._next_id:
+                if message['type'] == 'error':
+                    raise RuntimeError(message['error'])
+                return message
+            if message.get('type') == 'reading' and self.on_reading is not None:
+                self.on_reading(message)
+
+    def subscribe(self, channels=()):
+        return self.request('subscribe', channels=list(channels))
+
+    def latest(self):
+        return self.request('latest')['readings']
+
+    def transmit(self, instrument, command):
+        return self.request('transmit', instrument=instrument, command=command)['response']
+
+    def call(self, method, *args):
+        return self.request('call', method=method, args=list(args))['result']
+
+    def listen(self):
+        """
+        Yields streamed reading messages forever (after subscribe()).
+        """
+        while True:
+            message = self._receive()
+            if message.get('type') == 'reading':
+                if self.on_reading is not None:
+                    self.on_reading(message)
+                yield message
+
+
+if __name__ == '__main__':
+    import argparse
+    from time import sleep
+    from controller import Controller, default_comports
+    parser = argparse.ArgumentParser(description='Share the iTC and iPS connections with local clients.')
+    parser.add_argument('--itc', default=default_comports[0], help='iTC COM port')
+    parser.add_argument('--ips', default=default_comports[1], help='iPS COM port')
+    parser.add_argument('--host', default=default_address[0])
+    parser.add_argument('--port', type=int, default=default_address[1])
+    parser.add_argument('--unix', help='also listen on this Unix socket path')
+    parser.add_argument('--metrics', help='write serial port metrics to this file in Prometheus text format')
+    parser.add_argument('--trace', help='record the raw traffic and dump it into this directory after errors')
+    arguments = parser.parse_args()
+    controller = Controller(metrics_path=arguments.metrics, trace_directory=arguments.trace)
+    for connect, port in ((controller.itc_connect, arguments.itc), (controller.ips_connect, arguments.ips)):
+        failure = connect(port)
+        if failure is not None:
+            print(f'{port}: {failure}')
+    server = ReadingServer(controller, (arguments.host, arguments.port), arguments.unix)
+    print(f'Serving on {server.start()}')
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    controller.disconnect_all()
@@ -0,0 +1,288 @@
+import os
+import math
+import time
+import random
+import select
+import socket
+from threading import Thread, Lock
+
+# Default simulator settings
+default_latency = 0.01  # seconds between receiving a command and answering it
+default_jitter = 0.002  # extra latency drawn uniformly from [0, jitter) for every command
+default_ramp_rate = 0.5  # magnet ramp rate in Tesla per minute
+default_time_constant = 30  # seconds for a temperature or pressure to settle (1/e) towards its set point
+default_noise = 0.0005  # standard deviation of the noise added to each temperature/pressure reading
+
+# Devices simulated by default for each model, as UID -> (kind, initial value, initial set point)
+default_devices = {
+    'ITC': {'DEV:DB8.T1:TEMP': ('TEMP', 4.2, 4.2),  # probe
+            'DEV:MB1.T1:TEMP': ('TEMP', 4.2, 4.2),  # VTI
+            'DEV:DB5.P1:PRES': ('PRES', 5.0, None),  # VTI pressure, controlled through DB5.P1:TEMP
+            'DEV:DB5.P1:TEMP': ('TEMP', 5.0, 5.0)},
+    'IPS': {'DEV:DB7.T1:TEMP': ('TEMP', 40.0, None),  # PT2
+            'DEV:MB1.T1:TEMP': ('TEMP', 3.5, None),  # magnet
+            'DEV:GRPZ:PSU': ('PSU', 0.0, 0.0)},
+}
+pressure_loops = {'DEV:DB5.P1:PRES': 'DEV:DB5.P1:TEMP'}  # pressure sensor -> loop whose TSET is the pressure target
+
+
+class _Device:
+    """
+    State of one simulated device. Temperatures and pressures relax exponentially towards their set point; the magnet
+    power supply ramps its field linearly towards the set point (RTOS) or zero (RTOZ) and then holds.
+    """
+    def __init__(self, kind, value, setpoint):
+        self.kind = kind
+        self.value = value
+        self.setpoint = setpoint
+        self.action = 'HOLD'
+        self.switch_heater = 'ON'
+
+    def advance(self, elapsed, ramp_rate, time_constant, target=None):
+        if self.kind == 'PSU':
+            if self.action in ('RTOS', 'RTOZ'):
+                goal = self.setpoint if self.action == 'RTOS' else 0.0
+                step = ramp_rate / 60 * elapsed
+                if abs(goal - self.value) <= step:
+                    self.value, self.action = goal, 'HOLD'
+                else:
+                    self.value += step if goal > self.value else -step
+        else:
+            target = self.setpoint if target is None else target
+            if target is not None:
+                self.value = target + (self.value - target) * math.exp(-elapsed / time_constant)
+
+
+class MercurySimulator:
+    """
+    A simulated Oxford Instruments Mercury iTC or iPS (`model' 'ITC' or 'IPS') behind a pseudo-terminal, for
+    exercising SerialPort and the monitor loops without the instruments. After start(), `port' holds the path of the
+    pty that a SerialPort can open in place of a COM port. Commands are answered in order, one at a time, after
+    `latency' plus up to `jitter' seconds; `latencies' optionally maps command prefixes to their own latency. A fraction
+    `error_rate' of commands are answered with `?' and a fraction `drop_rate' are not answered at all. Unknown commands
+    are answered with `?'. `commands' counts the commands received. POSIX only (uses os.openpty()). Given a `tcp'
+    address, the simulator instead listens there like the instrument's Ethernet interface, one client at a time.
+    """
+    def __init__(self, model='ITC', latency=default_latency, jitter=default_jitter, error_rate=0.0, drop_rate=0.0,
+                 ramp_rate=default_ramp_rate, time_constant=default_time_constant, noise=default_noise,
+                 latencies=None, devices=None, serial_number='SIM0001', seed=None, tcp=None):
+        self.model = model.upper()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.ramp_rate = ramp_rate
+        self.time_constant = time_constant
+        self.noise = noise
+        self.latencies = latencies if latencies is not None else {}
+        self.serial_number = serial_number
+        self.tcp = tcp  # (host, port) to listen on instead of a pty; port 0 picks a free port
+        self.port = None
+        self.commands = 0
+        self.devices = {uid: _Device(*state) for uid, state in
+                        (devices if devices is not None else default_devices[self.model]).items()}
+        self._random = random.Random(seed)
+        self._lock = Lock()  # guards device state, which tests may change while the simulator runs
+        self._last_update = time.monotonic()
+        self._master, self._slave = None, None
+        self._listener, self._connection = None, None
+        self._running = False
+        self._thread = Thread()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """
+        Starts answering commands and returns the name to open: the pty path, or `tcp://host:port' when listening.
+        """
+        if self.tcp is not None:
+            self._listener = socket.create_server(self.tcp)
+            host, port = self._listener.getsockname()[:2]
+            self.port = f'tcp://{host}:{port}'
+        else:
+            import tty
+            self._master, self._slave = os.openpty()
+            tty.setraw(self._slave)  # no echo or line editing, like a real serial line
+            self.port = os.ttyname(self._slave)
+        self._running = True
+        self._thread = Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        self._thread.join(1)
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._master, self._slave = None, None
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+    def disconnect(self):
+        """
+        Drops the current TCP client, as a network fault or instrument restart would.
+        """
+        connection = self._connection
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _serve(self):
+        if self._listener is None:
+            self._serve_lines(self._master, lambda: os.read(self._master, 4096),
+                              lambda data: os.write(self._master, data))
+            return
+        while self._running:
+            readable, _, _ = select.select([self._listener], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                self._connection, _ = self._listener.accept()
+            except OSError:  # the listener was closed
+                break
+            with self._connection:
+                self._serve_lines(self._connection, lambda: self._connection.recv(4096), self._connection.sendall)
+            self._connection = None
+
+    def _serve_lines(self, source, read, write):
+        """
+        Answers newline-terminated commands read from `source' until it closes or the simulator stops.
+        """
+        buffer = b''
+        while self._running:
+            readable, _, _ = select.select([source], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                data = read()
+            except OSError:  # the pty or connection was closed
+                break
+            if not data:
+                break
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                command = line.decode('utf-8', 'replace').strip()
+                if command:
+                    response = self._answer(command)
+                    if response is not None:
+                        try:
+                            write((response + '\n').encode('utf-8'))
+                        except OSError:
+                            pass
+
+    def _answer(self, command):
+        self.commands += 1
+        latency = self.latency
+        for prefix, prefix_latency in self.latencies.items():
+            if command.startswith(prefix):
+                latency = prefix_latency
+                break
+        time.sleep(latency + self._random.random() * self.jitter)
+        if self._random.random() < self.drop_rate:
+            return None
+        if self._random.random() < self.error_rate:
+            return '?'
+        return self.respond(command)
+
+    def _advance(self):
+        now = time.monotonic()
+        elapsed, self._last_update = now - self._last_update, now
+        for uid, device in self.devices.items():
+            target = None
+            if uid in pressure_loops and pressure_loops[uid] in self.devices:
+                target = self.devices[pressure_loops[uid]].setpoint
+            device.advance(elapsed, self.ramp_rate, self.time_constant, target)
+
+    def respond(self, command):
+        """
+        Returns the response of the simulated instrument to `command' (without the newline).
+        """
+        if command == '*IDN?':
+            return f'IDN:OXFORD INSTRUMENTS:MERCURY {self.model}:{self.serial_number}:2.6.04.000'
+        if command == 'READ:SYS:CAT':
+            return 'STAT:SYS:CAT:' + ':'.join(self.devices)
+        parts = command.split(':')
+        if len(parts) < 4 or parts[0] not in ('READ', 'SET') or parts[1] != 'DEV':
+            return '?'
+        uid = ':'.join(parts[1:4])
+        with self._lock:
+            self._advance()
+            device = self.devices.get(uid)
+            if device is None:
+                return '?'
+            if parts[0] == 'READ':
+                value = self._read(device, parts[4:])
+                return '?' if value is None else f'STAT:{command[len("READ:"):]}:{value}'
+            if self._set(device, parts[4:-1], parts[-1]):
+                return f'STAT:{command}:VALID'
+            return f'STAT:{command}:INVALID'
+
+    def _read(self, device, path):
+        noise = self._random.gauss(0, self.noise) if self.noise else 0.0
+        if path == ['SIG']:  # every signal of the device
+            return ':'.join(f'{name}:{self._read(device, ["SIG", name])}' for name in
+                            (('FLD', 'FSET', 'SWHT') if device.kind == 'PSU' else (device.kind,)))
+        if device.kind == 'PSU':
+            if path == ['SIG', 'FLD']:
+                return f'{device.value:.4f}T'
+            if path == ['SIG', 'FSET']:
+                return f'{device.setpoint:.4f}T'
+            if path == ['ACTN']:
+                return device.action
+            if path == ['SIG', 'SWHT']:
+                return device.switch_heater
+            return None
+        unit = 'K' if device.kind == 'TEMP' else 'mB'
+        if path in (['SIG', 'TEMP'], ['SIG', 'PRES']) and path[1] == device.kind:
+            return f'{device.value + noise:.4f}{unit}'
+        if path[-2:] == ['LOOP', 'TSET'] and device.setpoint is not None:
+            return f'{device.setpoint:.4f}{unit}'
+        return None
+
+    def _set(self, device, path, value):
+        try:
+            number = float(value)
+        except ValueError:
+            number = None
+        if device.kind == 'PSU':
+            if path == ['ACTN'] and value in ('RTOS', 'RTOZ', 'HOLD'):
+                device.action = value
+                return True
+            if path == ['SIG', 'FSET'] and number is not None:
+                device.setpoint = number
+                return True
+            return False
+        if path[-2:] == ['LOOP', 'TSET'] and number is not None:
+            device.setpoint = number
+            return True
+        return False
+
+
+if __name__ == '__main__':
+    import sys
+    # python simulator.py [--tcp] [ITC] [IPS]; with --tcp the simulators listen on localhost ports 7020, 7021, ...
+    tcp = '--tcp' in sys.argv
+    models = [model for model in sys.argv[1:] if model != '--tcp'] or ['ITC', 'IPS']
+    simulators = [MercurySimulator(model, tcp=('127.0.0.1', 7020 + index) if tcp else None)
+                  for index, model in enumerate(models)]
+    for simulator in simulators:
+        print(f'Mercury {simulator.model} simulator on {simulator.start()}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for simulator in simulators:
+            simulator.stop()
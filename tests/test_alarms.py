@@ -0,0 +1,42 @@
+import os
+import time
+import pytest
+import alarms
+from alarms import AlarmEngine, AlarmRule
+from controller import Controller
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='the simulator runs behind a pty')
+
+stale_after = 0.6  # seconds, scaled down from alarms.stale_limit
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """
+    An AlarmEngine holding the magnet when its temperature goes stale, on a Controller connected to a simulated iPS
+    whose readings never change, so the temperature poll backs off as far as it may.
+    """
+    from simulator import MercurySimulator
+    monkeypatch.chdir(tmp_path)  # the port and catalogue caches are written to the working directory
+    monkeypatch.setattr(alarms, 'stale_check_interval', 0.05)
+    simulator = MercurySimulator('IPS', jitter=0.0, noise=0.0, seed=0)
+    controller = Controller(log_directory=str(tmp_path / 'logs'))
+    engine = AlarmEngine(controller, [AlarmRule('magnet temperature stale', 'magnet_temperature',
+                                                stale_after=stale_after, action='hold')])
+    engine.start()
+    assert controller.ips_connect(simulator.start()) is None
+    yield controller, engine
+    engine.stop()
+    controller.disconnect_all()
+    simulator.stop()
+
+
+def test_stable_reading_at_max_period_is_not_stale(engine):
+    controller, engine = engine
+    channel = controller.ips_scheduler.channels['magnet_temperature']
+    assert channel.max_period <= stale_after / alarms.stale_polls
+    time.sleep(8 * stale_after)
+    assert channel.period == channel.max_period  # backed off all the way
+    assert engine.active() == []
+    assert not engine.events
+    assert engine.latency.summary()['count'] == 0  # no HOLD was queued
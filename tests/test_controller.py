@@ -0,0 +1,23 @@
+from threading import Thread
+import pytest
+from controller import Controller
+
+
+@pytest.fixture
+def controller(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # the port and catalogue caches are written to the working directory
+    controller = Controller(log_directory=str(tmp_path / 'logs'))
+    yield controller
+    controller.disconnect_all()
+
+
+def test_wait_until_needs_target_or_predicate(controller):
+    """
+    A wait with nothing to wait for is refused up front, leaving the readings lock free for other waiters.
+    """
+    with pytest.raises(ValueError):
+        controller.wait_until('magnet_field', timeout=0.1)
+    waiter = Thread(target=controller.wait_until, args=('magnet_field', 0.0), kwargs={'timeout': 0.1})
+    waiter.start()
+    waiter.join(1)
+    assert not waiter.is_alive()
@@ -0,0 +1,67 @@
+import time
+import instrument
+from instrument import SerialPort, SerialMessage, answers
+
+temperature = 'READ:DEV:MB1.T1:TEMP:SIG:TEMP'
+setpoint = 'READ:DEV:MB1.T1:TEMP:SIG:TEMP:LOOP:TSET'
+
+
+class ScriptedTransport:
+    """
+    A transport that answers each write with the next of a list of scripted replies (bytes, sent as one burst).
+    """
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.port = 'scripted'
+        self.timeout = 0.01
+        self.is_open = True
+        self._input = b''
+
+    @property
+    def in_waiting(self):
+        return len(self._input)
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        self._input += self.replies.pop(0) if self.replies else b''
+        return len(data)
+
+    def read(self, size=1):
+        if not self._input:
+            time.sleep(self.timeout)
+            return b''
+        data, self._input = self._input[:size], self._input[size:]
+        return data
+
+
+def send(serialport, *commands):
+    messages = [SerialMessage(command, False) for command in commands]
+    serialport._send(messages)
+    return [message.result(0) for message in messages]
+
+
+def test_setpoint_does_not_answer_temperature_read():
+    assert answers('STAT:DEV:MB1.T1:TEMP:SIG:TEMP:4.2000K', temperature)
+    assert not answers('STAT:DEV:MB1.T1:TEMP:SIG:TEMP:LOOP:TSET:9.0000K', temperature)
+    assert answers('STAT:DEV:MB1.T1:TEMP:SIG:TEMP:LOOP:TSET:9.0000K', setpoint)
+    assert answers('STAT:DEV:MB1.T1:TEMP:SIG:TEMP:4.2000K:PRES:1.0000mB', 'READ:DEV:MB1.T1:TEMP:SIG')
+
+
+def test_lost_reply_and_late_reply_resync(monkeypatch):
+    """
+    A batch whose temperature reply is lost gives the temperature an empty response and the set point its own. A set
+    point reply that misses its batch and arrives ahead of the next temperature reply is discarded, not taken as the
+    temperature.
+    """
+    monkeypatch.setattr(instrument, 'delay_before_write', 0)
+    monkeypatch.setattr(instrument, 'default_timeout', 0.1)
+    temperature_reply = b'STAT:DEV:MB1.T1:TEMP:SIG:TEMP:4.2000K\n'
+    setpoint_reply = b'STAT:DEV:MB1.T1:TEMP:SIG:TEMP:LOOP:TSET:9.0000K\n'
+    serialport = SerialPort()
+    serialport._transport = ScriptedTransport([setpoint_reply, temperature_reply, setpoint_reply + temperature_reply])
+    assert send(serialport, temperature, setpoint) == ['', setpoint_reply.decode().strip()]
+    assert send(serialport, temperature, setpoint) == [temperature_reply.decode().strip(), '']
+    assert send(serialport, temperature) == [temperature_reply.decode().strip()]
+    assert serialport.metrics.discarded == 1
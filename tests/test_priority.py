@@ -0,0 +1,62 @@
+import os
+import time
+import pytest
+import instrument
+from instrument import SerialPort, SerialMessage, PRIORITY_CONTROL, PRIORITY_BACKGROUND
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='the simulator runs behind a pty')
+
+command_latency = 0.05  # seconds the simulated iPS takes to answer each command
+backlog = 12  # background polls queued ahead of each HOLD
+trials = 5
+hold = 'SET:DEV:GRPZ:PSU:ACTN:HOLD'
+poll = 'READ:DEV:GRPZ:PSU:SIG:FLD'
+
+
+@pytest.fixture
+def slow_port():
+    from simulator import MercurySimulator
+    simulator = MercurySimulator('IPS', latency=command_latency, jitter=0.0, noise=0.0, seed=0)
+    serialport = SerialPort()
+    serialport.coalesce_window = None  # every poll goes to the wire
+    assert serialport.open(simulator.start())
+    yield serialport
+    serialport.close()
+    simulator.stop()
+
+
+def test_hold_preempts_background_backlog(slow_port):
+    """
+    A HOLD queued behind `backlog' polls waits for the one poll in flight and then goes straight out: it must take
+    less than two and a half command times (one more poll served first would make it three), where FIFO order would
+    take `backlog' + 1.
+    """
+    command_time = command_latency + instrument.delay_before_write
+    limit = 2.5 * command_time
+    for _ in range(trials):
+        polls = [SerialMessage(poll, False, PRIORITY_BACKGROUND) for _ in range(backlog)]
+        for message in polls:
+            slow_port._queue.put(message)
+        time.sleep(command_time / 2)  # let the first poll get in flight
+        start = time.monotonic()
+        response = slow_port.transmit(hold, print_response=False, priority=PRIORITY_CONTROL)
+        latency = time.monotonic() - start
+        assert response.endswith(':VALID')
+        assert latency < limit, f'HOLD took {latency * 1e3:.1f} ms with {backlog} polls queued'
+        for message in polls:
+            assert message.result(backlog * command_time * 2) is not None
+        assert sum(message.completed < start + latency for message in polls) <= 1  # only the poll in flight
+
+
+def test_background_backlog_is_bounded(slow_port):
+    """
+    Polls beyond the background lane's depth are dropped unsent rather than delaying later commands.
+    """
+    depth = slow_port._queue.max_depth
+    polls = [SerialMessage(poll, False, PRIORITY_BACKGROUND) for _ in range(depth + 4)]
+    for message in polls:
+        slow_port._queue.put(message)
+    for message in polls:
+        message.result(len(polls) * (command_latency + instrument.delay_before_write) * 2)
+    assert sum(message.dropped for message in polls) >= 3
+    assert all(message.result(0).startswith('STAT:') for message in polls if not message.dropped)
@@ -0,0 +1,19 @@
+import pytest
+from sequencer import _values
+
+
+@pytest.mark.parametrize('span, expected', [
+    ({'from': 0, 'to': 2, 'step': 0.5}, [0, 0.5, 1.0, 1.5, 2.0]),
+    ({'from': 0, 'to': 7, 'step': 4}, [0, 4, 7]),
+    ({'from': 0, 'to': 1, 'step': 0.6}, [0, 0.6, 1]),
+    ({'from': 0, 'to': 2.5, 'step': 1}, [0, 1, 2, 2.5]),
+    ({'from': 1, 'to': 0, 'step': 0.1}, [1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1, 0.0]),
+    ({'from': 3, 'to': 3, 'step': 1}, [3]),
+])
+def test_range_ends_on_to_without_passing_it(span, expected):
+    assert _values(span) == pytest.approx(expected)
+
+
+def test_range_rejects_zero_step():
+    with pytest.raises(ValueError):
+        _values({'from': 0, 'to': 1, 'step': 0})
@@ -0,0 +1,90 @@
+import os
+import time
+from threading import Thread
+import pytest
+from controller import Controller, uid_magnet
+from server import ReadingServer, ReadingClient
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='the simulator runs behind a pty')
+
+field_read = f'READ:{uid_magnet}:SIG:FLD'
+action_read = f'READ:{uid_magnet}:ACTN'
+slow_read = f'READ:{uid_magnet}:SIG:FSET'  # answered slowly by the simulator, so that overlapping reads coalesce
+
+
+@pytest.fixture
+def served(tmp_path, monkeypatch):
+    """
+    A Controller connected to a simulated iPS, shared by a ReadingServer on a loopback port.
+    """
+    from simulator import MercurySimulator
+    monkeypatch.chdir(tmp_path)  # the port and catalogue caches are written to the working directory
+    simulator = MercurySimulator('IPS', latencies={slow_read: 0.3})
+    controller = Controller(log_directory=str(tmp_path / 'logs'))
+    assert controller.ips_connect(simulator.start()) is None
+    server = ReadingServer(controller, ('127.0.0.1', 0))
+    address = server.start()
+    yield controller, server, address
+    server.stop()
+    controller.disconnect_all()
+    simulator.stop()
+
+
+def test_subscribe_streams_readings(served):
+    controller, server, address = served
+    client = ReadingClient(address)
+    try:
+        client.subscribe(['magnet_field'])
+        controller.ips_scheduler.poll_now('magnet_field')
+        message = next(client.listen())
+        assert message['name'] == 'magnet_field'
+        assert isinstance(message['value'], float)
+    finally:
+        client.close()
+
+
+def test_transmit_answers_from_the_instrument_response(served):
+    controller, server, address = served
+    client = ReadingClient(address)
+    try:
+        controller.ips_scheduler.poll_now('magnet_field', 'magnet_action')
+        controller.wait_until('magnet_field', predicate=lambda field: True, since=0, timeout=5)
+        assert client.transmit('ips', field_read).startswith(f'STAT:{field_read[len("READ:"):]}:')
+        assert server.stats['from_latest'] >= 1
+        # a countdown shown in place of the magnet action is listener text, never a response
+        controller._notify('magnet_action', 'Engaging 532', None, time.time())
+        assert client.transmit('ips', action_read) == f'STAT:{action_read[len("READ:"):]}:HOLD'
+    finally:
+        client.close()
+
+
+def test_overlapping_reads_share_one_round_trip(served):
+    controller, server, address = served
+    server.freshness = 0  # always go to the instrument
+    clients = [ReadingClient(address) for _ in range(4)]
+    responses = []
+    threads = [Thread(target=lambda client=client: responses.append(client.transmit('ips', slow_read)))
+               for client in clients]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert len(responses) == 4 and len(set(responses)) == 1
+        assert responses[0].startswith(f'STAT:{slow_read[len("READ:"):]}:')
+        assert server.stats['coalesced'] >= 1
+    finally:
+        for client in clients:
+            client.close()
+
+
+def test_set_commands_go_through_the_controller(served):
+    controller, server, address = served
+    client = ReadingClient(address)
+    try:
+        with pytest.raises(RuntimeError, match='SET commands'):
+            client.transmit('ips', f'SET:{uid_magnet}:SIG:FSET:99')
+        assert client.call('set_magnetic_field', 99) is False  # beyond max_abs_field
+        assert client.call('set_magnetic_field', 0.5) is True
+    finally:
+        client.close()
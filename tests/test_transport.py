@@ -0,0 +1,37 @@
+import pytest
+from instrument import SerialPort, SocketTransport
+
+field_read = 'READ:DEV:GRPZ:PSU:SIG:FLD'
+
+
+@pytest.fixture
+def tcp_instrument():
+    """
+    A SerialPort connected through a SocketTransport to a simulated iPS listening on a loopback TCP port.
+    """
+    from simulator import MercurySimulator
+    simulator = MercurySimulator('IPS', tcp=('127.0.0.1', 0))
+    serialport = SerialPort()
+    assert serialport.open(simulator.start())
+    yield serialport, simulator
+    serialport.close()
+    simulator.stop()
+
+
+def test_round_trip(tcp_instrument):
+    serialport, simulator = tcp_instrument
+    assert isinstance(serialport._transport, SocketTransport)
+    assert serialport.transmit('*IDN?', print_response=False).startswith('IDN:OXFORD INSTRUMENTS:MERCURY IPS')
+    assert serialport.transmit_many([field_read, 'READ:DEV:GRPZ:PSU:ACTN'], print_response=False) == \
+        ['STAT:DEV:GRPZ:PSU:SIG:FLD:0.0000T', 'STAT:DEV:GRPZ:PSU:ACTN:HOLD']
+
+
+def test_reconnects_after_the_instrument_drops_the_connection(tcp_instrument):
+    serialport, simulator = tcp_instrument
+    serialport.coalesce_window = None  # send every read
+    assert serialport.transmit(field_read, print_response=False).startswith('STAT:')
+    simulator.disconnect()
+    responses = [serialport.transmit(field_read, print_response=False) for _ in range(3)]
+    assert serialport._transport.reconnects >= 1
+    assert responses[-1] == 'STAT:DEV:GRPZ:PSU:SIG:FLD:0.0000T'  # answered over the new connection
+    assert serialport.is_open
@@ -0,0 +1,184 @@
+import time
+import numpy as np
+import tkinter as tk
+
+# Trend plot settings
+trend_channels = (('magnet_field', 'Field', 'T'), ('magnet_temperature', 'Magnet', 'K'),
+                  ('pt2_temperature', 'PT2', 'K'), ('probe_temperature', 'Probe', 'K'),
+                  ('vti_temperature', 'VTI', 'K'), ('vti_pressure', 'VTI', 'mB'))  # channel, label, unit per plot
+trend_spans = (('10 min', 600), ('1 hour', 3600), ('8 hours', 28800), ('1 day', 86400), ('1 week', 604800))
+trend_interval = 0.5  # seconds between plot updates
+plot_width, plot_height = 900, 60  # pixels per plot
+plot_padding = 4  # pixels left free above and below the trace
+range_margin = 0.1  # fraction of the value range added above and below when the plot is rescaled
+
+
+def decimate(times, minima, maxima, pixel, first, last):
+    """
+    Reduces samples to one (min, max) pair per pixel column, with NumPy rather than a Python loop. Columns are
+    `pixel' seconds wide and numbered from the epoch (column c covers c * pixel to (c + 1) * pixel), so a column
+    keeps its number as the plot scrolls. `times' must be in order.
+
+    :return: (columns, minima, maxima) arrays for the columns from `first' to `last' that hold samples
+    """
+    columns = np.floor(times / pixel).astype(np.int64)
+    keep = (columns >= first) & (columns <= last)
+    columns, minima, maxima = columns[keep], minima[keep], maxima[keep]
+    if len(columns) == 0:
+        return columns, minima, maxima
+    starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])  # index of the first sample of each column
+    return columns[starts], np.minimum.reduceat(minima, starts), np.maximum.reduceat(maxima, starts)
+
+
+class TrendPlot(tk.Canvas):
+    """
+    A strip chart of one channel of a History over the last `span' seconds, one pixel column per `span / width'
+    seconds, drawn as the min/max envelope of each column so that spikes survive decimation. Updates are
+    incremental: as time passes the drawn trace is moved left, and only the columns completed since the last update
+    are added, as one new line item; the last two columns (which may still gain readings) are redrawn in place. The
+    whole plot is redrawn, with the value range fitted to the readings shown, only when the span changes, a reading
+    falls outside the range, or a quarter of the span has scrolled by since the last fit.
+    """
+    def __init__(self, master, channel, label, unit, span=trend_spans[0][1], width=plot_width, height=plot_height):
+        super().__init__(master, width=width, height=height, bg='black', highlightthickness=0)
+        self.channel = channel
+        self.label = label
+        self.unit = unit
+        self.plot_width, self.plot_height = width, height
+        self._label = self.create_text(4, 2, anchor=tk.NW, fill='white', text=label)
+        self._high_label = self.create_text(width - 4, 2, anchor=tk.NE, fill='gray')
+        self._low_label = self.create_text(width - 4, height - 2, anchor=tk.SE, fill='gray')
+        self.set_span(span)
+
+    def set_span(self, span):
+        self.span = span
+        self.pixel = span / self.plot_width  # seconds per pixel column
+        self._clear()
+
+    def _clear(self):
+        self.delete('trace')
+        self._column = None  # column at the right edge when last drawn; None until the first draw
+        self._drawn = None  # last column drawn into the completed chunks
+        self._last_point = ()  # (x, y) where the completed chunks end, so the next one joins on
+        self._chunks = []  # (line item, last column in it) for each completed chunk, oldest first
+        self._head = None  # line item of the columns that may still change
+        self._low = self._high = None
+        self._fitted = None  # column at the right edge when the value range was last fitted
+
+    def _y(self, values):
+        scale = (self.plot_height - 2 * plot_padding) / (self._high - self._low)
+        return self.plot_height - plot_padding - (values - self._low) * scale
+
+    def _points(self, columns, minima, maxima):
+        """
+        Returns the flat canvas coordinates of the envelope: for each column, its minimum then its maximum.
+        """
+        points = np.empty((len(columns), 4))
+        points[:, 0] = points[:, 2] = self.plot_width - 1 - (self._column - columns)
+        points[:, 1], points[:, 3] = self._y(minima), self._y(maxima)
+        return points.ravel().tolist()
+
+    def refresh(self, history, now=None):
+        """
+        Brings the plot up to date with the readings of its channel in `history'. Cheap when nothing has changed.
+        """
+        readings = history.channels.get(self.channel)
+        if readings is None:
+            return
+        now = time.time() if now is None else now
+        column = int(now // self.pixel)
+        if self._column is None or column - self._fitted >= self.plot_width // 4:
+            self._redraw(readings, now, column)
+            return
+        if column > self._column:  # scroll
+            self.move('trace', self._column - column, 0)
+            if self._last_point:
+                self._last_point = (self._last_point[0] - (column - self._column), self._last_point[1])
+            self._column = column
+            while self._chunks and self._chunks[0][1] <= column - self.plot_width:
+                self.delete(self._chunks.pop(0)[0])
+        first = self._drawn + 1
+        times, minima, maxima = readings.envelope(now - first * self.pixel, now)
+        columns, minima, maxima = decimate(times, minima, maxima, self.pixel, first, column)
+        if len(columns) and (self._low is None or minima.min() < self._low or maxima.max() > self._high):
+            self._redraw(readings, now, column)
+            return
+        self._draw(columns, minima, maxima, column)
+        self._show_last(readings)
+
+    def _redraw(self, readings, now, column):
+        self._clear()
+        self._column = self._fitted = column
+        times, minima, maxima = readings.envelope(self.span + self.pixel, now)
+        columns, minima, maxima = decimate(times, minima, maxima, self.pixel, column - self.plot_width + 1, column)
+        self._drawn = column - self.plot_width
+        if len(columns):
+            low, high = float(minima.min()), float(maxima.max())
+            spread = high - low if high > low else max(abs(high) * 1e-3, 1e-6)
+            self._low, self._high = low - spread * range_margin, high + spread * range_margin
+            self.itemconfigure(self._high_label, text=f'{self._high:.5g} {self.unit}')
+            self.itemconfigure(self._low_label, text=f'{self._low:.5g} {self.unit}')
+            self._draw(columns, minima, maxima, column)
+        self._show_last(readings)
+
+    def _draw(self, columns, minima, maxima, column):
+        """
+        Appends the completed `columns' as a new chunk and redraws the last two columns as the head. Draws nothing
+        while no reading has fallen in the span, as there is no value range to scale by.
+        """
+        if self._low is None:
+            return
+        completed = columns < column - 1
+        if completed.any():
+            points = list(self._last_point) + self._points(columns[completed], minima[completed], maxima[completed])
+            self._chunks.append((self.create_line(*points, fill='red', tags='trace'), int(columns[completed][-1])))
+            self._last_point = tuple(points[-2:])
+        self._drawn = max(self._drawn, column - 2)
+        head = list(self._last_point) + self._points(columns[~completed], minima[~completed], maxima[~completed])
+        if self._head is not None:
+            self.delete(self._head)
+            self._head = None
+        if len(head) >= 4:
+            self._head = self.create_line(*head, fill='red', tags='trace')
+
+    def _show_last(self, readings):
+        if not np.isnan(readings.last_value):
+            self.itemconfigure(self._label, text=f'{self.label} {readings.last_value:.5g} {self.unit}')
+
+
+class TrendPanel(tk.Frame):
+    """
+    Trend plots of `trend_channels' with a choice of span, updated from the Tk thread every `trend_interval'
+    seconds. `history' is a function returning the History to plot (e.g. lambda: controller.history), so that the
+    History is only created once the panel is first updated.
+    """
+    def __init__(self, master, history, channels=trend_channels):
+        super().__init__(master)
+        self.history = history
+        self._span = tk.StringVar(self, trend_spans[0][0])
+        frm_span = tk.Frame(self)
+        tk.Label(frm_span, text='Span').pack(side=tk.LEFT)
+        tk.OptionMenu(frm_span, self._span, *[name for name, _ in trend_spans], command=self._set_span).pack(
+            side=tk.LEFT)
+        frm_span.pack(anchor=tk.W)
+        self.plots = [TrendPlot(self, *channel) for channel in channels]
+        for plot in self.plots:
+            plot.pack(pady=1)
+        self.after(int(trend_interval * 1000), self._update)
+
+    def _set_span(self, name):
+        span = dict(trend_spans)[name]
+        for plot in self.plots:
+            plot.set_span(span)
+        self._refresh()
+
+    def _refresh(self):
+        history, now = self.history(), time.time()
+        for plot in self.plots:
+            plot.refresh(history, now)
+
+    def _update(self):
+        try:
+            self._refresh()
+        finally:  # keep updating even if one refresh fails
+            self.after(int(trend_interval * 1000), self._update)
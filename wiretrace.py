@@ -0,0 +1,263 @@
+import os
+import time
+import struct
+from datetime import datetime
+from threading import Thread, Lock
+
+# Trace settings
+default_slots = 32768  # records held by the ring buffer before the oldest are overwritten (4 MB)
+slot_size = 128  # bytes per record: a header then up to `slot_size - header.size' bytes of data
+default_dump_interval = 60  # shortest time in seconds between automatic dumps after errors
+default_speed = 1.0  # replay speed: 1 keeps the recorded timing, 10 is ten times faster and 0 never waits
+trace_magic = b'OXTRACE1\n'
+
+# Each record is a monotonic timestamp, a kind and the length of the data that follows it in the slot. Data longer
+# than a slot continues in the following slots, whose kind has CONTINUED added.
+header = struct.Struct('<dBB')
+file_header = struct.Struct('<ddI')  # wall-clock time and monotonic time of the dump, slot size
+KIND_WRITE = 0
+KIND_READ = 1
+CONTINUED = 0x80
+
+
+class WireTrace:
+    """
+    Records the raw traffic of a SerialPort: every write and every read (including empty ones, which are timeouts)
+    with its monotonic time, in a preallocated ring buffer of `slots' fixed-size binary records, so that
+    recording never allocates and costs a struct pack per line. Set it as the port's `trace' attribute before open().
+    dump() writes the buffer to a file on demand; given a `dump_directory', a timeout or `?' response also dumps it
+    there automatically (in a background thread, at most once every `dump_interval' seconds).
+    """
+    def __init__(self, slots=default_slots, dump_directory=None, dump_interval=default_dump_interval):
+        self.slots = slots
+        self.dump_directory = dump_directory
+        self.dump_interval = dump_interval
+        self.records = 0  # records written since creation (including overwritten ones)
+        self.dumps = []  # paths of the files written
+        self._buffer = bytearray(slots * slot_size)
+        self._head = 0  # slot the next record is written to
+        self._count = 0
+        self._last_dump = float('-inf')
+        self._lock = Lock()
+
+    def wrap(self, transport):
+        return TracingTransport(transport, self)
+
+    def record(self, kind, data, timestamp=None):
+        timestamp = time.monotonic() if timestamp is None else timestamp
+        space = slot_size - header.size
+        with self._lock:
+            for offset in range(0, max(len(data), 1), space):
+                chunk = data[offset:offset + space]
+                position = self._head * slot_size
+                header.pack_into(self._buffer, position, timestamp, kind | (CONTINUED if offset else 0), len(chunk))
+                self._buffer[position + header.size:position + header.size + len(chunk)] = chunk
+                self._head = (self._head + 1) % self.slots
+                self._count = min(self._count + 1, self.slots)
+                self.records += 1
+
+    def _snapshot(self):
+        with self._lock:
+            start = self._head if self._count == self.slots else 0
+            if start == 0:
+                return bytes(self._buffer[:self._count * slot_size])
+            return bytes(self._buffer[start * slot_size:]) + bytes(self._buffer[:start * slot_size])
+
+    def dump(self, path=None):
+        """
+        Writes the recorded traffic, oldest first, to `path' (by default a time-stamped file in `dump_directory' or
+        the working directory) and returns the path.
+        """
+        if path is None:
+            path = self._filename(self.dump_directory or '.')
+        self._write(path, self._snapshot())
+        return path
+
+    @staticmethod
+    def _filename(directory):
+        return os.path.join(directory, datetime.now().strftime('trace-%Y%m%d-%H%M%S-%f.oxtrace'))
+
+    def _write(self, path, data):
+        with open(path, 'wb') as file:
+            file.write(trace_magic + file_header.pack(time.time(), time.monotonic(), slot_size) + data)
+        self.dumps.append(path)
+
+    def _error(self):
+        """
+        Called on a timeout or error response: dumps the buffer in the background if automatic dumps are enabled.
+        """
+        if self.dump_directory is None or time.monotonic() - self._last_dump < self.dump_interval:
+            return
+        self._last_dump = time.monotonic()
+        os.makedirs(self.dump_directory, exist_ok=True)
+        data = self._snapshot()  # copied now, so the dump shows the traffic up to the error
+        Thread(target=self._write_dump, args=(data,), daemon=True).start()
+
+    def _write_dump(self, data):
+        path = self._filename(self.dump_directory)
+        try:
+            self._write(path, data)
+        except OSError as error:
+            print(f'Error writing trace {path}: {error!r}\a')
+
+
+class TracingTransport:
+    """
+    Wraps a transport (see instrument.make_transport()) so that its writes and reads are recorded in a WireTrace.
+    """
+    def __init__(self, transport, trace):
+        self.transport = transport
+        self.trace = trace
+
+    def __getattr__(self, name):  # everything else (port, timeout, is_open, in_waiting, ...) is the wrapped transport's
+        return getattr(self.transport, name)
+
+    def open(self):
+        self.transport.open()
+
+    def close(self):
+        self.transport.close()
+
+    def write(self, data):
+        self.trace.record(KIND_WRITE, data)
+        return self.transport.write(data)
+
+    def read(self, size=1):
+        data = self.transport.read(size)
+        self.trace.record(KIND_READ, data)
+        if not data or data[:1] == b'?' or b'\n?' in data:
+            self.trace._error()
+        return data
+
+
+def read_trace(path):
+    """
+    Reads a trace file written by WireTrace.dump().
+
+    :return: list of (monotonic time, kind, data) tuples in the order recorded, with continued data rejoined
+    """
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(trace_magic):
+        raise ValueError(f'{path} is not a trace file')
+    _, _, size = file_header.unpack_from(data, len(trace_magic))
+    records = []
+    for position in range(len(trace_magic) + file_header.size, len(data) - size + 1, size):
+        timestamp, kind, length = header.unpack_from(data, position)
+        chunk = data[position + header.size:position + header.size + length]
+        if kind & CONTINUED:
+            if records:  # (the start of a record overwritten in the ring leaves an orphaned continuation)
+                records[-1] = (records[-1][0], records[-1][1], records[-1][2] + chunk)
+        else:
+            records.append((timestamp, kind, chunk))
+    return records
+
+
+def pair_commands(records):
+    """
+    Pairs each command written in a trace with the response read for it, matching response lines to commands as
+    SerialPort._send() does.
+
+    :return: list of (command, write time, response, read time) tuples in the order written, where the response
+             and read time are None for commands that were not answered
+    """
+    from instrument import answers
+    pairs, outstanding, received = [], [], b''  # outstanding holds the indices in `pairs' of unanswered commands
+    for timestamp, kind, data in records:
+        if kind == KIND_WRITE:
+            for line in data.split(b'\n')[:-1]:
+                outstanding.append(len(pairs))
+                pairs.append([line + b'\n', timestamp, None, None])
+            continue
+        received += data
+        while b'\n' in received:
+            line, received = received.split(b'\n', 1)
+            text = line.decode('utf-8', 'replace').strip('\r')
+            for position, index in enumerate(outstanding):
+                command = pairs[index][0].decode('utf-8', 'replace')
+                if text.startswith('?') or answers(text, command):
+                    pairs[index][2:] = [line + b'\n', timestamp]
+                    del outstanding[:position + 1]
+                    break
+    return [tuple(pair) for pair in pairs]
+
+
+class ReplayTransport:
+    """
+    A transport (see instrument.make_transport()) that plays back a recorded trace instead of talking to an
+    instrument, for reproducing glitches and for performance tests of the monitor loops with real traffic. Open it
+    with the port name `replay://path' or `replay://path?speed=10'. Each command written is looked up among the
+    recorded commands (see pair_commands()), from where the previous one matched onwards, and read() returns the
+    recorded response after the recorded delay between the command and its response, divided by `speed' (0 for no
+    delays). So the replay follows the program being run: commands it skips are passed over, and a command that was
+    never recorded (counted in `mismatches') or never answered times out, as it did on the instrument.
+    """
+    def __init__(self, path, speed=default_speed):
+        self.path = path
+        self.speed = speed
+        self.port = f'replay://{path}'
+        self.timeout = 0.25
+        self.is_open = False
+        self.mismatches = 0
+        self._pairs = []
+        self._next = 0  # index of the first recorded command not yet replayed
+        self._pending = []  # (response or None for no answer, monotonic time it is due) for each command written
+        self._input = b''  # the part of a due response not yet read
+
+    def open(self):
+        self._pairs = pair_commands(read_trace(self.path))
+        self._next = 0
+        self._pending = []
+        self._input = b''
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def in_waiting(self):
+        return len(self._input)
+
+    def write(self, data):
+        if not self.is_open:
+            raise ValueError('Attempting to use a port that is not open')
+        now = time.monotonic()
+        for line in data.split(b'\n')[:-1]:
+            command = line + b'\n'
+            for index in range(self._next, len(self._pairs)):
+                if self._pairs[index][0] == command:
+                    _, write_time, response, read_time = self._pairs[index]
+                    delay = (read_time - write_time) / self.speed if self.speed and response is not None else 0.0
+                    self._pending.append((response, now + delay))
+                    self._next = index + 1
+                    break
+            else:
+                self.mismatches += 1
+                self._pending.append((None, None))
+        return len(data)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise ValueError('Attempting to use a port that is not open')
+        if not self._input:
+            response, due = self._pending.pop(0) if self._pending else (None, None)
+            if response is None:  # nothing recorded for this command: time out
+                time.sleep(self.timeout / self.speed if self.speed else 0)
+                return b''
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._input = response
+        data, self._input = self._input[:size], self._input[size:]
+        return data
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        print('Usage: python wiretrace.py trace.oxtrace')
+    else:
+        records = read_trace(sys.argv[1])
+        start = records[0][0] if records else 0.0
+        for timestamp, kind, data in records:
+            print(f'{timestamp - start:10.4f} {"<>"[kind == KIND_WRITE]} {data!r}')
@@ -0,0 +1,314 @@
+import os
+import math
+import struct
+from time import sleep
+from threading import Thread, Lock, Event
+from multiprocessing import shared_memory
+
+# Worker settings
+default_table_name = 'oxford_mercury_latest'  # shared memory name other local processes attach to
+default_slots = 64  # channels the table can hold
+poll_interval = 0.05  # seconds between the proxy's checks of the table for new readings
+worker_methods = ('itc_connect', 'ips_connect', 'itc_disconnect', 'ips_disconnect', 'find_ports',
+                  'set_vti_temperature', 'set_vti_pressure', 'set_magnetic_field', 'ramp_goto_set', 'ramp_goto_zero',
+                  'ramp_hold')  # Controller methods that can be called through the command pipe
+table_magic = b'OXLATEST'
+
+# Channel status in the table
+STATUS_EMPTY = 0  # slot not in use
+STATUS_OK = 1  # numeric reading
+STATUS_TEXT = 2  # non-numeric reading, such as the magnet action
+STATUS_ERROR = 3  # the read failed (`?' or no response)
+
+header = struct.Struct('<8sII')  # magic, number of slots, slots in use
+sequence = struct.Struct('<Q')
+# Each slot is a sequence number followed by the reading: value (NaN if none), timestamp, status, text, channel name
+reading = struct.Struct('<ddB31s32s')
+slot_size = sequence.size + reading.size
+
+
+class LatestTable:
+    """
+    The latest reading of every channel in a multiprocessing.shared_memory block, written by one process and read
+    by any number of others without locks. Each slot is guarded by a seqlock: the writer makes the slot's sequence
+    number odd, writes the reading and makes it even again, and a reader retries if the number was odd or changed
+    while it read. Slots are given to channels in the order they first appear and keep them. Use create() in the
+    process that owns the table (and unlink() it when done) and attach() everywhere else.
+    """
+    def __init__(self, memory, owner):
+        self._memory = memory
+        self._buffer = memory.buf
+        self.owner = owner
+        magic, self.slots, _ = header.unpack_from(self._buffer, 0)
+        if magic != table_magic:
+            raise ValueError(f'{memory.name} is not a table of latest readings')
+        self._index = {}  # channel name -> slot
+        self._lock = Lock()  # serialises the writers of one process (e.g. the two monitor threads)
+
+    @classmethod
+    def create(cls, name=default_table_name, slots=default_slots):
+        try:
+            memory = shared_memory.SharedMemory(name, create=True, size=header.size + slots * slot_size)
+        except FileExistsError:  # left behind by a process that did not unlink it
+            shared_memory.SharedMemory(name).unlink()
+            memory = shared_memory.SharedMemory(name, create=True, size=header.size + slots * slot_size)
+        memory.buf[:header.size + slots * slot_size] = bytes(header.size + slots * slot_size)
+        header.pack_into(memory.buf, 0, table_magic, slots, 0)
+        return cls(memory, True)
+
+    @classmethod
+    def attach(cls, name=default_table_name, tracked=False):
+        """
+        Opens the table created by another process. Python (before 3.13) has a process's resource tracker unlink
+        every shared memory block the process opened when it exits, which would remove the table from under its
+        owner, so the block is untracked again, unless `tracked' says this process shares the owner's tracker (as
+        processes started through multiprocessing by the owner do).
+        """
+        memory = shared_memory.SharedMemory(name)
+        if not tracked and os.name == 'posix':
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return cls(memory, False)
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def close(self):
+        self._buffer = None
+        self._memory.close()
+
+    def unlink(self):
+        self._memory.unlink()
+
+    def _offset(self, slot):
+        return header.size + slot * slot_size
+
+    def write(self, name, text, value, timestamp):
+        """
+        Publishes a reading as passed to Controller listeners. Readings of channels beyond the table's size are
+        dropped.
+        """
+        with self._lock:
+            slot = self._index.get(name)
+            if slot is None:
+                used = header.unpack_from(self._buffer, 0)[2]
+                if used >= self.slots:
+                    return
+                slot = self._index[name] = used
+                header.pack_into(self._buffer, 0, table_magic, self.slots, used + 1)
+            if value is not None:
+                status = STATUS_OK
+            else:
+                status = STATUS_ERROR if text in ('', '?', '~') else STATUS_TEXT
+            offset = self._offset(slot)
+            number = sequence.unpack_from(self._buffer, offset)[0]
+            sequence.pack_into(self._buffer, offset, number + 1)
+            reading.pack_into(self._buffer, offset + sequence.size, math.nan if value is None else value, timestamp,
+                              status, text.encode('utf-8')[:31], name.encode('utf-8')[:32])
+            sequence.pack_into(self._buffer, offset, number + 2)
+
+    def _read_slot(self, slot):
+        """
+        Returns (name, text, value, timestamp, status) from `slot', retrying while the writer is changing it.
+        """
+        offset = self._offset(slot)
+        while True:
+            number = sequence.unpack_from(self._buffer, offset)[0]
+            if number & 1:
+                sleep(0)
+                continue
+            value, timestamp, status, text, name = reading.unpack_from(self._buffer, offset + sequence.size)
+            if sequence.unpack_from(self._buffer, offset)[0] == number:
+                return (name.rstrip(b'\0').decode('utf-8'), text.rstrip(b'\0').decode('utf-8'),
+                        None if math.isnan(value) else value, timestamp, status)
+
+    def read(self, name):
+        """
+        Returns (text, value, timestamp, status) of the latest reading of channel `name', or None if there is none.
+        """
+        slot = self._index.get(name)
+        if slot is None:
+            self.read_all()  # learn the slots used since
+            slot = self._index.get(name)
+            if slot is None:
+                return None
+        return self._read_slot(slot)[1:]
+
+    def read_all(self):
+        """
+        Returns a dictionary mapping every channel name to (text, value, timestamp, status).
+        """
+        readings = {}
+        for slot in range(header.unpack_from(self._buffer, 0)[2]):
+            name, text, value, timestamp, status = self._read_slot(slot)
+            if status != STATUS_EMPTY:
+                self._index.setdefault(name, slot)
+                readings[name] = (text, value, timestamp, status)
+        return readings
+
+
+def _serve(table_name, connection, log_directory, metrics_path, trace_directory, alarms):
+    """
+    The worker process: runs a Controller (and, if `alarms', the default interlocks beside it), publishes its
+    readings into the LatestTable `table_name' and answers requests from `connection' until it receives None.
+    """
+    from controller import Controller
+    controller = Controller(log_directory, metrics_path, trace_directory)
+    table = LatestTable.attach(table_name, tracked=True)
+    controller.add_listener(table.write)
+    engine = None
+    if alarms:
+        from alarms import AlarmEngine
+        engine = AlarmEngine(controller)
+        engine.start()
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):  # the front end went away
+            break
+        if request is None:
+            break
+        method, args = request
+        try:
+            if method == 'is_open':
+                result = getattr(controller, args[0]).is_open
+            elif method == 'switch_status':
+                result = controller.switch_status
+            elif method == 'transmit':
+                result = getattr(controller, args[0]).transmit(args[1], print_response=False)
+            elif method in worker_methods:
+                result = getattr(controller, method)(*args)
+            else:
+                raise ValueError(f'method {method!r} cannot be called')
+            reply = ('ok', result)
+        except Exception as error:
+            reply = ('error', repr(error))
+        connection.send(reply)
+    if engine is not None:
+        engine.stop()
+    controller.disconnect_all()
+    table.close()
+
+
+class _PortProxy:
+    """
+    Stands in for Controller.itc/ips in the front end process: answers is_open and transmit() through the worker.
+    """
+    def __init__(self, proxy, name):
+        self._proxy = proxy
+        self._name = name
+
+    @property
+    def is_open(self):
+        return self._proxy._call('is_open', self._name)
+
+    def transmit(self, message):
+        return self._proxy._call('transmit', self._name, message)
+
+
+class WorkerController:
+    """
+    A Controller whose serial ports, IO threads and monitor loops run in a separate process, so that a busy GUI or
+    script in this one cannot delay the serial traffic (and the interlocks, which run in the worker too). It offers
+    the parts of the Controller interface the panel uses: the methods in `worker_methods' are sent over a pipe and
+    return the worker's result, `itc'/`ips' answer is_open, and listeners, `latest' and `history' are fed from the
+    LatestTable the worker publishes every reading into. Other local processes can read the same table with
+    LatestTable.attach(table_name).
+    """
+    def __init__(self, log_directory=None, metrics_path=None, trace_directory=None, alarms=True,
+                 table_name=default_table_name):
+        import multiprocessing
+        self.table = LatestTable.create(table_name)
+        context = multiprocessing.get_context('spawn')  # a fresh interpreter, whatever threads this process runs
+        self._connection, worker_connection = context.Pipe()
+        self._process = context.Process(target=_serve, args=(self.table.name, worker_connection, log_directory,
+                                                             metrics_path, trace_directory, alarms), daemon=True)
+        self._process.start()
+        worker_connection.close()
+        self._lock = Lock()  # one request on the pipe at a time
+        self.itc, self.ips = _PortProxy(self, 'itc'), _PortProxy(self, 'ips')
+        self._listeners = []
+        self._history = None
+        self._history_lock = Lock()
+        self._stop = Event()
+        self._thread = Thread(target=self._watch_table, daemon=True)
+        self._thread.start()
+
+    def _call(self, method, *args):
+        with self._lock:
+            self._connection.send((method, args))
+            status, result = self._connection.recv()
+        if status == 'error':
+            raise RuntimeError(f'{method} failed in the worker: {result}')
+        return result
+
+    def __getattr__(self, name):
+        if name in worker_methods:
+            return lambda *args: self._call(name, *args)
+        raise AttributeError(name)
+
+    @property
+    def switch_status(self):
+        return self._call('switch_status')
+
+    @property
+    def latest(self):
+        """
+        Dictionary mapping each channel name to (text, value, timestamp) of its latest reading, as Controller.latest.
+        """
+        return {name: entry[:3] for name, entry in self.table.read_all().items()}
+
+    @property
+    def history(self):
+        """
+        A History of the readings seen in the table from its first use (at most one per channel every `poll_interval'
+        seconds).
+        """
+        with self._history_lock:
+            if self._history is None:
+                from history import History
+                self._history = History()
+            return self._history
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _watch_table(self):
+        """
+        Thread function passing each new reading in the table to the listeners, as the monitor threads of a
+        Controller would.
+        """
+        seen = {}  # channel name -> timestamp of the reading last passed on
+        while not self._stop.wait(poll_interval):
+            for name, (text, value, timestamp, status) in self.table.read_all().items():
+                if seen.get(name) == timestamp:
+                    continue
+                seen[name] = timestamp
+                if value is not None and self._history is not None:
+                    self._history.record(name, value, timestamp)
+                for listener in list(self._listeners):
+                    try:
+                        listener(name, text, value, timestamp)
+                    except Exception as error:
+                        print(f'Error in listener for {name}: {error!r}\a')
+
+    def disconnect_all(self):
+        """
+        Disconnects both instruments and stops the worker.
+        """
+        self._stop.set()
+        try:
+            with self._lock:
+                self._connection.send(None)
+        except OSError:
+            pass
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
+        self.table.close()
+        self.table.unlink()